@@ -0,0 +1,28 @@
+### gunicorn settings for serving graph shard containers with several workers, i.e.
+### docker run -d -p 5050:5000 -e NXG_WORKERS=4 dinorows/nxg -m gunicorn -c gunicorn.conf.py nx_g_shard:app
+### Workers are separate processes. The CLIENT shard is shared between them
+### through a memory-mapped file in NXG_SHARED_DIR (see nx_g_shard.py), so
+### read endpoints like /bfs-trees-with-remote-nodes scale across cores.
+### Query sessions are per process, so the session endpoints (/session-expand,
+### /bfs-count-with-remote-nodes with a sid, /p2p-frontier, /superstep, ..)
+### refuse to serve with several workers: NXG_WORKERS defaults to 1, set it
+### only on CLIENTs that serve read endpoints alone.
+### SERVER and MASTER-SERVER state lives in a single process: run those with
+### NXG_WORKERS=1, and NXG_THREADS > 1 to serve concurrent requests.
+import os
+# the port also names the instance's shared shard file (see shared_name)
+os.environ.setdefault("NXG_PORT", "5000")
+bind = "0.0.0.0:" + os.environ["NXG_PORT"]
+workers = int(os.environ.get("NXG_WORKERS", "1"))
+# tells the app how many processes serve it (see sessions_refused())
+os.environ["NXG_PROCESSES"] = str(workers)
+# a single worker has nobody to share its shard with
+if workers > 1:
+    os.environ.setdefault("NXG_SHARED_DIR", "/dev/shm/nxg")
+threads = int(os.environ.get("NXG_THREADS", "1"))
+worker_class = "gthread" if threads > 1 else "sync"
+# a DBFS on a large remote fleet can take a while
+timeout = int(os.environ.get("NXG_TIMEOUT", "600"))
+# frontiers go as POST bodies, but some calls still carry node lists in the
+# query string (i.e. /session-expand info=..): 0 lifts the 4094 bytes limit
+limit_request_line = int(os.environ.get("NXG_LIMIT_REQUEST_LINE", "0"))
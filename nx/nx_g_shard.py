@@ -4,17 +4,34 @@ import json as j
 import networkx as nx
 import math as m
 from itertools import product
-from random import choice, sample
+from random import choice, sample, Random
 import sys 
 import time
 import datetime
+import itertools
+import logging
+import logging.handlers
+import queue
+import atexit
+import os
+import tempfile
+import mmap
+import struct
+import fcntl
+import contextlib
+import collections
+import threading
+import base64
+import hashlib
+from array import array
+from fractions import Fraction
 
 # neo/CYPHER
 from py2neo import Graph, Node, Relationship
 
 # janus/GREMLIN
 from gremlin_python import statics
-from gremlin_python.structure.graph import Graph as jGraph
+from gremlin_python.structure.graph import Graph as jGraph, Vertex, Edge
 from gremlin_python.process.graph_traversal import __
 from gremlin_python.driver.driver_remote_connection import DriverRemoteConnection
 
@@ -53,6 +70,7 @@ from gremlin_python.driver.driver_remote_connection import DriverRemoteConnectio
 ###
 ### Running as a local client (create a single networkX local shard):
 ### http://localhost:5000/testHealth
+### http://localhost:5000/log-level?level=debug&hop-sample=10
 ### http://localhost:5000/create-graph-shard?id=0&nodes=200&edges=0.08
 ### http://localhost:5000/edges?id=0
 ### http://localhost:5000/most-distant-internal-nodes?id=0&how-many=16
@@ -60,6 +78,17 @@ from gremlin_python.driver.driver_remote_connection import DriverRemoteConnectio
 ### http://localhost:5000/nodes-with-attribute?id=0&attribute=remote
 ### http://localhost:5000/bfs-trees-with-remote-nodes-from-center-node
 ### http://localhost:5000/bfs-trees-with-remote-nodes?sources=6,9,131,44,79
+### http://localhost:5000/bfs-trees-with-remote-nodes?sources=0.bQAI&bitmap=1
+### http://localhost:5000/bfs-reach-with-remote-nodes?sources=6,9,131,44,79
+### http://localhost:5000/bfs-count-with-remote-nodes?sid=5f3a&sources=6,9,131,44,79
+### http://localhost:5000/session-end?sid=5f3a
+### Incremental changes to the local shard, no need to grow it again:
+### http://localhost:5000/add-nodes?info=0.5,0.5,0.6,0.6
+### http://localhost:5000/add-edges?info=200,6,201,9
+### http://localhost:5000/remove-edges?info=200,6
+### http://localhost:5000/remove-nodes?nodes=200,201
+### http://localhost:5000/external-edges
+### http://localhost:5000/remove-edge-external?info=197,1,30,198,2,31
 ### -phost:container
 ### docker run -p7474:7474 -p7687:7687 --env NEO4J_AUTH=neo4j/test neo4j:latest
 ### docker run -it -p 8182:8182 janusgraph/janusgraph
@@ -79,6 +108,12 @@ from gremlin_python.driver.driver_remote_connection import DriverRemoteConnectio
 ### docker run -d -p 5050:5000 dinorows/nxg
 ### For easier debugging (can see print commands):
 ### docker run --rm -p 5050:5000 dinorows/nxg
+### Production serving of a CLIENT shard with several gunicorn workers (see gunicorn.conf.py):
+### docker run -d -p 5050:5000 -e NXG_WORKERS=4 dinorows/nxg -m gunicorn -c gunicorn.conf.py nx_g_shard:app
+### The CLIENT shard is then shared by all workers through a memory-mapped file in NXG_SHARED_DIR.
+### Query sessions are not: with NXG_WORKERS > 1 the session endpoints (counts-only and targeted DBFS,
+### peer-to-peer DBFS, vertex programs) answer 409. NXG_WORKERS defaults to 1, which serves everything.
+### SERVER and MASTER-SERVER state is per process, so run those with NXG_WORKERS=1 (NXG_THREADS > 1 is fine).
 ###
 ###
 ### Running as a CLIENT demo, containerized (create a single networkX graph shard on a container):
@@ -104,7 +139,55 @@ from gremlin_python.driver.driver_remote_connection import DriverRemoteConnectio
 ### http://localhost:5000/do-dbfs?shard=1&verbose=0
 ### http://localhost:5000/do-dbfs?shard=2&verbose=0
 ### http://localhost:5000/do-dbfs?shard=3&verbose=0
+### Shards return counts and boundaries only, keeping the nodes visited:
+### http://localhost:5000/do-dbfs?shard=0&verbose=0&counts-only=1
+### Level by level, frontiers combined into one request per shard per level:
+### http://localhost:5000/do-dbfs?shard=0&verbose=0&combine=1
+### Shard queue policies, side by side (also works for a MASTER-SERVER):
+### http://localhost:5000/do-dbfs-policies?shard=0&policies=fifo,largest,contributions,latency&runs=3
+### http://localhost:5000/do-dbfs?shard=0&verbose=0&policy=largest
+### Repeated BFSes off the shards' result caches, hits and misses (also works for a MASTER-SERVER):
+### http://localhost:5000/bfs-cache?capacity=256&clear=0
+### Many DBFSes in one traversal, up to 64 sharing each shard call, side by side with one by one
+### (also works for a MASTER-SERVER):
+### http://localhost:5000/do-dbfs-batch?shards=all&compare=1
+### Checkpoint the DBFS state to disk (NXG_CHECKPOINT_DIR), and resume it after a crash
+### (also works for a MASTER-SERVER):
+### http://localhost:5000/do-dbfs?shard=0&verbose=0&checkpoint=1&traversal=t1
+### http://localhost:5000/do-dbfs-resume?traversal=t1&verbose=0
+### http://localhost:5000/dbfs-checkpoints?remove=t1
 ### < 0.01 second
+### Change the graph in between DBFSes (also works for a MASTER-SERVER):
+### http://localhost:5000/churn-cross-cuts?changes=16
+### http://localhost:5000/add-cross-cuts?info=0,197,1,30,0,198,3,31
+### http://localhost:5000/remove-cross-cuts?info=0,197,1,30
+### http://localhost:5000/remove-shard-nodes?shard=0&nodes=6,9,131
+### http://localhost:5000/add-shard-nodes?shard=0&info=0.5,0.5
+### http://localhost:5000/add-shard-edges?shard=0&info=200,6
+### http://localhost:5000/remove-shard-edges?shard=0&info=200,6
+### Plan the DBFS on the coordinator's summary graph, count-only without calling any shard:
+### http://localhost:5000/summary-graph
+### http://localhost:5000/do-dbfs-summary?shard=0&counts-only=1&verbose=0
+### http://localhost:5000/do-dbfs-summary?shard=0&counts-only=0&verbose=0
+### Label every node with its global component, then answer DBFS reach from the labels:
+### http://localhost:5000/label-components-fleet
+### http://localhost:5000/do-dbfs-components?shard=0&check=1
+### Replicate the remote nodes within k hops of each shard's boundary, the DBFS goes through them:
+### http://localhost:5000/do-dbfs-halo?shard=0&k=2&verbose=0
+### Targeted queries, stopping as soon as the answer is known:
+### http://localhost:5000/shortest-path?from-shard=0&to-shard=3&verbose=0
+### http://localhost:5000/k-hop?shard=0&k=3&verbose=0
+### http://localhost:5000/do-dbfs-levels?shard=0&verbose=0
+### Iterative analytics in supersteps, one call per shard per superstep:
+### http://localhost:5000/pregel?algorithm=pagerank&supersteps=100&top=5
+### http://localhost:5000/pregel?algorithm=cc
+### The same DBFS over emulated networks, every shard call paying round trip, jitter,
+### bandwidth and loss in simulated time (also works for a MASTER-SERVER):
+### http://localhost:5000/do-dbfs-network-sweep?shard=0&scenarios=direct,lan,wan,intercontinental
+### http://localhost:5000/do-dbfs-network-sweep?shard=0&rtt-ms=20&jitter-ms=2&mbps=100&loss=0.01&combine=1
+### The cost model fit from those runs, and its predictions for other fleets and networks:
+### http://localhost:5000/cost-model
+### http://localhost:5000/cost-model-predict?shards=64&nodes=200&scenarios=lan,wan
 ### PICK TO BEGIN THE DBFS ON THE SHARD THAT EXHIBITS CROSS-CUTS ABOVE
 ### May have to run:
 ### docker system prune --volumes
@@ -117,7 +200,15 @@ from gremlin_python.driver.driver_remote_connection import DriverRemoteConnectio
 ### note -d and -it options, instead of --rm which allows me to stop container with CTRL-Z
 ### http://localhost:5000/clone-shards-to-janus?janus-ip=192.168.99.100&janus-start-port=8182&how-many-shards=4&verbose=0
 ### http://localhost:5000/do-ddbfs-on-janus-shards?shard=0&verbose=0
+### http://localhost:5000/do-ddbfs-side-by-side?fleets=neo,janus&shard=0&verbose=0
 ### ~30 seconds
+### No containers: ip 'fake' clones to in-process neo and janus stand-ins, with a
+### latency injected per round trip, i.e. to benchmark the driver side:
+### http://localhost:5000/fake-engines?latency-ms=2&clear=1
+### http://localhost:5000/clone-shards-to-janus?janus-ip=fake&janus-start-port=8182&how-many-shards=4&verbose=0
+### http://localhost:5000/clone-shards-to-neo?neo-ip=fake&neo-start-port=7474&how-many-shards=4&verbose=0
+### http://localhost:5000/do-ddbfs-side-by-side?fleets=neo,janus&shard=0&verbose=0
+### http://localhost:5000/fake-engines
 ### docker run -p7474:7474 -p7687:7687 --env NEO4J_AUTH=neo4j/test neo4j:latest
 ### docker run -p7475:7474 -p7688:7687 --env NEO4J_AUTH=neo4j/test neo4j:latest
 ### docker run -p7476:7474 -p7689:7687 --env NEO4J_AUTH=neo4j/test neo4j:latest
@@ -157,6 +248,18 @@ from gremlin_python.driver.driver_remote_connection import DriverRemoteConnectio
 ### http://localhost:5000/create-remote-shards?shards=4&nodes=200&edges=0.08&farnodes=16&shards-ip=192.168.99.100&shard-ports-start-at=5050&verbose=0
 ### http://localhost:5000/do-ddbfs?shard=0&verbose=0
 ### ~.1 second for shard exhibiting cross-cuts.
+### Shards return counts and boundaries only, much smaller responses on big shards:
+### http://localhost:5000/do-ddbfs?shard=0&verbose=0&counts-only=1
+### Peer-to-peer, the shards forward frontiers to each other and only report counts here:
+### http://localhost:5000/do-dbfs-p2p?shard=0&master=192.168.99.1:5000&verbose=0
+### Speculative, the next shards on the queue start while a shard runs:
+### http://localhost:5000/do-dbfs-speculative?shard=0&width=2&verbose=0
+### http://localhost:5000/do-ddbfs?shard=0&verbose=0&speculate=2
+### Deadlines, retries and hedged requests to shard replicas (CLIENTs sharing a NXG_SHARED_DIR and NXG_INSTANCE),
+### and an answer without the shards that stay unavailable:
+### http://localhost:5000/rpc-settings?timeout=5&retries=2&hedge-percentile=95
+### http://localhost:5000/shard-replicas?shard=0&replicas=192.168.99.100:5070
+### http://localhost:5000/do-ddbfs?shard=0&verbose=0&partial=1
 ###
 ###
 ### NOTE: LIMITS ON THE NUMBER OF CONTAINERS
@@ -221,7 +324,202 @@ def myjson(j):
     if not '[' == t[0]:
         t = '[' + t + ']'
     return t
+def mytuples(info, width):
+    # flat comma separated query parameter to a list of width-tuples, None if it doesn't divide
+    numbers = list(map(lambda e: round(float(e),2) if '.' in e else int(e), info.split(",")))
+    if 0 != len(numbers) % width:
+        return None
+    return [tuple(numbers[i:i+width]) for i in range(0, len(numbers), width)]
+
+
+#####################################################
+### compressed node id sets
+###
+### Roaring-style: node ids are split in chunks of
+### 2**16 ids, and each chunk is a python int used as
+### a bitmap, so union and difference run a whole 
+### chunk at a time. On the wire, each chunk goes as
+### a bitmap or as an array of 16-bit ids, whichever
+### is smaller, base64 (url safe) encoded:
+### key.b<bitmap>~key.a<array>~..
+#####################################################
+byte_bits = [tuple(b for b in range(8) if v >> b & 1) for v in range(256)]
+
+class NodeSet:
+    __slots__ = ('chunks',)
+
+    def __init__(self, nodes=()):
+        self.chunks = dict()   # id >> 16 -> bitmap of the ids' low 16 bits
+        if isinstance(nodes, NodeSet):
+            self.chunks.update(nodes.chunks)
+            return
+        lows = dict()
+        for n in nodes:
+            lows.setdefault(n >> 16, []).append(n & 0xffff)
+        for key, chunk in lows.items():
+            bits = bytearray(8192)
+            for low in chunk:
+                bits[low >> 3] |= 1 << (low & 7)
+            self.chunks[key] = int.from_bytes(bits, 'little')
+
+    def __len__(self):
+        return sum(bin(bits).count('1') for bits in self.chunks.values())
+
+    def __bool__(self):
+        return 0 < len(self.chunks)
+
+    def __contains__(self, n):
+        return 1 == (self.chunks.get(n >> 16, 0) >> (n & 0xffff)) & 1
+
+    def __iter__(self):
+        for key in sorted(self.chunks):
+            base = key << 16
+            bits = self.chunks[key]
+            for i, byte in enumerate(bits.to_bytes((bits.bit_length() + 7) // 8, 'little')):
+                if byte:
+                    for b in byte_bits[byte]:
+                        yield base + (i << 3) + b
+
+    def __repr__(self):
+        return "NodeSet(" + str(list(self)) + ")"
+
+    def add(self, n):
+        self.chunks[n >> 16] = self.chunks.get(n >> 16, 0) | 1 << (n & 0xffff)
+
+    def update(self, nodes):
+        if not isinstance(nodes, NodeSet):
+            nodes = NodeSet(nodes)
+        for key, bits in nodes.chunks.items():
+            self.chunks[key] = self.chunks.get(key, 0) | bits
+
+    def __sub__(self, nodes):
+        if not isinstance(nodes, NodeSet):
+            nodes = NodeSet(nodes)
+        result = NodeSet()
+        for key, bits in self.chunks.items():
+            if key in nodes.chunks:
+                bits &= ~nodes.chunks[key]
+            if bits:
+                result.chunks[key] = bits
+        return result
+
+    def __or__(self, nodes):
+        result = NodeSet(self)
+        result.update(nodes)
+        return result
+
+    def to_wire(self):
+        encoded = []
+        for key in sorted(self.chunks):
+            bits = self.chunks[key]
+            bitmap = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+            count = bin(bits).count('1')
+            if 2 * count < len(bitmap):
+                lows = array('H', (n & 0xffff for n in self.chunk(key)))
+                if sys.byteorder != 'little':
+                    lows.byteswap()
+                encoded.append(str(key) + '.a' + base64.urlsafe_b64encode(lows.tobytes()).decode().rstrip('='))
+            else:
+                encoded.append(str(key) + '.b' + base64.urlsafe_b64encode(bitmap).decode().rstrip('='))
+        return '~'.join(encoded)
+
+    # the ids of chunk key
+    def chunk(self, key):
+        nodes = NodeSet()
+        nodes.chunks[key] = self.chunks[key]
+        return iter(nodes)
+
+    @staticmethod
+    def from_wire(encoded):
+        nodes = NodeSet()
+        for part in encoded.split('~') if encoded else []:
+            key, data = part.split('.')
+            raw = base64.urlsafe_b64decode(data[1:] + '=' * (-len(data[1:]) % 4))
+            if 'a' == data[0]:
+                lows = array('H')
+                lows.frombytes(raw)
+                if sys.byteorder != 'little':
+                    lows.byteswap()
+                bits = bytearray(8192)
+                for low in lows:
+                    bits[low >> 3] |= 1 << (low & 7)
+                raw = bytes(bits)
+            bits = int.from_bytes(raw, 'little')
+            if bits:
+                nodes.chunks[int(key)] = bits
+        return nodes
+
 		
+#####################################################
+### Remote shard calls: deadlines, retries, replicas
+###
+### Every call to a remote shard has a deadline per 
+### attempt (rpc.timeout). The DBFS calls are retried
+### on timeouts, connection errors and server errors, 
+### with a short backoff. The ones that change session
+### state on the shard carry a request id, so that the
+### shard answers a retry with the reply it has given
+### already (see reply_once()). A shard may have 
+### replicas: other CLIENTs serving the same shard, 
+### i.e. sharing its NXG_SHARED_DIR. A call without
+### side effects goes to a replica as well if the 
+### shard has not answered by the rpc.hedge_percentile
+### percentile of its latency (hedged request), and 
+### the first answer wins. Tail latency, per shard,
+### is in the stats (see /rpc-settings).
+#####################################################
+class RpcSettings:
+    def __init__(self):
+        self.timeout = float(os.environ.get('NXG_RPC_TIMEOUT', 30))     # seconds per attempt
+        self.retries = int(os.environ.get('NXG_RPC_RETRIES', 2))
+        self.backoff = 0.05                                              # seconds, doubled per retry
+        self.hedge_percentile = float(os.environ.get('NXG_RPC_HEDGE_PERCENTILE', 95))
+
+    def settings(self):
+        return {'timeout': self.timeout, 'retries': self.retries, 'backoff': self.backoff, 'hedge_percentile': self.hedge_percentile}
+
+rpc = RpcSettings()
+
+# p-th percentile of sorted samples, nearest rank
+def percentile(samples, p):
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, max(0, int(m.ceil(p / 100. * len(samples))) - 1))]
+
+# What a CLIENT shard replies to request rid of session sid, computed only once:
+# a retry gets the same reply, and waits for it if the first attempt is still going.
+# The coordinator calls a session one request at a time, so only the last reply is
+# kept: the next request id replaces it. A request that failed is not kept, its
+# retry computes again (and concurrent waiters get the same error).
+replies_lock = threading.Lock()
+
+def reply_once(shard, sid, rid, compute):
+    if rid is None:
+        return compute()
+    with replies_lock:
+        session = shard.sessions.setdefault(sid, dict())
+        last = session.get('reply')
+        first = last is None or last[0] != rid
+        if first:
+            last = session['reply'] = (rid, [threading.Event(), None, None])
+    entry = last[1]
+    if first:
+        try:
+            entry[1] = compute()
+        except Exception as e:
+            entry[2] = e
+            with replies_lock:
+                if session.get('reply') is last:
+                    del session['reply']
+            raise
+        finally:
+            entry[0].set()
+    elif not entry[0].wait(rpc.timeout):
+        raise RuntimeError("request " + rid + " of session " + sid + " still going")
+    elif entry[2] is not None:
+        raise entry[2]
+    return entry[1]
+
 class dShard:
     # The constructor stores ip and port for the remote node,
     # creates a remote shard, and grows it. All other methods 
@@ -237,15 +535,13 @@ class dShard:
           "http://" + ip + ":" + str(port) + 
           "/create-graph-shard?id=" + str(guid) + 
           "&nodes=" + str(nodes) +
-          "&edges=" + str(p)
+          "&edges=" + str(p),
+          timeout=rpc.timeout
         )
         responsetext = myjson(response.text)
 		
         if verbose:
-            if total_recall:
-                sys.stderr.write("Created shard with edges and center: " + responsetext + " at port " + str(port))
-            else:
-                print("Created shard with edges and center: " + responsetext + " at port " + str(port))
+            log.info("created remote shard edges_and_center=%s port=%s", responsetext, port)
 				
         currdt = datetime.datetime.now()
         self.when = "Remote shard " + str(guid) + " with number of edges and center node: " + responsetext + ", created " + currdt.strftime("%Y-%m-%d %H:%M:%S")
@@ -259,10 +555,114 @@ class dShard:
         #print(str(int(edges_and_center[1])))
 
         self.center = int(edges_and_center[1])
+        # other CLIENTs serving the same shard, [(ip, port), ..], and call stats
+        self.replicas = []
+        self.latencies = collections.deque(maxlen=256)
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()
 
     def guid(self):
         return self.guid_internal
 
+    def count(self, stat):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def fetch(self, ip, port, path, data=None):
+        if data is None:
+            response = requests.get("http://" + ip + ":" + str(port) + path, timeout=rpc.timeout)
+        else:
+            response = requests.post("http://" + ip + ":" + str(port) + path, data=data, timeout=rpc.timeout)
+        response.raise_for_status()
+        return response.text
+
+    # GET path, retried on timeouts, connection errors and server errors. hedge: the
+    # call has no side effects, and may go to the replicas too (see hedged()). data:
+    # form fields too long for a request line (i.e. compressed node sets), POSTed.
+    def get(self, path, hedge=False, data=None):
+        error = None
+        for attempt in range(rpc.retries + 1):
+            if attempt:
+                self.count('retries')
+                time.sleep(min(rpc.backoff * 2 ** (attempt - 1), 1.))
+            start = time.time()
+            try:
+                if hedge and self.replicas:
+                    text = self.hedged(path, data)
+                else:
+                    text = self.fetch(self.ip, self.port, path, data)
+            except requests.RequestException as e:
+                self.count('errors')
+                error = e
+                continue
+            with self.stats_lock:
+                self.stats['calls'] += 1
+                self.stats['bytes'] += len(path) + len(text) + (sum(len(v) for v in data.values()) if data else 0)
+                self.latencies.append(time.time() - start)
+            return text
+        self.count('failures')
+        log.warning("remote shard %s at %s:%s unavailable: %s", self.guid_internal, self.ip, self.port, error)
+        raise error
+
+    # The call goes to the shard, and to a replica if the shard has not answered
+    # by the hedge percentile of its latency, or has failed. The first answer wins.
+    def hedged(self, path, data=None):
+        results = queue.Queue()
+        def attempt(ip, port, replica):
+            try:
+                results.put((True, self.fetch(ip, port, path, data), replica))
+            except requests.RequestException as e:
+                results.put((False, e, replica))
+
+        endpoints = collections.deque(self.replicas)
+        threading.Thread(target=attempt, args=(self.ip, self.port, False), daemon=True).start()
+        pending = 1
+        with self.stats_lock:
+            latencies = sorted(self.latencies)
+        # until there are enough samples, the replicas are only there to fail over to
+        delay = percentile(latencies, rpc.hedge_percentile) if 16 <= len(latencies) else rpc.timeout
+        error = None
+        hedge_now = False
+        try:
+            ok, value, replica = results.get(timeout=delay)
+            if ok:
+                return value
+            pending -= 1
+            error = value
+        except queue.Empty:
+            pass
+        while endpoints or pending:
+            if endpoints and (pending == 0 or not hedge_now):
+                ip, port = endpoints.popleft()
+                self.count('hedges')
+                threading.Thread(target=attempt, args=(ip, port, True), daemon=True).start()
+                pending += 1
+                hedge_now = True
+            try:
+                ok, value, replica = results.get(timeout=rpc.timeout)
+            except queue.Empty:
+                raise requests.Timeout("no answer from shard " + str(self.guid_internal) + " or its replicas")
+            pending -= 1
+            if ok:
+                if replica:
+                    self.count('hedge_wins')
+                return value
+            error = value
+        raise error
+
+    # bytes of the requests and replies so far, roughly what went over the wire
+    def wire_bytes(self):
+        with self.stats_lock:
+            return self.stats['bytes']
+
+    def rpc_stats(self):
+        with self.stats_lock:
+            latencies = sorted(self.latencies)
+            stats = dict(self.stats)
+        stats.update(('p' + str(p), round(percentile(latencies, p), 6) if latencies else None) for p in (50, 95, 99))
+        stats['replicas'] = [ip + ":" + str(port) for ip, port in self.replicas]
+        return stats
+
     def when(self):
         return self.when
         
@@ -270,7 +670,8 @@ class dShard:
         # e.g. http://192.168.99.100:5060/nodes
         response = requests.get(
           "http://" + self.ip + ":" + str(self.port) + 
-          "/nodes"
+          "/nodes",
+          timeout=rpc.timeout
         )
         return response.text;
 
@@ -278,20 +679,27 @@ class dShard:
         # e.g. http://192.168.99.100:5060/edges
         response = requests.get(
           "http://" + self.ip + ":" + str(self.port) + 
-          "/edges"
+          "/edges",
+          timeout=rpc.timeout
         )
         return response.text;
 		
     def node_center(self):
         # e.g. http://192.168.99.100:5060/node-center
-        #response = requests.get(
-        #  "http://" + self.ip + ":" + str(self.port) + 
-        #  "/node-center"
-        #)
-        #return response.text;
+        # Only asked for again after the remote graph has changed.
+        if self.center is None:
+            self.center = int(j.loads(myjson(self.get("/node-center?id=0", hedge=True)))[0])
         return self.center, 0.0 #the second number should be the distance which we don't really care about
+
+    # the remote graph has changed: its center and far nodes may have too
+    def changed(self):
+        self.center = None
+        self.far_nodes = []
 		
-    def most_distant_internal_nodes(self, how_many):
+    # also takes num=, like Shard.most_distant_internal_nodes()
+    def most_distant_internal_nodes(self, how_many=0, num=0):
+        if 0 < num:
+            how_many = num
         try:
             if (len(self.far_nodes) == how_many):
                 return self.far_nodes
@@ -310,7 +718,8 @@ class dShard:
         # i.e. http://192.168.99.100:5060/most-distant-internal-nodes?id=0&how-many=16
         response = requests.get(
           "http://" + self.ip + ":" + str(self.port) + 
-          "/most-distant-internal-nodes?id=0&how-many=" + str(how_many)
+          "/most-distant-internal-nodes?id=0&how-many=" + str(how_many),
+          timeout=rpc.timeout
         )
 		
         responsetext = response.text
@@ -345,17 +754,98 @@ class dShard:
         # i.e. http://192.168.99.100:5060/add-edge-external?info=197,30,0.5,0.5,1,10,198,31,0.6,0.6,2,11,199,32,0.7,0.7,3,12
         response = requests.get(
           "http://" + self.ip + ":" + str(self.port) + 
-          "/add-edge-external?info=" + str(snodes_and_pos)
+          "/add-edge-external?info=" + str(snodes_and_pos),
+          timeout=rpc.timeout
+        )
+        self.changed()
+        return response.text;
+
+    #input: [(ni,shard,ne), (), ..]
+    def remove_edge_external(self, cuts):
+        scuts = str(cuts).replace('[', '').replace(']', '').replace('(', '').replace(')', '').replace(' ','')
+
+        # i.e. http://192.168.99.100:5060/remove-edge-external?info=197,1,30,198,2,31
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/remove-edge-external?info=" + scuts,
+          timeout=rpc.timeout
+        )
+        self.changed()
+        return response.text;
+
+    def external_edges(self):
+        # i.e. http://192.168.99.100:5060/external-edges
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/external-edges",
+          timeout=rpc.timeout
+        )
+        return [tuple(cut) for cut in j.loads(response.text)]
+
+    #input: [(x,y), (), ..]
+    def add_nodes(self, positions):
+        spositions = str(positions).replace('[', '').replace(']', '').replace('(', '').replace(')', '').replace(' ','')
+
+        # i.e. http://192.168.99.100:5060/add-nodes?info=0.5,0.5,0.6,0.6
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/add-nodes?info=" + spositions,
+          timeout=rpc.timeout
+        )
+        self.changed()
+        return j.loads(response.text)
+
+    def remove_nodes(self, node_ids):
+        snodes = str(list(node_ids)).replace('[', '').replace(']', '').replace(' ','')
+
+        # i.e. http://192.168.99.100:5060/remove-nodes?nodes=6,9,131
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/remove-nodes?nodes=" + snodes,
+          timeout=rpc.timeout
+        )
+        self.changed()
+        return [tuple(cut) for cut in j.loads(response.text)]
+
+    #input: [(u,v), (), ..]
+    def add_edges(self, edges):
+        sedges = str(edges).replace('[', '').replace(']', '').replace('(', '').replace(')', '').replace(' ','')
+
+        # i.e. http://192.168.99.100:5060/add-edges?info=6,9,9,131
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/add-edges?info=" + sedges,
+          timeout=rpc.timeout
+        )
+        self.changed()
+        return response.text;
+
+    #input: [(u,v), (), ..]
+    def remove_edges(self, edges):
+        sedges = str(edges).replace('[', '').replace(']', '').replace('(', '').replace(')', '').replace(' ','')
+
+        # i.e. http://192.168.99.100:5060/remove-edges?info=6,9,9,131
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/remove-edges?info=" + sedges,
+          timeout=rpc.timeout
         )
+        self.changed()
         return response.text;
 
     # Note that nodes is a list without leading and trailing parenses.	
+    # NodeSets go and come back compressed (see NodeSet.to_wire()).
     def bfs_trees_with_remote_nodes(self, nodes):
 	
         #@@@@@@
         # We are going to assume that the remote shard has id 0!
         shard_id = 0
 
+        if isinstance(nodes, NodeSet):
+            # i.e. curl -d sources=0.bQAI 'http://192.168.99.100:5060/bfs-trees-with-remote-nodes?id=0&bitmap=1'
+            ins, exs = j.loads(self.get("/bfs-trees-with-remote-nodes?id=" + str(shard_id) + "&bitmap=1", hedge=True, data={'sources': nodes.to_wire()}))
+            return list((NodeSet.from_wire(ins), [(k, NodeSet.from_wire(v)) for k, v in exs]))
+
         #@@@@@@
 		# since this MASTER-SERVER call has the same surface API as a SERVER call, I
         # need to unwrap the list of nodes so I can pass them as a query parameter!
@@ -364,16 +854,152 @@ class dShard:
         # i.e. http://192.168.99.100:5060/bfs-trees-with-remote-nodes?id=0&sources=6,9,131,44,79
         #print("Calling..." + "http://" + self.ip + ":" + str(self.port) + 
         #  "/bfs-trees-with-remote-nodes?id=0&sources=" + snodes)
-        response = requests.get(
-          "http://" + self.ip + ":" + str(self.port) + 
-          "/bfs-trees-with-remote-nodes?id=" + str(shard_id) + "&sources=" + snodes
-        )
-        responsetext = response.text
+        responsetext = self.get("/bfs-trees-with-remote-nodes?id=" + str(shard_id) + "&sources=" + snodes, hedge=True)
         #print(responsetext)
         responsetext = myjson(responsetext)
         #print(responsetext)
         return j.loads(responsetext);
+
+    # the remote shard's BfsCache stats, resized to capacity and emptied if asked to
+    def bfs_cache_status(self, capacity=None, clear=False):
+        # i.e. http://192.168.99.100:5060/bfs-cache?capacity=256&clear=0
+        return j.loads(self.get("/bfs-cache?clear=" + str(int(clear)) + ("" if capacity is None else "&capacity=" + str(capacity))))['shards'][0]
+
+    # sources: [(mask, nodes), ..], see Shard.bfs_trees_with_remote_nodes_multi()
+    def bfs_trees_with_remote_nodes_multi(self, sources):
+        # i.e. curl -d sources=3:0.bQAI,4:0.aFAA 'http://192.168.99.100:5060/bfs-trees-with-remote-nodes-multi?id=0'
+        ins, exs = j.loads(self.get("/bfs-trees-with-remote-nodes-multi?id=0", hedge=True, data={'sources': mask_groups_to_wire(sources)}))
+        return list((mask_groups_from_wire(ins), [(k, mask_groups_from_wire(v)) for k, v in exs]))
 		
+    # Note that nodes is a list without leading and trailing parenses.	
+    def reach_trees_with_remote_nodes(self, nodes):
+        snodes = str(list(nodes)).replace('[', '').replace(']', '').replace(' ','')
+
+        # i.e. http://192.168.99.100:5060/bfs-reach-with-remote-nodes?id=0&sources=6,9,131,44,79
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/bfs-reach-with-remote-nodes?id=0&sources=" + snodes,
+          timeout=rpc.timeout
+        )
+        return j.loads(response.text);
+
+    # Note that nodes is a list without leading and trailing parenses, or a NodeSet.
+    # The nodes visited stay in session sid: a retry carries the same request id,
+    # rid if given (see reply_once()).
+    def bfs_count_with_remote_nodes(self, sid, nodes, rid=None):
+        if rid is None:
+            rid = session_id()
+        if isinstance(nodes, NodeSet):
+            # i.e. curl -d sources=0.bQAI 'http://192.168.99.100:5060/bfs-count-with-remote-nodes?id=0&sid=5f3a&rid=9c1e&bitmap=1'
+            count, exs, anchors = j.loads(self.get("/bfs-count-with-remote-nodes?id=0&sid=" + sid + "&rid=" + rid + "&bitmap=1", data={'sources': nodes.to_wire()}))
+            return list((count, [(k, NodeSet.from_wire(v)) for k, v in exs], NodeSet.from_wire(anchors)))
+
+        snodes = str(list(nodes)).replace('[', '').replace(']', '').replace(' ','')
+
+        # i.e. http://192.168.99.100:5060/bfs-count-with-remote-nodes?id=0&sid=5f3a&rid=9c1e&sources=6,9,131,44,79
+        return j.loads(self.get("/bfs-count-with-remote-nodes?id=0&sid=" + sid + "&rid=" + rid + "&sources=" + snodes));
+
+    def summary(self):
+        # i.e. http://192.168.99.100:5060/summary?id=0
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/summary?id=0",
+          timeout=rpc.timeout
+        )
+        return j.loads(response.text);
+
+    #input: sid, 'F' or 'B', [(node,dist,oshard,onode), (), ..], limit
+    def expand(self, sid, direction, entries, limit):
+        sentries = str(entries).replace('[', '').replace(']', '').replace('(', '').replace(')', '').replace(' ','')
+
+        # i.e. http://192.168.99.100:5060/session-expand?id=0&sid=5f3a&rid=9c1e&direction=F&limit=inf&info=6,0,-1,-1
+        return j.loads(self.get("/session-expand?id=0&sid=" + sid + "&rid=" + session_id() + "&direction=" + direction + "&limit=" + str(limit) + "&info=" + sentries));
+
+    def session_path(self, sid, direction, node):
+        # i.e. http://192.168.99.100:5060/session-path?id=0&sid=5f3a&direction=F&node=6
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/session-path?id=0&sid=" + sid + "&direction=" + direction + "&node=" + str(node),
+          timeout=rpc.timeout
+        )
+        return j.loads(response.text);
+
+    def end_session(self, sid):
+        # i.e. http://192.168.99.100:5060/session-end?id=0&sid=5f3a
+        return [tuple(level) for level in j.loads(self.get("/session-end?id=0&sid=" + sid))];
+
+    # Opens a connection and wakes the shard's worker up, ahead of a call that
+    # is likely to come (see speculative_dbfs())
+    def warm_up(self):
+        # i.e. http://192.168.99.100:5060/testHealth
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/testHealth",
+          timeout=rpc.timeout
+        )
+        return response.text
+
+    # the shard's own index in the fleet, and the fleet's shards as ip:port
+    def set_peers(self, me, peers):
+        # i.e. http://192.168.99.100:5060/set-peers?me=0&peers=192.168.99.100:5060,192.168.99.100:5061
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/set-peers?me=" + str(me) + "&peers=" + ",".join(peers),
+          timeout=rpc.timeout
+        )
+        return response.text
+
+    # hands a frontier with credit to the shard, for peer-to-peer DBFS
+    def p2p_frontier(self, sid, nodes, credit, master):
+        # i.e. curl -d sources=0.bQAI 'http://192.168.99.100:5060/p2p-frontier?sid=5f3a&credit=1&master=192.168.99.1:5000'
+        response = requests.post(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/p2p-frontier?sid=" + sid + "&credit=" + str(credit) + "&master=" + master,
+          data={'sources': NodeSet(nodes).to_wire()},
+          timeout=rpc.timeout
+        )
+        return response.text
+
+    #input: version, [(cid,gid), (), ..]
+    def label_components(self, version, labels):
+        slabels = str(labels).replace('[', '').replace(']', '').replace('(', '').replace(')', '').replace(' ','')
+
+        # i.e. http://192.168.99.100:5060/label-components?id=0&version=3&info=0,0,1,4294967296
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/label-components?id=0&version=" + str(version) + "&info=" + slabels,
+          timeout=rpc.timeout
+        )
+        return j.loads(response.text);
+
+    def component_label(self, node):
+        # i.e. http://192.168.99.100:5060/component-label?id=0&node=6
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/component-label?id=0&node=" + str(node),
+          timeout=rpc.timeout
+        )
+        return j.loads(response.text);
+
+    # Inboxes can get big, so they are POSTed as JSON
+    def superstep(self, sid, algorithm, step, inbox, params):
+        # i.e. curl -X POST -H 'Content-Type: application/json' -d '{"sid":"5f3a","algorithm":"pagerank","step":0,"inbox":[],"params":{"shard":0,"n":800}}' http://192.168.99.100:5060/superstep?id=0
+        response = requests.post(
+          "http://" + self.ip + ":" + str(self.port) + "/superstep?id=0",
+          json = {'sid': sid, 'algorithm': algorithm, 'step': step, 'inbox': inbox, 'params': params},
+          timeout=rpc.timeout
+        )
+        return j.loads(response.text);
+
+    def superstep_result(self, sid, algorithm, top):
+        # i.e. http://192.168.99.100:5060/superstep-result?id=0&sid=5f3a&algorithm=pagerank&top=5
+        response = requests.get(
+          "http://" + self.ip + ":" + str(self.port) + 
+          "/superstep-result?id=0&sid=" + sid + "&algorithm=" + algorithm + "&top=" + str(top),
+          timeout=rpc.timeout
+        )
+        return j.loads(response.text);
+
     def bfs_trees_with_remote_nodes_from_center_node(self):
         #@@@@@@
         # We are going to assume that the remote shard has id 0!
@@ -382,7 +1008,8 @@ class dShard:
         # i.e. http://192.168.99.100:5060/bfs-trees-with-remote-nodes-from-center-node?id=0
         response = requests.get(
           "http://" + self.ip + ":" + str(self.port) + 
-          "/bfs-trees-with-remote-nodes-from-center-node?id=" + str(shard_id)
+          "/bfs-trees-with-remote-nodes-from-center-node?id=" + str(shard_id),
+          timeout=rpc.timeout
         )
         return j.loads(myjson(response.text));
 
@@ -411,10 +1038,10 @@ class dNeoShard:
         #sources = j.loads(myjson(nodes))
 		
         if self.verbose:
-            print("neo bfs @ ", self.ip, self.port, nodes)		
+            log.debug("neo bfs ip=%s port=%s sources=%s", self.ip, self.port, nodes)
         r = bfs_trees_with_remote_nodes_neo_internal(self.ip, self.port, nodes, self.verbose)
         if self.verbose:
-            print(r)
+            log.debug("neo bfs result=%s", r)
         return j.loads(r)
 
 
@@ -441,13 +1068,107 @@ class dJanusShard:
         #sources = str(nodes).replace('{', '').replace('}', '').replace(' ','')
 
         if self.verbose:
-            print("janus bfs @ ", self.ip, self.port, nodes)		
+            log.debug("janus bfs ip=%s port=%s sources=%s", self.ip, self.port, nodes)
         r = bfs_trees_with_remote_nodes_janus_internal(self.ip, self.port, nodes, self.verbose)
         if self.verbose:
-            print(r)
+            log.debug("janus bfs result=%s", r)
         return j.loads(r)
 
 
+#####################################################
+### BFS result cache
+###
+### A shard answers the same sources the same way 
+### until it changes: benchmark repetitions, and DBFS
+### runs from other begin shards that converge, ask 
+### for the same BFS again. Results are kept per shard
+### in a bounded LRU, keyed by the shard version and a
+### hash of the sources (compressed, see NodeSet, so 
+### the same set hashes the same in any order). As the
+### BFS stops at proxies, its result only depends on 
+### the components of the internal sources (see 
+### Shard.index_components()) and on the proxies among
+### the sources: other sources in the same components
+### reuse the result too (subsumption). Results are 
+### shared between callers, which never change them.
+#####################################################
+class BfsCache:
+    def __init__(self, capacity=int(os.environ.get('NXG_BFS_CACHE_ENTRIES', 256))):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.version = None
+        self.entries = collections.OrderedDict()   # key -> (cover, result), least recent first
+        self.covers = dict()                       # cover -> key
+        self.stats = collections.Counter()
+
+    # the shard has changed: nothing cached is valid anymore
+    def clear(self, version=None):
+        if self.entries:
+            self.stats['invalidations'] += 1
+        self.version = version
+        self.entries.clear()
+        self.covers.clear()
+
+    # the result for the sources hashed to key, None if not cached
+    def get(self, version, key):
+        with self.lock:
+            if version != self.version:
+                self.clear(version)
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.stats['hits'] += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    # the result for other sources with the same cover, None if not cached
+    def subsumed(self, version, key, cover):
+        with self.lock:
+            if version != self.version:
+                self.clear(version)
+            covering = self.covers.get(cover)
+            if covering is not None:
+                self.stats['subsumed'] += 1
+                self.entries.move_to_end(covering)
+                result = self.entries[covering][1]
+                self.add(key, cover, result)
+                return result
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, version, key, cover, result):
+        with self.lock:
+            if version == self.version and 0 < self.capacity:
+                self.add(key, cover, result)
+
+    # call while holding the lock
+    def add(self, key, cover, result):
+        self.entries[key] = (cover, result)
+        self.covers[cover] = key
+        self.evict()
+
+    def evict(self):
+        while self.capacity < len(self.entries):
+            key, (cover, result) = self.entries.popitem(last=False)
+            if self.covers.get(cover) == key:
+                del self.covers[cover]
+            self.stats['evictions'] += 1
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), capacity=self.capacity, version=self.version)
+
+    def empty(self):
+        with self.lock:
+            self.clear(self.version)
+
+    # capacity 0 turns the cache off
+    def resize(self, capacity):
+        with self.lock:
+            self.capacity = capacity
+            self.evict()
+
+
 ################################################
 ### Shard class, local.
 ### We are a shard CLIENT or local shards SERVER
@@ -455,6 +1176,8 @@ class dJanusShard:
 class Shard:
     def __init__(self, guid):
         self.guid_internal = guid
+        self.bfs_cache = BfsCache()
+        self.halos = dict()     # k -> (halo, border), see set_halo()
 
     def grow_graph(self, guid, nodes, p):
         self.guid = guid
@@ -468,6 +1191,17 @@ class Shard:
         for edge_id in self.g.edges():
             self.g.edges[edge_id]['remote'] = None
 
+        # node ids are never reused, even after nodes get removed
+        self.next_node_id = nodes
+        self.version = 0
+        self.center = None
+        self.distances = None
+        self.index_boundary()
+        self.index_components()
+        self.sessions = dict()
+        self.component_labels = dict()
+        self.labels_version = None
+
         # returns the number of edges created and the node center					
         return self.g.number_of_edges(), self.node_center()[0]
 
@@ -527,37 +1261,459 @@ class Shard:
     def edges_with_attributes(self):
         return [(edge_id, self.g.edges[edge_id]) for edge_id in self.g.edges]
 		
+    # Every change to the graph goes through here: bumps the version and
+    # drops whatever was cached off the previous version.
+    def changed(self):
+        self.version += 1
+        self.center = None
+        self.distances = None
+
+    def new_node_id(self):
+        node_id = self.next_node_id
+        self.next_node_id += 1
+        return node_id
+
+    # There is a single local copy (a proxy node) per remote node, whatever the
+    # number of external edges to it: proxies maps (shard, ne) to the proxy, and 
+    # the boundary table maps each proxy back to its remote owner (shard, ne, d).
+    # The 'remote' node attribute is kept as well, for the graph engine clones.
+    def index_boundary(self):
+        self.proxies = dict()
+        self.boundary = dict()
+        for node_id, label in self.g.nodes(data='remote'):
+            if label is not None:
+                self.proxies[(label[0], label[1])] = node_id
+                self.boundary[node_id] = tuple(label)
+
+    def remove_proxy(self, proxy):
+        shard, ne, d = self.boundary.pop(proxy)
+        del self.proxies[(shard, ne)]
+        # (the component of ni may be waiting to be re-split)
+        for ni in self.g.adj[proxy]:
+            proxies = self.component_boundary.get(self.component_of[ni])
+            if proxies is not None:
+                proxies.discard(proxy)
+        self.g.remove_node(proxy)
+
     #input: [(ni,ne,x,y,shard,d), (), ..]
     def add_edge_external(self, nodes_and_pos):
         #print('-- shard ' + str(self.guid) + ': number of nodes ' + str(self.g.number_of_nodes()))
-        num_new_nodes = len(nodes_and_pos)
-        new_node_index = self.g.number_of_nodes()
-        #print(new_node_index)
+        num_new_nodes = 0
+        num_reused = 0
         for _ in nodes_and_pos:
             (ni, ne, x, y, shard, d) = _
+            # the internal node may have been removed in the meantime
+            if ni not in self.g:
+                continue
             #print(ni, ne, x, y, shard, d)
-            #print('-- shard ' + str(self.guid) + ': adding new node ' + str(new_node_index))
-            self.g.add_node(new_node_index)
-            self.g.nodes[new_node_index]['remote'] = shard, ne, d
-            self.g.nodes[new_node_index]['pos'] = x, y
-            self.g.add_edge(ni, new_node_index) 
+            proxy = self.proxies.get((shard, ne))
+            if proxy is None:
+                proxy = self.new_node_id()
+                #print('-- shard ' + str(self.guid) + ': adding new node ' + str(proxy))
+                self.g.add_node(proxy)
+                self.g.nodes[proxy]['remote'] = shard, ne, d
+                self.g.nodes[proxy]['pos'] = x, y
+                self.proxies[(shard, ne)] = proxy
+                self.boundary[proxy] = shard, ne, d
+                num_new_nodes += 1
+            else:
+                num_reused += 1
+            self.g.add_edge(ni, proxy) 
+            self.component_boundary[self.component_of[ni]].add(proxy)
             #2do: add edge 'remote' attribute
-            new_node_index +=1
-        return "added " + str(num_new_nodes) + " new nodes representing copies of nodes on other shards, for a total of " + str(new_node_index) + " nodes."
+        self.changed()
+        return "added " + str(num_new_nodes) + " new nodes representing copies of nodes on other shards (reused " + str(num_reused) + "), for a total of " + str(self.g.number_of_nodes()) + " nodes."
+
+    # removes the external edges (ni, shard, ne) between internal node ni and the copy
+    # of node ne on shard shard. Copies left without any edge are removed as well.
+    #input: [(ni,shard,ne), (), ..]
+    def remove_edge_external(self, cuts):
+        num_removed = 0
+        for ni, shard, ne in cuts:
+            proxy = self.proxies.get((shard, ne))
+            if proxy is not None and self.g.has_edge(ni, proxy):
+                self.g.remove_edge(ni, proxy)
+                cid = self.component_of[ni]
+                if not any(cid == self.component_of[n] for n in self.g.adj[proxy]):
+                    self.component_boundary[cid].discard(proxy)
+                if 0 == self.g.degree(proxy):
+                    self.remove_proxy(proxy)
+                num_removed += 1
+        self.changed()
+        return "removed " + str(num_removed) + " external edges, for a total of " + str(self.g.number_of_nodes()) + " nodes."
+
+    # the external edges of the shard, as (ni, shard, ne)
+    def external_edges(self):
+        cuts = []
+        for proxy, (shard, ne, d) in self.boundary.items():
+            for ni in self.g.adj[proxy]:
+                cuts.append((ni, shard, ne))
+        return cuts
+
+    # new internal nodes, returns their ids
+    #input: [(x,y), (), ..]
+    def add_nodes(self, positions):
+        node_ids = []
+        for x, y in positions:
+            node_id = self.new_node_id()
+            self.g.add_node(node_id, pos=(x, y), remote=None)
+            self.origpos[node_id] = x, y
+            node_ids.append(node_id)
+            self.index_component({node_id})
+        self.numnodes += len(node_ids)
+        self.changed()
+        return node_ids
+
+    # Removes internal nodes (and copies of remote nodes, if asked to). Returns the 
+    # external edges (ni, shard, ne) that went away with them, as the shards on 
+    # the other side of these edges still hold the mirror edges.
+    def remove_nodes(self, node_ids):
+        cuts = []
+        split = set()
+        for node_id in node_ids:
+            if node_id not in self.g:
+                continue
+            label = self.boundary.get(node_id)
+            if label is not None:
+                for ni in self.g.adj[node_id]:
+                    cuts.append((ni, label[0], label[1]))
+                self.remove_proxy(node_id)
+                continue
+            for n in list(self.g.adj[node_id]):
+                label = self.boundary.get(n)
+                if label is not None:
+                    cuts.append((node_id, label[0], label[1]))
+                    if 1 == self.g.degree(n):
+                        self.remove_proxy(n)
+            self.origpos.pop(node_id, None)
+            self.numnodes -= 1
+            self.g.remove_node(node_id)
+            cid = self.component_of.pop(node_id)
+            if cid in self.component_nodes:
+                split.update(self.unindex_component(cid))
+            split.discard(node_id)
+        if split:
+            self.reindex_components(split)
+        self.changed()
+        return cuts
+
+    # internal edges only, between existing internal nodes
+    #input: [(u,v), (), ..]
+    def add_edges(self, edges):
+        num_added = 0
+        for u, v in edges:
+            if u in self.g and v in self.g and u not in self.boundary and v not in self.boundary and not self.g.has_edge(u, v):
+                self.g.add_edge(u, v, remote=None)
+                num_added += 1
+                self.merge_components(self.component_of[u], self.component_of[v])
+        self.changed()
+        return "added " + str(num_added) + " edges, for a total of " + str(self.g.number_of_edges()) + " edges."
+
+    #input: [(u,v), (), ..]
+    def remove_edges(self, edges):
+        num_removed = 0
+        split = set()
+        for u, v in edges:
+            if u not in self.boundary and v not in self.boundary and self.g.has_edge(u, v):
+                self.g.remove_edge(u, v)
+                num_removed += 1
+                if self.component_of[u] in self.component_nodes:
+                    split.update(self.unindex_component(self.component_of[u]))
+        if split:
+            self.reindex_components(split)
+        self.changed()
+        return "removed " + str(num_removed) + " edges, for a total of " + str(self.g.number_of_edges()) + " edges."
     
     # returns all nodes of the graph that are copies of nodes that live on other shards
     # In other words, these "remote" nodes don't actually belong to this graph. They
-    # are only used to create external edges
+    # are only used to create external edges. O(boundary), off the boundary table.
     def external_nodes(self):
-        exnodes = []
-        for node_id in self.g.nodes():
-            label = self.g.nodes[node_id]['remote']
-            if label is not None:
-                exnodes.append((node_id, label))
-        return exnodes
+        return list(self.boundary.items())
     
-    # used to find the center of a geographic graph
+    # Reachability index: the connected components of the internal graph (the
+    # BFS stops at proxies), each with its number of internal nodes and the
+    # proxies on its boundary. Built with the shard, then kept up to date by
+    # the changes above: added edges merge components, removed edges and nodes
+    # only re-split the components they were in.
+    def index_components(self):
+        self.component_of = dict()
+        self.component_nodes = dict()
+        self.component_boundary = dict()
+        self.components = itertools.count()
+        self.reindex_components(set(n for n in self.g if n not in self.boundary))
+
+    def index_component(self, nodes):
+        cid = next(self.components)
+        proxies = set()
+        for n in nodes:
+            self.component_of[n] = cid
+            for t in self.g.adj[n]:
+                if t in self.boundary:
+                    proxies.add(t)
+        self.component_nodes[cid] = nodes
+        self.component_boundary[cid] = proxies
+        return cid
+
+    # drops a component from the index, returns its nodes
+    def unindex_component(self, cid):
+        del self.component_boundary[cid]
+        return self.component_nodes.pop(cid)
+
+    # splits nodes (no longer indexed) into components, and indexes them
+    def reindex_components(self, nodes):
+        adj = self.g.adj
+        while nodes:
+            n = nodes.pop()
+            component = {n}
+            frontier = [n]
+            while frontier:
+                for t in adj[frontier.pop()]:
+                    if t not in component and t not in self.boundary:
+                        component.add(t)
+                        frontier.append(t)
+            nodes -= component
+            self.index_component(component)
+
+    def merge_components(self, cu, cv):
+        if cu == cv:
+            return
+        if len(self.component_nodes[cu]) < len(self.component_nodes[cv]):
+            cu, cv = cv, cu
+        self.component_boundary[cu].update(self.component_boundary[cv])
+        nodes = self.unindex_component(cv)
+        for n in nodes:
+            self.component_of[n] = cu
+        self.component_nodes[cu].update(nodes)
+
+    # Same as bfs_trees_with_remote_nodes(), but off the reachability index, 
+    # without traversing: O(sources + boundary). Returns the number of internal
+    # nodes reached, the components reached with their number of internal nodes,
+    # and the remote nodes to visit next, grouped by shard.
+    def reach_trees_with_remote_nodes(self, sources):
+        cids = set()
+        for n in sources:
+            cid = self.component_of.get(n)
+            if cid is not None:
+                cids.add(cid)
+        extnodes = dict()
+        for cid in cids:
+            for proxy in self.component_boundary[cid]:
+                shard, extnode, distance = self.boundary[proxy]
+                if shard not in extnodes:
+                    extnodes[shard] = {extnode}
+                else:
+                    extnodes[shard].add(extnode)
+        counts = [(cid, len(self.component_nodes[cid])) for cid in cids]
+        return list((sum(count for cid, count in counts), counts, [(k,list(v)) for k,v in extnodes.items()]))
+
+    # What a coordinator needs to know about this shard to plan a DBFS without
+    # calling it: its components ([cid, number of internal nodes, a node of the
+    # component]), which component each node with external edges is in (the 
+    # anchors other shards' proxies point to), the remote nodes each component
+    # borders on ([cid, shard, ne]), and the center node with its component.
+    def summary(self):
+        anchors = dict()
+        boundary = []
+        for cid, proxies in self.component_boundary.items():
+            for proxy in proxies:
+                shard, ne, d = self.boundary[proxy]
+                boundary.append((cid, shard, ne))
+                for ni in self.g.adj[proxy]:
+                    anchors[ni] = self.component_of[ni]
+        center = self.node_center()[0]
+        return {
+            'components': [(cid, len(nodes), next(iter(nodes))) for cid, nodes in self.component_nodes.items()],
+            'anchors': list(anchors.items()),
+            'boundary': boundary,
+            'center': (center, self.component_of.get(center)),
+            'version': self.version
+        }
+
+    # Global component ids, [(cid, gid), ..], as labelled by the coordinator off 
+    # the summary of shard version version. Component ids change with the shard,
+    # so labels for another version are refused, and labels go stale as soon as
+    # the shard changes.
+    def label_components(self, version, labels):
+        if version != self.version:
+            return False
+        self.component_labels = dict(labels)
+        self.labels_version = version
+        return True
+
+    # the global component id of node, None if unknown or stale
+    def component_label(self, node):
+        if self.labels_version != self.version or node not in self.component_of:
+            return None
+        return self.component_labels.get(self.component_of[node])
+
+    # Targeted queries (shortest path, k-hop) keep per-query state on the shard,
+    # in a session: the forward ('F') and backward ('B') distance labels of the
+    # nodes reached so far, as node -> (distance, parent). The parent is the 
+    # previous node in the shard, or (shard, node) for a node entered through
+    # an external edge, or None for the query's own source. The coordinator 
+    # ends the session when the query is done.
+    #
+    # Expands a session in one direction, from entries [(node, distance, origin 
+    # shard, origin node), ..] (origin -1, -1 for the source), up to distance limit.
+    # Labels only ever improve, so a shard can be expanded again with better 
+    # entries. Returns the best meeting of both directions among the nodes 
+    # labelled by this expansion ([distance, node], or None) and the remote
+    # nodes reached ([shard, ne, distance, ni, d], with ni the node on this 
+    # shard and d the length of the external edge, from the remote label).
+    def expand(self, sid, direction, entries, limit):
+        session = self.sessions.setdefault(sid, dict())
+        labels = session.setdefault(direction, dict())
+        other = session.setdefault('B' if 'F' == direction else 'F', dict())
+        adj = self.g.adj
+        boundary = self.boundary
+
+        seeds = []
+        for node, dist, oshard, onode in sorted(entries, key = lambda e: e[1]):
+            if node in adj and node not in boundary and dist <= limit and (node not in labels or dist < labels[node][0]):
+                labels[node] = dist, (None if oshard < 0 else (oshard, onode))
+                seeds.append((node, dist))
+
+        # BFS with sources starting at different distances: seeds join the
+        # queue as soon as the queue has caught up with their distance
+        frontier = collections.deque()
+        seeds.reverse()
+        labelled = set()
+        reached = dict()
+        while frontier or seeds:
+            if seeds and (not frontier or seeds[-1][1] <= frontier[0][1]):
+                n, d = seeds.pop()
+            else:
+                n, d = frontier.popleft()
+            if labels[n][0] != d:
+                continue
+            labelled.add(n)
+            if d >= limit:
+                continue
+            for t in adj[n]:
+                label = boundary.get(t)
+                if label is not None:
+                    shard, ne, w = label
+                    if (shard, ne) not in reached or d + w < reached[(shard, ne)][2]:
+                        reached[(shard, ne)] = (shard, ne, d + w, n, w)
+                elif t not in labels or d + 1 < labels[t][0]:
+                    labels[t] = d + 1, n
+                    frontier.append((t, d + 1))
+
+        meet = None
+        for n in labelled:
+            if n in other and (meet is None or labels[n][0] + other[n][0] < meet[0]):
+                meet = (labels[n][0] + other[n][0], n)
+        return list((meet, list(reached.values())))
+
+    # The path from node back to where the session entered the shard, and
+    # the (shard, node) it came from, None if it started on this shard.
+    def session_path(self, sid, direction, node):
+        labels = self.sessions[sid][direction]
+        path = [node]
+        parent = labels[node][1]
+        while parent is not None and not isinstance(parent, tuple):
+            path.append(parent)
+            parent = labels[parent][1]
+        return list((path, parent))
+
+    # Same BFS as bfs_trees_with_remote_nodes(), in count-only mode: the visited
+    # nodes stay on the shard, in session sid, so the response is the size of
+    # the boundary and not of the shard. Returns the number of internal nodes
+    # newly visited, the remote nodes reached, grouped by shard, and the anchors
+    # (internal nodes with external edges) newly visited: these are the only 
+    # nodes other shards ask for, so the coordinator dedupes on them. rid: the
+    # request id, a request asked again gets the same reply (see reply_once()).
+    def bfs_count_with_remote_nodes(self, sid, sources, rid=None):
+        if rid is not None:
+            return reply_once(self, sid, rid, lambda: self.bfs_count_with_remote_nodes(sid, sources))
+        visited = self.sessions.setdefault(sid, dict()).setdefault('visited', set())
+        adj = self.g.adj
+        boundary = self.boundary
+        frontier = collections.deque(set(n for n in sources if n in adj and n not in boundary and n not in visited))
+        visited.update(frontier)
+        count = 0
+        anchors = []
+        extnodes = dict()
+        while frontier:
+            n = frontier.popleft()
+            count += 1
+            anchor = False
+            for t in adj[n]:
+                label = boundary.get(t)
+                if label is not None:  #shard, ne, d
+                    anchor = True
+                    extnodes.setdefault(label[0], set()).add(label[1])
+                elif t not in visited:
+                    visited.add(t)
+                    frontier.append(t)
+            if anchor:
+                anchors.append(n)
+        return list((count, [(k,list(v)) for k,v in extnodes.items()], anchors))
+
+    # Drops the session, returns the number of nodes it reached forward
+    # per distance from the source, as [(distance, count), ..]
+    def end_session(self, sid):
+        session = self.sessions.pop(sid, None)
+        levels = collections.Counter()
+        if session is not None:
+            for dist, parent in session.get('F', dict()).values():
+                levels[dist] += 1
+        return sorted(levels.items())
+
+    # One superstep of vertex program algorithm (see vertex_programs) in session
+    # sid: every internal node takes in its combined messages, from this shard's
+    # nodes last superstep and from other shards (inbox, [(node, message), ..]),
+    # updates its value and messages its neighbors. Messages to nodes on this 
+    # shard are kept for the next superstep, messages to remote nodes are combined
+    # per remote node and returned grouped by shard, to be delivered by the
+    # coordinator. Returns [[(shard, [(ne, message), ..]), ..], aggregate, number 
+    # of messages kept on the shard].
+    def superstep(self, sid, algorithm, step, inbox, params):
+        program = vertex_programs[algorithm](params)
+        session = self.sessions.setdefault(sid, dict())
+        values = session.setdefault('values', dict())
+        incoming = session.pop('local', dict())
+        for node, message in inbox:
+            incoming[node] = message if node not in incoming else program.combine(incoming[node], message)
+
+        adj = self.g.adj
+        boundary = self.boundary
+        local = dict()
+        remote = dict()
+        aggregate = program.zero()
+        for n in adj:
+            if n in boundary:
+                continue
+            degree = len(adj[n])
+            # (nodes added since the first superstep start from scratch)
+            old = values.get(n)
+            new = program.initial(params['shard'], n) if old is None else program.update(old, incoming.get(n))
+            values[n] = new
+            aggregate = program.aggregate(aggregate, old, new, degree)
+            message = program.message(old, new, degree)
+            if message is None:
+                continue
+            for t in adj[n]:
+                label = boundary.get(t)
+                outbox, key = (local, t) if label is None else (remote, (label[0], label[1]))
+                outbox[key] = message if key not in outbox else program.combine(outbox[key], message)
+        session['local'] = local
+
+        grouped = dict()
+        for (shard, ne), message in remote.items():
+            grouped.setdefault(shard, []).append((ne, message))
+        return list((list(grouped.items()), aggregate, len(local)))
+
+    # The vertex program's result on this shard's values (see vertex_programs)
+    def superstep_result(self, sid, algorithm, top):
+        values = self.sessions.get(sid, dict()).get('values', dict())
+        adj = self.g.adj
+        return vertex_programs[algorithm](dict()).result(dict((n, v) for n, v in values.items() if n in adj), top)
+
+    # used to find the center of a geographic graph. Cached until the graph changes.
     def node_center(self):
+        if self.center is not None:
+            return self.center
         # find node near center (0.5,0.5)
         dmin=1
         ncenter=0
@@ -568,7 +1724,8 @@ class Shard:
             if d<dmin:
                 ncenter=n
                 dmin=d
-        return ncenter, dmin
+        self.center = ncenter, dmin
+        return self.center
     
     # used to compute distance from graph center
     def nodes_distance_from_center(self):
@@ -583,18 +1740,20 @@ class Shard:
     # used to locate the most far-away-from-center nodes in the graph.
     # These can then be connected to remote nodes on other graph shards
     def most_distant_internal_nodes(self, p=1, num=0):
-        distances = []
-        for n in self.origpos:
-            x,y=self.origpos[n]
-            d=(x-0.5)**2+(y-0.5)**2
-            distances.append((n,round(d,2)))
+        if self.distances is None:
+            distances = []
+            for n in self.origpos:
+                x,y=self.origpos[n]
+                d=(x-0.5)**2+(y-0.5)**2
+                distances.append((n,round(d,2)))
+            self.distances = sorted(distances, key = lambda x: x[1])
         how_many = 0
         if p > 1: p = 1
         if 0 < num: 
             how_many = num
         else:
             how_many = int(self.numnodes * p)
-        return(sorted(distances, key = lambda x: x[1])[-how_many:])
+        return(self.distances[-how_many:])
     
     def bfs_edges(self, source):
         return list(nx.bfs_edges(self.g, source))
@@ -635,32 +1794,161 @@ class Shard:
 	# shards, so I need to rewrite the method below so that it
 	# *does not* require knowledge of number of shards! I'm going
 	# to use a dictionary structure instead!
-    def bfs_trees_with_remote_nodes(self, sources):
+    #
+    # A single BFS from all sources at once: a node reachable from several
+    # sources is only explored once. The BFS stops at proxies, as a proxy may
+    # now connect internal nodes that are not connected inside the shard.
+    def bfs_trees_with_remote_nodes_uncached(self, sources):
 
         #print(sources)	
-        innodes = set()
+        adj = self.g.adj
+        boundary = self.boundary
+        visited = set(n for n in sources if n in adj)
+        frontier = collections.deque(visited)
+        innodes = []
         extnodes = dict()
-        for source in sources:
-            tree = list(nx.bfs_tree(self.g, source))
-            for n in tree:
-                label = self.g.nodes[n]['remote']
-                if label is not None:  #shard, ne, d
-                    shard, extnode, distance = label
-					
-                    if shard not in extnodes:
-                        extnodes[shard] = {extnode}
-                    else:
-                        extnodes[shard].add(extnode)
-
+        while frontier:
+            n = frontier.popleft()
+            label = boundary.get(n)
+            if label is not None:  #shard, ne, d
+                shard, extnode, distance = label
+                if shard not in extnodes:
+                    extnodes[shard] = {extnode}
                 else:
-                    innodes.add(n)
+                    extnodes[shard].add(extnode)
+                continue
+
+            innodes.append(n)
+            for t in adj[n]:
+                if t not in visited:
+                    visited.add(t)
+                    frontier.append(t)
 
         #print(innodes)
         #print(extnodes)
         extshards_and_nodes = [(k,list(v)) for k,v in extnodes.items()]
         #print(extshards_and_nodes)
         #print(list((list(innodes), extshards_and_nodes)))
-        return list((list(innodes), extshards_and_nodes))
+        return list((innodes, extshards_and_nodes))
+
+    # bfs_trees_with_remote_nodes_uncached(), through the shard's BfsCache. The cover
+    # of the sources: the components of the internal ones, and the proxies.
+    def bfs_trees_with_remote_nodes(self, sources):
+        cache = self.bfs_cache
+        if 0 == cache.capacity:
+            return self.bfs_trees_with_remote_nodes_uncached(sources)
+        if not isinstance(sources, NodeSet):
+            sources = NodeSet(sources)
+        version = self.version
+        key = hashlib.blake2b(sources.to_wire().encode(), digest_size=16).digest()
+        result = cache.get(version, key)
+        if result is not None:
+            return result
+
+        boundary = self.boundary
+        component_of = self.component_of
+        cids = set()
+        proxies = set()
+        for n in sources:
+            if n in boundary:
+                proxies.add(n)
+            elif n in component_of:
+                cids.add(component_of[n])
+        cover = (frozenset(cids), frozenset(proxies))
+        result = cache.subsumed(version, key, cover)
+        if result is None:
+            result = self.bfs_trees_with_remote_nodes_uncached(sources)
+            cache.put(version, key, cover, result)
+        return result
+
+    # Same as bfs_trees_with_remote_nodes(), for up to 64 BFSes at once (see multi_dbfs()):
+    # each node carries the mask of the queries that reached it, and is expanded once 
+    # per level for all of them. sources: [(mask, nodes), ..]. Returns the internal 
+    # nodes visited and the remote nodes reached grouped by shard, each grouped by mask:
+    # [(mask, [nodes]), ..], [(p, [(mask, [nodes]), ..]), ..]
+    def bfs_trees_with_remote_nodes_multi(self, sources):
+        adj = self.g.adj
+        boundary = self.boundary
+        seen = dict()
+        for mask, nodes in sources:
+            for n in nodes:
+                if n in adj:
+                    seen[n] = seen.get(n, 0) | mask
+        frontier = dict(seen)
+        extnodes = dict()
+        while frontier:
+            upcoming = dict()
+            for n, mask in frontier.items():
+                label = boundary.get(n)
+                if label is not None:  #shard, ne, d
+                    reached = extnodes.setdefault(label[0], dict())
+                    reached[label[1]] = reached.get(label[1], 0) | mask
+                    continue
+                for t in adj[n]:
+                    new = mask & ~seen.get(t, 0)
+                    if new:
+                        seen[t] = seen.get(t, 0) | new
+                        upcoming[t] = upcoming.get(t, 0) | new
+            frontier = upcoming
+
+        innodes = mask_groups((n, mask) for n, mask in seen.items() if n not in boundary)
+        return list((innodes, [(k, mask_groups(v.items())) for k, v in extnodes.items()]))
+
+    # Read-only copies of the remote nodes within k hops of the boundary (see Halos):
+    # halo: {(q, n): [(r, m), ..]} the neighbors of the remote nodes with all their
+    # neighbors in the halo or in this shard, border: {(q, n), ..} the others.
+    # One per k, so that DBFS runs with different k don't swap each other's halos.
+    def set_halo(self, k, halo, border):
+        self.halos[k] = (halo, border)
+
+    # Same as bfs_trees_with_remote_nodes(), but the BFS goes on through the halo
+    # k hops deep instead of stopping at the proxies. Remote nodes on the halo's
+    # border, and beyond it, are the external nodes. Also returns the remote nodes
+    # the BFS went through, grouped by shard: [(p, [nodes]), (q, [nodes]), ..]
+    def bfs_trees_with_halo(self, sources, k):
+        adj = self.g.adj
+        boundary = self.boundary
+        halo, border = self.halos[k]
+        me = self.guid
+        visited = set(n for n in sources if n in adj)
+        frontier = collections.deque(visited)
+        ghosts = collections.deque()
+        ghosts_visited = set()
+        innodes = []
+        ghostnodes = dict()
+        extnodes = dict()
+        while frontier or ghosts:
+            if frontier:
+                n = frontier.popleft()
+                label = boundary.get(n)
+                if label is None:
+                    innodes.append(n)
+                    for t in adj[n]:
+                        if t not in visited:
+                            visited.add(t)
+                            frontier.append(t)
+                    continue
+                key = (label[0], label[1])
+            else:
+                key = ghosts.popleft()
+
+            if key[0] == me:
+                # back into this shard, through another shard
+                if key[1] not in visited:
+                    visited.add(key[1])
+                    frontier.append(key[1])
+            elif key in halo:
+                if key not in ghosts_visited:
+                    ghosts_visited.add(key)
+                    ghostnodes.setdefault(key[0], []).append(key[1])
+                    for nb in halo[key]:
+                        if nb not in ghosts_visited:
+                            ghosts.append(nb)
+            else:
+                # on the halo's border, or beyond the halo
+                extnodes.setdefault(key[0], set()).add(key[1])
+
+        return list((innodes, [(k, list(v)) for k, v in extnodes.items()], list(ghostnodes.items())))
 
 	# deprecated in favor of above
 	
@@ -674,7 +1962,7 @@ class Shard:
     #def bfs_trees_with_remote_nodes(self, sources, numshards):
     def deprecated_bfs_trees_with_remote_nodes(self, sources):
 	
-        num_shards = nshards_as_list[0]
+        num_shards = registry.current().num_shards()
         innodes = set()
         extshards = []
         extnodes = [None]*num_shards
@@ -704,6 +1992,267 @@ class Shard:
         return list(innodes), extshards_and_nodes
 
 
+
+##########################################################
+### Shared shard state, for multi-worker serving (CLIENT)
+###
+### Under gunicorn every worker is its own process, with
+### its own globals. With NXG_SHARED_DIR set, the CLIENT
+### shard is published to that directory as a CSR 
+### adjacency file (offsets, targets, then the remote
+### labels and positions as JSON) after every change, and
+### each worker memory-maps it. All workers thus share the
+### same pages, and the read endpoints scale across cores.
+### Any other endpoint materializes a networkx Shard from
+### the mapping, once per published version.
+###
+### The file is named after the instance: NXG_INSTANCE,
+### or else the port (NXG_PORT), so that CLIENTs on the
+### same host don't overwrite each other's shard. Only
+### when another process reads it is the shard published
+### at all: several workers, or replicas started with
+### the same NXG_INSTANCE (see dShard.hedged()).
+##########################################################
+
+# Worker processes serving this app, set by gunicorn.conf.py. Query sessions
+# (Shard.sessions, reply_once(), PeerNode, vertex programs) are not shared: each
+# process has its own, and a session's calls land on any of them. So the session
+# endpoints refuse to serve with more than one process.
+worker_processes = int(os.environ.get('NXG_PROCESSES', 1))
+
+shared_instance = os.environ.get('NXG_INSTANCE')
+shared_dir = os.environ.get('NXG_SHARED_DIR') if 1 < worker_processes or shared_instance else None
+shared_name = "client-shard-" + (shared_instance or os.environ.get('NXG_PORT', '5000'))
+
+# the far nodes kept in the published meta, the rest come off the materialized shard
+shared_far_nodes = 64
+
+def sessions_refused():
+    if 1 < worker_processes:
+        return "Query sessions need a single worker process, this instance has " + str(worker_processes) + ": serve it with NXG_WORKERS=1!", 409
+    return None
+
+# magic, version, node id slots, adjacency length, meta length, pos length
+csr_header = struct.Struct('<8sqqqqq')
+csr_magic = b'NXGCSR01'
+
+def shared_shard_path():
+    return os.path.join(shared_dir, shared_name + ".csr")
+
+# serializes shard changes across worker processes. A no-op without NXG_SHARED_DIR.
+@contextlib.contextmanager
+def shared_shard_lock():
+    if not shared_dir:
+        yield
+        return
+    os.makedirs(shared_dir, exist_ok=True)
+    with open(os.path.join(shared_dir, shared_name + ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# call while holding shared_shard_lock()
+def publish_shard(shard):
+    if not shared_dir:
+        return shard
+    if isinstance(shard, MappedShard):
+        shard = shard.materialized()
+
+    g = shard.g
+    slots = max(g.nodes) + 1 if 0 < g.number_of_nodes() else 0
+    offsets = array('i', [0])
+    targets = array('i')
+    for n in range(0, slots):
+        if n in g:
+            targets.extend(g.adj[n])
+        offsets.append(len(targets))
+
+    meta = j.dumps({
+        'guid': shard.guid,
+        'numnodes': shard.numnodes,
+        'probaedge': shard.probaedge,
+        'absent': [n for n in range(0, slots) if n not in g],
+        'remote': [[n, list(g.nodes[n]['remote'])] for n in g.nodes if g.nodes[n]['remote'] is not None],
+        'next_node_id': shard.next_node_id,
+        'version': shard.version,
+        'center': list(shard.node_center()),
+        'distances': [[n, d] for n, d in shard.most_distant_internal_nodes(num=shared_far_nodes)]
+    }).encode()
+    pos = j.dumps({
+        'pos': [[n, list(g.nodes[n]['pos'])] for n in g.nodes],
+        'origpos': [[n, list(xy)] for n, xy in shard.origpos.items()]
+    }).encode()
+
+    path = shared_shard_path()
+    try:
+        with open(path, 'rb') as f:
+            version = csr_header.unpack(f.read(csr_header.size))[1] + 1
+    except (OSError, struct.error):
+        version = 1
+
+    tmp_path = path + "." + str(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(csr_header.pack(csr_magic, version, slots, len(targets), len(meta), len(pos)))
+        f.write(offsets.tobytes())
+        f.write(targets.tobytes())
+        f.write(meta)
+        f.write(pos)
+    os.replace(tmp_path, path)
+
+    # this worker keeps the networkx shard it just changed, on top of the new mapping
+    mapped = MappedShard(path)
+    mapped.shard = shard
+    return mapped
+
+def unpublish_shard():
+    if shared_dir:
+        try:
+            os.remove(shared_shard_path())
+        except OSError:
+            pass
+
+# Read-only CLIENT shard backed by a memory-mapped CSR file. It answers
+# the hot read endpoints itself and hands anything else over to a networkx
+# Shard materialized from the mapping.
+class MappedShard:
+    def __init__(self, path):
+        self.shard = None
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.file_version, self.slots, num_adjacent, meta_len, pos_len = csr_header.unpack_from(self.mm, 0)
+        if magic != csr_magic:
+            raise ValueError(path + " is not a published shard!")
+
+        view = memoryview(self.mm)
+        start = csr_header.size
+        self.offsets = view[start:start + 4 * (self.slots + 1)].cast('i')
+        start += 4 * (self.slots + 1)
+        self.targets = view[start:start + 4 * num_adjacent].cast('i')
+        start += 4 * num_adjacent
+        self.meta = j.loads(bytes(view[start:start + meta_len]).decode())
+        self.pos_at = start + meta_len, pos_len
+
+        self.guid = self.meta['guid']
+        self.numnodes = self.meta['numnodes']
+        self.version = self.meta['version']
+        self.remote = {n: tuple(label) for n, label in self.meta['remote']}
+        self.absent = set(self.meta['absent'])
+
+    def same_file(self, stat):
+        return (self.stat.st_ino, self.stat.st_mtime_ns, self.stat.st_size) == (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def materialized(self):
+        if self.shard is None:
+            self.shard = shard_from_mapped(self)
+        return self.shard
+
+    # everything not answered from the mapping goes to the networkx shard
+    def __getattr__(self, name):
+        return getattr(self.materialized(), name)
+
+    def nodes(self):
+        return [n for n in range(0, self.slots) if n not in self.absent]
+
+    def edges(self):
+        offsets, targets = self.offsets, self.targets
+        return [(u, v) for u in self.nodes() for v in targets[offsets[u]:offsets[u + 1]] if u <= v]
+
+    def numedges(self):
+        return len(self.targets) // 2
+
+    def node_center(self):
+        n, d = self.meta['center']
+        return n, d
+
+    def external_nodes(self):
+        return list(self.remote.items())
+
+    def most_distant_internal_nodes(self, p=1, num=0):
+        if p > 1: p = 1
+        how_many = num if 0 < num else int(self.numnodes * p)
+        if len(self.meta['distances']) < how_many:
+            return self.materialized().most_distant_internal_nodes(p, num)
+        return [tuple(e) for e in self.meta['distances'][-how_many:]]
+
+    # same output as Shard.bfs_trees_with_remote_nodes(), straight off the CSR arrays
+    def bfs_trees_with_remote_nodes(self, sources):
+        offsets, targets, remote = self.offsets, self.targets, self.remote
+        visited = bytearray(self.slots)
+        innodes = []
+        extnodes = dict()
+        frontier = collections.deque()
+        for source in sources:
+            if 0 <= source < self.slots and source not in self.absent and not visited[source]:
+                visited[source] = 1
+                frontier.append(source)
+
+        while frontier:
+            n = frontier.popleft()
+            label = remote.get(n)
+            if label is not None:
+                if label[0] in extnodes:
+                    extnodes[label[0]].add(label[1])
+                else:
+                    extnodes[label[0]] = {label[1]}
+                continue
+            innodes.append(n)
+            for t in targets[offsets[n]:offsets[n + 1]]:
+                if not visited[t]:
+                    visited[t] = 1
+                    frontier.append(t)
+
+        return list((innodes, [(k, list(v)) for k, v in extnodes.items()]))
+
+def shard_from_mapped(mapped):
+    pos_start, pos_len = mapped.pos_at
+    pos = j.loads(bytes(mapped.mm[pos_start:pos_start + pos_len]).decode())
+
+    shard = Shard(mapped.guid)
+    shard.guid = mapped.guid
+    shard.numnodes = mapped.numnodes
+    shard.probaedge = mapped.meta['probaedge']
+    shard.g = nx.Graph()
+    for n, xy in pos['pos']:
+        shard.g.add_node(n, pos=tuple(xy), remote=mapped.remote.get(n))
+    for u, v in mapped.edges():
+        if u in mapped.remote or v in mapped.remote:
+            shard.g.add_edge(u, v)
+        else:
+            shard.g.add_edge(u, v, remote=None)
+    shard.origpos = {n: tuple(xy) for n, xy in pos['origpos']}
+    shard.next_node_id = mapped.meta['next_node_id']
+    shard.version = mapped.meta['version']
+    shard.center = mapped.node_center()
+    shard.distances = None
+    shard.index_boundary()
+    shard.index_components()
+    shard.sessions = dict()
+    shard.component_labels = dict()
+    shard.labels_version = None
+    return shard
+
+# Picks up the CLIENT shard another worker may have published since the
+# last request. One stat() per request when NXG_SHARED_DIR is set.
+def sync_shared_shard():
+    if not shared_dir:
+        return
+    fleet = registry.snapshot('local')
+    current = fleet.shards[0] if fleet.shards else None
+    try:
+        stat = os.stat(shared_shard_path())
+    except OSError:
+        if isinstance(current, MappedShard):
+            registry.reset()
+        return
+    if isinstance(current, MappedShard) and current.same_file(stat):
+        return
+
+    mapped = MappedShard(shared_shard_path())
+    registry.publish('local', Fleet([mapped], num_nodes_per_shard=mapped.numnodes), role="CLIENT")
+
 		
 #################
 ### toroidal wrap
@@ -732,12 +2281,12 @@ def tw_neigh(i, n):
 ####################################
 ### distributed BFS on remote shards
 ####################################
-def ddbfs(begin_shard, verbose=False):
+def ddbfs(begin_shard, verbose=False, fleet=None, counts_only=False, combine=False, speculate=0, policy='fifo', unavailable=None, checkpoint=None):
     # The code is the same because
 	# our shard list s consists of
 	# dShard objects instead of
 	# shard objects :-)
-    return dbfs(begin_shard, verbose)
+    return dbfs(begin_shard, verbose, fleet, counts_only, combine, speculate=speculate, policy=policy, unavailable=unavailable, checkpoint=checkpoint)
 
 	
 ###################################
@@ -749,7 +2298,8 @@ def deprecated_buggy_dbfs(begin_shard, verbose=False):
     time_spent_inside_shards_in_seconds = 0.
     time_spent_outside_shards_in_seconds = 0.
 	
-    num_shards = nshards_as_list[0]
+    s = registry.current().shards
+    num_shards = len(s)
     cross_cuts_per_shard = [None]*num_shards
     traversed_nodes = [None]*num_shards
     shard_queue = []
@@ -774,11 +2324,8 @@ def deprecated_buggy_dbfs(begin_shard, verbose=False):
         # traverse the shard and get internal nodes visited by the
         # BFS as well as external nodes and shards that need to be
         # visited
-        if global_verbose:
-            print("---> Traversing shard " + str(i) + ". Queue size: " + str(len(shard_queue)))
-        if verbose:
-            if traversed_nodes[i] is None: print("---> traversing shard " + str(i))
-            if not traversed_nodes[i] is None: print("---> traversing shard " + str(i) + " again (" + str(cross_cuts_per_shard[i]) + ")!")
+        # Per-hop records are sampled, and formatted only if they get through.
+        hop_log.info("dbfs hop shard=%s queue=%d again=%s", i, len(shard_queue), traversed_nodes[i] is not None)
         start = time.time()
         #ins, exs = s[i].bfs_trees_with_remote_nodes(ns, num_shards)   #{}, [(p, {}), (q, {}), ..]
         ins, exs = s[i].bfs_trees_with_remote_nodes(ns)   #{}, [(p, {}), (q, {}), ..]
@@ -786,19 +2333,12 @@ def deprecated_buggy_dbfs(begin_shard, verbose=False):
         time_spent_inside_shards_in_seconds += end - start
         time_spent_outside_shards_in_seconds -= end - start
 
-        # debugging
-        if verbose:
-            print("   BFS: internal nodes traversed: " + str(ins))
-            print("   BFS: Need to additionally traverse following shards and their nodes: " + str(exs))
-            print("        On these shards, only the following new nodes need to be visited:")
+        # debugging: the node sets are only stringified if DEBUG is enabled
+        if verbose and log.isEnabledFor(logging.DEBUG):
+            log.debug("dbfs bfs shard=%s cross_cuts=%s internal=%s external=%s", i, cross_cuts_per_shard[i], ins, exs)
             for ex in exs:
                 shard, nodes = ex
-
-                if traversed_nodes[shard] is None:
-                    print("        On shard " + str(shard) +": Nodes " + str(nodes))
-                else:
-                    print("        On shard " + str(shard) +": Nodes " + str(set(nodes) - set(traversed_nodes[shard])))
-            print("        ---------")
+                log.debug("dbfs new shard=%s nodes=%s", shard, nodes if traversed_nodes[shard] is None else set(nodes) - set(traversed_nodes[shard]))
 
 
         # add internal nodes to the visited nodes per shard
@@ -863,13 +2403,10 @@ def deprecated_buggy_dbfs(begin_shard, verbose=False):
                             cross_cuts_per_shard[ss] = 1 if cross_cuts_per_shard[ss] is None else cross_cuts_per_shard[ss] + 1
 
 
-        # debugging
+        # debugging. No more sleeping here to keep the notebook alive: records
+        # are written out by the logging listener thread, outside the timed region.
         if verbose:
-            print("        shard queue = " + str(shard_queue))
-            print()
-            
-            # If i don't do this I may exceed the allowed data rate and crash the hotebook!
-            time.sleep(0.1)
+            log.debug("dbfs queue=%s", shard_queue)
             
         #debugging_p = False
         
@@ -889,12 +2426,58 @@ def deprecated_buggy_dbfs(begin_shard, verbose=False):
 def firstkey(mydictionary):
     for key in mydictionary:
         return key
+
+# a query session id, for the shards' per-query state
+def session_id():
+    return "%x" % int.from_bytes(os.urandom(8), 'little')
+
+# Ends session sid on shard p, for the cleanup after a query: a shard that cannot
+# be reached keeps the session, and the cleanup goes on with the other shards.
+# Returns what the shard's end_session() returns, or None if it failed.
+def end_session(s, p, sid):
+    try:
+        return s[p].end_session(sid)
+    except requests.RequestException as e:
+        log.warning("could not end session %s on shard %s: %s", sid, p, e)
+        return None
+
+# The dbfs() options that do not go together, as a ValueError
+def check_dbfs_options(counts_only=False, combine=False, halo=0, speculate=0, checkpoint=None):
+    # the count-only BFS on the shards does not go through halos
+    if halo and counts_only:
+        raise ValueError("a DBFS through halos cannot be counts-only")
+    # checkpoints are kept hop by hop, a combined DBFS goes level by level
+    if combine and checkpoint is not None:
+        raise ValueError("a combined DBFS cannot be checkpointed")
+    # speculation runs plain hops, one shard after the other
+    if speculate and (counts_only or combine or halo or checkpoint is not None):
+        raise ValueError("a speculative DBFS cannot be counts-only, combined, through halos nor checkpointed")
 		
 # 4/14/20: optimized using dict()
-def dbfs(begin_shard, verbose=False):
-
+# fleet: snapshot to traverse, defaults to the registry's current fleet
+# counts_only: shards keep the visited nodes and only return counts, the remote
+# nodes reached and the anchors visited (see Shard.bfs_count_with_remote_nodes()),
+# so traversed_nodes only holds anchors. Not for the graph engine clones.
+# combine: level-synchronous, see combined_dbfs()
+# unavailable: a dict, for a partial result instead of an error if shards stay
+# unavailable (see dShard.get()). Gets shard -> number of nodes it was not asked for.
+# checkpoint: a DbfsCheckpoint, new or loaded, to keep the state on disk after every
+# hop and resume from it. Hop by hop only, not combined nor speculative.
+# Options that do not go together raise a ValueError, see check_dbfs_options().
+def dbfs(begin_shard, verbose=False, fleet=None, counts_only=False, combine=False, halo=0, speculate=0, policy='fifo', unavailable=None, checkpoint=None):
+
+    check_dbfs_options(counts_only, combine, halo, speculate, checkpoint)
+    if combine:
+        return combined_dbfs(begin_shard, verbose, fleet, counts_only, unavailable, policy)
+    if speculate:
+        return speculative_dbfs(begin_shard, verbose, fleet, speculate, unavailable, policy)[:4]
+    if checkpoint is not None and checkpoint.finished():
+        return checkpoint.result(unavailable)
+    if fleet is None:
+        fleet = registry.current()
+    s = fleet.shards
     if not s:
-        print("Whoah! Graph has not been initialized yet!")
+        log.warning("Whoah! Graph has not been initialized yet!")
         return 0,0,0,0
 
     time_spent_inside_shards_in_seconds = 0.
@@ -903,139 +2486,1568 @@ def dbfs(begin_shard, verbose=False):
     cross_cuts_per_shard = dict()
     traversed_nodes = dict()
     shard_queue = dict()
-
-    # start BFS at which shard, which nodes (note plural nodes bfs_trees_with_remote_nodes() API)?
-    total_cross_cuts_required = 0
-    begin_node = s[begin_shard].node_center()[0]
-    shard_queue[begin_shard] = {begin_node} #(set with one element)
-
-    # add the cross-cut for shard 'begin_shard', the starting point of the BFS.
-    # Note we don't add it to the total total_cross_cuts_required
-    cross_cuts_per_shard[begin_shard] = 1
+    sid = session_id()
+    asked = set()   # the shards with a counts-only session
+    num_nodes_counted = 0
+    if halo:
+        fleet_halos(fleet, halo)
+    scheduler = queue_policies[policy](fleet)
+
+    if checkpoint is not None and checkpoint.loaded():
+        # carry on where the checkpoint left off, with the same shard sessions
+        sid = checkpoint.options['sid']
+        total_cross_cuts_required, num_nodes_counted, time_spent_inside_shards_in_seconds, time_spent_outside_shards_in_seconds = \
+            checkpoint.restore(traversed_nodes, shard_queue, cross_cuts_per_shard, unavailable)
+        # a counts-only hop that was under way when the checkpoint was left goes first
+        redo = checkpoint.pending
+        for q in shard_queue:
+            scheduler.enqueued(q)
+    else:
+        # start BFS at which shard, which nodes (note plural nodes bfs_trees_with_remote_nodes() API)?
+        total_cross_cuts_required = 0
+        begin_node = s[begin_shard].node_center()[0]
+        shard_queue[begin_shard] = NodeSet([begin_node]) #(set with one element)
+        scheduler.enqueued(begin_shard)
+
+        # add the cross-cut for shard 'begin_shard', the starting point of the BFS.
+        # Note we don't add it to the total total_cross_cuts_required
+        cross_cuts_per_shard[begin_shard] = 1
+
+        redo = None
+        if checkpoint is not None:
+            checkpoint.begin({'begin_shard': begin_shard, 'shards': fleet.num_shards(), 'counts_only': counts_only, 'halo': halo,
+                              'policy': policy, 'partial': unavailable is not None, 'sid': sid},
+                             traversed_nodes, shard_queue, cross_cuts_per_shard, unavailable)
 
     # while there are shards (and nodes on those shards) on the queue
 	# Note: python 3.6 safeguards queue order (random beforehand)
     #debugging_p = True
     start_o = time.time()
-    while 0 < len(shard_queue):
-    #while debugging_p:
-        # pop first shard/nodes from the queue
-        i = firstkey(shard_queue)
-        ns = shard_queue.pop(i)
-
-        # traverse the shard and get internal nodes visited by the BFS 
-		# as well as external nodes and shards that still need to be visited
-        if global_verbose:
-            print("---> Traversing shard " + str(i) + ". Queue size: " + str(len(shard_queue)))
-        if verbose:
-            if i in traversed_nodes: 
-                print("---> traversing shard " + str(i) + " again (" + str(cross_cuts_per_shard[i]) + ")!")
+    finished = False
+    try:
+        while 0 < len(shard_queue):
+        #while debugging_p:
+            # pop the next shard/nodes off the queue, first in first out unless another policy says otherwise
+            if redo is not None:
+                i, rid = redo
+                redo = None
+            else:
+                i = scheduler.pick(shard_queue)
+                rid = session_id()
+            ns = shard_queue.pop(i)
+
+            # traverse the shard and get internal nodes visited by the BFS 
+    		# as well as external nodes and shards that still need to be visited.
+            # Per-hop records are sampled, and formatted only if they get through.
+            hop_log.info("dbfs hop shard=%s queue=%d again=%s", i, len(shard_queue), i in traversed_nodes)
+
+            # the graph may be changing while we traverse it, but never within a hop
+            start = time.time()
+            ghosts, count = (), 0
+            #ins, exs = s[i].bfs_trees_with_remote_nodes(ns, num_shards)   #{}, [(p, {}), (q, {}), ..]
+            if counts_only and checkpoint is not None:
+                checkpoint.intent(i, rid)
+            try:
+                with registry.lock.read():
+                    if counts_only:
+                        asked.add(i)
+                        count, exs, ins = s[i].bfs_count_with_remote_nodes(sid, ns, rid)   #n, [(p, {}), (q, {}), ..], {anchors}
+                        num_nodes_counted += count
+                    elif halo:
+                        ins, exs, ghosts = s[i].bfs_trees_with_halo(ns, halo)   #{}, [(p, {}), (q, {}), ..], [(p, {}), ..]
+                    else:
+                        ins, exs = s[i].bfs_trees_with_remote_nodes(ns)   #{}, [(p, {}), (q, {}), ..]
+            except requests.RequestException:
+                if unavailable is None:
+                    raise
+                # the nodes behind shard i are left out, the DBFS goes on without them
+                unavailable[i] = unavailable.get(i, 0) + len(ns)
+                if checkpoint is not None:
+                    checkpoint.hop(i, (), (), (), 0, None, lost=len(ns))
+                continue
+            end = time.time()
+            time_spent_inside_shards_in_seconds += end - start
+            time_spent_outside_shards_in_seconds -= end - start
+            scheduler.called(i, end - start)
+
+            # debugging: the node sets are only stringified if DEBUG is enabled
+            if verbose and log.isEnabledFor(logging.DEBUG):
+                log.debug("dbfs bfs shard=%s cross_cuts=%s internal=%s external=%s", i, cross_cuts_per_shard[i], ins, exs)
+                for ex in exs:
+                    shard, nodes = ex
+                    log.debug("dbfs new shard=%s nodes=%s", shard, NodeSet(nodes) - traversed_nodes[shard] if shard in traversed_nodes else nodes)
+
+
+            # Action 1: Add internal nodes to the visited nodes per shard (compressed, 
+            # see NodeSet: the merges below then run in bulk, a chunk of ids at a time)
+            if i in traversed_nodes:
+                traversed_nodes[i].update(ins) # automatically discards duplicates
             else:
-                print("---> traversing shard " + str(i))
+                traversed_nodes[i] = NodeSet(ins)
+
+            # the other shards' nodes the BFS went through in the halo are visited, no cross-cut
+            if halo:
+                for q, gns in ghosts:
+                    traversed_nodes.setdefault(q, NodeSet()).update(gns)
+
+
+            # Action 2: if an external node that needs to be traversed hasn't 
+            # already been traversed, schedule it for traversal and
+            # increment the number of cross-cuts if that node hadn't
+            # already been previously scheduled for traversal
+            for ex in exs:      #[(p, {}), (q, {}), ..]
+                (ss, nns) = ex  #(p, {})
+			
+    			# nodes that have not already been traversed:
+                real_nns = NodeSet(nns) - traversed_nodes[ss] if ss in traversed_nodes else NodeSet(nns)
+
+                # if non-empty
+                if real_nns:
+                    if ss in shard_queue:
+
+                        # Shard ss is already spooled in the queue.
+                        # Find queue entry and add the additional nodes to be visited only if they have not already been visited
+                        # Note no new cross-cuts required at all, piggy-backing on already scheduled ones!
+                        shard_queue[ss].update(real_nns)
+                        scheduler.merged(ss)
+
+                    else:
+
+                        # need new entry in shard queue, need to increment cross-cuts
+                        shard_queue[ss] = real_nns
+                        scheduler.enqueued(ss)
+                        total_cross_cuts_required += 1
+                        cross_cuts_per_shard[ss] = cross_cuts_per_shard[ss] + 1 if ss in cross_cuts_per_shard else 1
+
+            if checkpoint is not None:
+                checkpoint.hop(i, ins, exs, ghosts, count, (total_cross_cuts_required, num_nodes_counted, time_spent_inside_shards_in_seconds,
+                                                            time_spent_outside_shards_in_seconds + time.time() - start_o))
+
+            # debugging. No more sleeping here to keep the notebook alive: records
+            # are written out by the logging listener thread, outside the timed region.
+            if verbose:
+                log.debug("dbfs queue=%s", shard_queue)
+            
+            #debugging_p = False
+	
+        if verbose and log.isEnabledFor(logging.DEBUG):
+            num_shards = fleet.num_shards()
+            log.debug("dbfs never visited shards=%s", [i for i in range(0, num_shards) if i not in traversed_nodes])
+        finished = True
+    finally:
+        # the shards' counts-only sessions are ended also when the DBFS fails,
+        # unless a checkpoint keeps them to resume with
+        if counts_only and (finished or checkpoint is None):
+            for i in asked | set(traversed_nodes):
+                end_session(s, i, sid)
+
+    # num nodes visited
+    if counts_only:
+        num_nodes_visited = num_nodes_counted
+    else:
+        num_nodes_visited = sum(
+            [len(traversed_nodes[i]) for i in traversed_nodes]
+        )
+    
+    end_o = time.time()
+    time_spent_outside_shards_in_seconds += end_o - start_o	
+    if checkpoint is not None:
+        checkpoint.done((total_cross_cuts_required, num_nodes_visited, time_spent_inside_shards_in_seconds, time_spent_outside_shards_in_seconds))
+    return total_cross_cuts_required, num_nodes_visited, time_spent_inside_shards_in_seconds, time_spent_outside_shards_in_seconds
+
+
+#####################################################
+### DBFS checkpoints
+###
+### A long DBFS keeps the coordinator's state on local
+### disk, in NXG_CHECKPOINT_DIR, so that it can resume
+### after the coordinator dies without going back to 
+### the shards it has been through. Each hop is 
+### appended to <traversal>.log as a line of JSON: the
+### shard, the nodes it visited and the remote nodes 
+### it reached, compressed (see NodeSet). Every so 
+### many hops or seconds, the whole state (visited 
+### sets, queue, cross-cuts) goes to <traversal>.snap,
+### written aside and renamed over the last one, and 
+### the log starts over. Resuming loads the snapshot 
+### and replays the hops logged since. A torn last 
+### line, from a crash mid-write, is dropped: that hop
+### is done again. That is only safe in plain mode: 
+### in counts-only mode the shard has marked the hop's
+### nodes visited in its session already, and would 
+### answer nothing new. So before each counts-only 
+### shard call goes an intent record with the call's
+### request id, and the hop of an intent without its
+### record is done again first, with the same request
+### id: the shard answers it with the reply it gave 
+### (see reply_once()), or computes it if the call 
+### never got there. The log is flushed, not synced, 
+### per record: it survives the coordinator, not the
+### machine.
+#####################################################
+checkpoint_dir = os.environ.get('NXG_CHECKPOINT_DIR', os.path.join(tempfile.gettempdir(), 'nxg-checkpoints'))
+
+class DbfsCheckpoint:
+    def __init__(self, traversal, every=64, seconds=5.):
+        self.traversal = traversal
+        self.every = every
+        self.seconds = seconds
+        self.options = None
+        self.state = None       # the snapshot loaded, see load()
+        self.records = []       # the hops logged after it
+        self.log_file = None
+        self.hops = 0
+        self.pending = None     # (shard, rid) of the hop logged as intended only
+
+    def path(self, extension):
+        return os.path.join(checkpoint_dir, self.traversal + extension)
+
+    @staticmethod
+    def load(traversal):
+        checkpoint = DbfsCheckpoint(traversal)
+        with open(checkpoint.path('.snap')) as f:
+            checkpoint.state = j.load(f)
+        checkpoint.options = checkpoint.state['options']
+        checkpoint.hops = checkpoint.state['hops']
+        if os.path.exists(checkpoint.path('.log')):
+            with open(checkpoint.path('.log')) as f:
+                for line in f:
+                    try:
+                        record = j.loads(line)
+                    except ValueError:
+                        break
+                    if checkpoint.hops < record['hop']:
+                        checkpoint.records.append(record)
+        return checkpoint
+
+    def loaded(self):
+        return self.state is not None
+
+    def finished(self):
+        return self.state is not None and self.state.get('result') is not None
+
+    def result(self, unavailable=None):
+        if unavailable is not None:
+            unavailable.update(self.state['unavailable'])
+        return tuple(self.state['result'])
+
+    # a new traversal, its options and the dicts dbfs() keeps its state in
+    def begin(self, options, traversed_nodes, shard_queue, cross_cuts_per_shard, unavailable):
+        self.options = options
+        self.traversed_nodes = traversed_nodes
+        self.shard_queue = shard_queue
+        self.cross_cuts_per_shard = cross_cuts_per_shard
+        self.unavailable = unavailable
+        self.snapshot((0, 0, 0., 0.))
+
+    # Fills dbfs()'s dicts from the snapshot and the hops logged since, the way dbfs()
+    # did. Returns the cross-cuts, nodes counted, and time spent in and out of shards.
+    # The shard queue comes back in order (MostContributionsPolicy starts over).
+    def restore(self, traversed_nodes, shard_queue, cross_cuts_per_shard, unavailable):
+        state = self.state
+        traversed_nodes.update((q, NodeSet.from_wire(wire)) for q, wire in state['traversed'])
+        shard_queue.update((q, NodeSet.from_wire(wire)) for q, wire in state['queue'])
+        cross_cuts_per_shard.update((q, n) for q, n in state['cross_cuts_per_shard'])
+        if unavailable is not None:
+            unavailable.update((q, n) for q, n in state['unavailable'])
+        cross_cuts, counted = state['cross_cuts'], state['counted']
+
+        self.pending = None
+        for record in self.records:
+            i = record['shard']
+            if 'intent' in record:
+                self.pending = (i, record['intent'])
+                continue
+            self.pending = None
+            ns = shard_queue.pop(i)
+            self.hops = record['hop']
+            if 'lost' in record:
+                if unavailable is not None:
+                    unavailable[i] = unavailable.get(i, 0) + len(ns)
+                continue
+            traversed_nodes.setdefault(i, NodeSet()).update(NodeSet.from_wire(record['ins']))
+            for q, wire in record.get('ghosts', ()):
+                traversed_nodes.setdefault(q, NodeSet()).update(NodeSet.from_wire(wire))
+            counted += record.get('count', 0)
+            for ss, wire in record['exs']:
+                real_nns = NodeSet.from_wire(wire) - traversed_nodes[ss] if ss in traversed_nodes else NodeSet.from_wire(wire)
+                if real_nns:
+                    if ss in shard_queue:
+                        shard_queue[ss].update(real_nns)
+                    else:
+                        shard_queue[ss] = real_nns
+                        cross_cuts += 1
+                        cross_cuts_per_shard[ss] = cross_cuts_per_shard.get(ss, 0) + 1
+        log.info("dbfs checkpoint %s: resuming after hop %d, %d shards queued, hop of shard %s to redo", self.traversal, self.hops, len(shard_queue),
+                 None if self.pending is None else self.pending[0])
+
+        self.state, self.records = None, []
+        scalars = (cross_cuts, counted, state['time_in'], state['time_out'])
+        pending = self.pending
+        self.begin(self.options, traversed_nodes, shard_queue, cross_cuts_per_shard, unavailable)
+        # the snapshot starts the log over: the intent goes in again
+        if pending is not None:
+            self.intent(*pending)
+        return scalars
+
+    # shard i is about to be called with request id rid (counts-only mode)
+    def intent(self, i, rid):
+        self.pending = (i, rid)
+        self.log_file.write(j.dumps({'hop': self.hops + 1, 'shard': i, 'intent': rid}, separators=(',', ':')) + '\n')
+        self.log_file.flush()
+
+    # shard i has been traversed. scalars: cross-cuts, nodes counted, time in and out of shards
+    # so far, for the snapshot. lost: nodes not asked for, shard i being unavailable.
+    def hop(self, i, ins, exs, ghosts, count, scalars, lost=0):
+        self.hops += 1
+        self.pending = None
+        record = {'hop': self.hops, 'shard': i}
+        if lost:
+            record['lost'] = lost
+        else:
+            record['ins'] = NodeSet(ins).to_wire()
+            record['exs'] = [[ss, NodeSet(nns).to_wire()] for ss, nns in exs]
+            if ghosts:
+                record['ghosts'] = [[q, NodeSet(gns).to_wire()] for q, gns in ghosts]
+            if count:
+                record['count'] = count
+        self.log_file.write(j.dumps(record, separators=(',', ':')) + '\n')
+        self.log_file.flush()
+        if scalars is not None and (self.every <= self.hops - self.snapped or self.seconds <= time.time() - self.snapped_at):
+            self.snapshot(scalars)
+
+    def snapshot(self, scalars, result=None):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        state = {'traversal': self.traversal, 'options': self.options, 'hops': self.hops, 'result': result,
+                 'cross_cuts': scalars[0], 'counted': scalars[1], 'time_in': scalars[2], 'time_out': scalars[3],
+                 'unavailable': list(self.unavailable.items()) if self.unavailable is not None else []}
+        if result is None:
+            state['cross_cuts_per_shard'] = list(self.cross_cuts_per_shard.items())
+            state['traversed'] = [[q, nodes.to_wire()] for q, nodes in self.traversed_nodes.items()]
+            state['queue'] = [[q, nodes.to_wire()] for q, nodes in self.shard_queue.items()]
+        with open(self.path('.snap.tmp'), 'w') as f:
+            j.dump(state, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path('.snap.tmp'), self.path('.snap'))
+        log.debug("dbfs checkpoint %s: snapshot at hop %d", self.traversal, self.hops)
+
+        # the hops logged so far are in the snapshot (a crash right here: load() skips them)
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        if result is None:
+            self.log_file = open(self.path('.log'), 'w')
+        elif os.path.exists(self.path('.log')):
+            os.remove(self.path('.log'))
+        self.snapped, self.snapped_at = self.hops, time.time()
+
+    # the traversal is over: only its result is kept
+    def done(self, result):
+        self.snapshot((result[0], 0, result[2], result[3]), list(result))
+
+# the checkpoints on disk: traversal, hops done, finished or not, and the DBFS options
+def dbfs_checkpoints():
+    checkpoints = []
+    if os.path.isdir(checkpoint_dir):
+        for name in sorted(os.listdir(checkpoint_dir)):
+            if name.endswith('.snap'):
+                checkpoint = DbfsCheckpoint.load(name[:-len('.snap')])
+                checkpoints.append({'traversal': checkpoint.traversal, 'hops': checkpoint.hops + len(checkpoint.records),
+                                    'finished': checkpoint.finished(), 'options': checkpoint.options})
+    return checkpoints
+
+def remove_dbfs_checkpoint(traversal):
+    checkpoint = DbfsCheckpoint(traversal)
+    for extension in ('.snap', '.log', '.snap.tmp'):
+        if os.path.exists(checkpoint.path(extension)):
+            os.remove(checkpoint.path(extension))
+
+# a traversal name goes into file names
+def valid_traversal(traversal):
+    return traversal.replace('-', '').replace('_', '').isalnum()
+
+# checkpoint=1&traversal=<name>: a new checkpoint for the DBFS, named or not
+def request_checkpoint():
+    if 0 == int(request.args.get('checkpoint', 0)):
+        return None
+    traversal = request.args.get('traversal') or session_id()
+    if not valid_traversal(traversal):
+        raise ValueError("A traversal name has letters, digits, - and _ only!")
+    every = int(request.args.get('checkpoint-every', 64))
+    return DbfsCheckpoint(traversal, every)
+
+
+#####################################################
+### Multi-source DBFS
+###
+### Up to 64 DBFS queries in one traversal, MS-BFS 
+### style: each query is a bit, each node visited 
+### carries the mask of the queries that visited it,
+### and each shard call carries the frontiers of all 
+### the queries queued for that shard. Queries that 
+### cross the same shards share the calls, so there 
+### are up to 64 times fewer of them. Nodes go over 
+### the wire grouped by mask, as most of them are 
+### reached by the same queries: mask:nodes,mask:nodes
+### with mask in hex and nodes compressed (see NodeSet)
+#####################################################
+batch_width = 64
+
+# [(node, mask), ..] -> [(mask, [nodes]), ..]
+def mask_groups(node_masks):
+    groups = dict()
+    for n, mask in node_masks:
+        groups.setdefault(mask, []).append(n)
+    return list(groups.items())
+
+def mask_groups_to_wire(groups):
+    return ','.join("%x" % mask + ':' + NodeSet(nodes).to_wire() for mask, nodes in groups)
+
+def mask_groups_from_wire(encoded):
+    groups = []
+    for part in encoded.split(',') if encoded else []:
+        mask, nodes = part.split(':')
+        groups.append((int(mask, 16), NodeSet.from_wire(nodes)))
+    return groups
+
+# the queries in mask
+def mask_queries(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+# One DBFS per begin shard, up to batch_width of them, in one traversal. Returns the
+# cross-cuts and nodes visited per query, the number of shard calls, and the time
+# spent in and out of the shards. A query's cross-cuts count the times its frontier
+# for a shard was queued with no frontier of its own already there, as in dbfs().
+# unavailable: a dict, for partial results instead of an error if shards stay 
+# unavailable (see dShard.get()). Gets query -> {shard: number of nodes it was not
+# asked for}, for the queries that had nodes on those shards.
+def multi_dbfs(begin_shards, verbose=False, fleet=None, policy='fifo', unavailable=None):
+    if not 0 < len(begin_shards) <= batch_width:
+        raise ValueError("From 1 to " + str(batch_width) + " queries at once!")
+    if fleet is None:
+        fleet = registry.current()
+    s = fleet.shards
+    num_queries = len(begin_shards)
+    if not s:
+        log.warning("Whoah! Graph has not been initialized yet!")
+        return [0] * num_queries, [0] * num_queries, 0, 0., 0.
+
+    time_spent_inside_shards_in_seconds = 0.
+    time_spent_outside_shards_in_seconds = 0.
+    visited = dict()       # shard -> {node: mask of the queries that visited it}
+    shard_queue = dict()   # shard -> {node: mask of the queries to visit it for}
+    pending = dict()       # shard -> mask of the queries with a frontier queued for it
+    cross_cuts = [0] * num_queries
+    num_calls = 0
+    scheduler = queue_policies[policy](fleet)
+
+    for q, begin_shard in enumerate(begin_shards):
+        begin_node = s[begin_shard].node_center()[0]
+        if begin_shard in shard_queue:
+            scheduler.merged(begin_shard)
+        else:
+            shard_queue[begin_shard] = dict()
+            scheduler.enqueued(begin_shard)
+        frontier = shard_queue[begin_shard]
+        frontier[begin_node] = frontier.get(begin_node, 0) | 1 << q
+        pending[begin_shard] = pending.get(begin_shard, 0) | 1 << q
+
+    start_o = time.time()
+    while shard_queue:
+        i = scheduler.pick(shard_queue)
+        frontier = shard_queue.pop(i)
+        pending.pop(i)
+        hop_log.info("multi dbfs hop shard=%s queue=%d again=%s", i, len(shard_queue), i in visited)
 
         start = time.time()
-        #ins, exs = s[i].bfs_trees_with_remote_nodes(ns, num_shards)   #{}, [(p, {}), (q, {}), ..]
-        ins, exs = s[i].bfs_trees_with_remote_nodes(ns)   #{}, [(p, {}), (q, {}), ..]
+        try:
+            with registry.lock.read():
+                ins, exs = s[i].bfs_trees_with_remote_nodes_multi(mask_groups(frontier.items()))
+        except requests.RequestException:
+            if unavailable is None:
+                raise
+            # the nodes behind shard i are left out, each query goes on without its own
+            for mask in frontier.values():
+                for q in mask_queries(mask):
+                    lost = unavailable.setdefault(q, dict())
+                    lost[i] = lost.get(i, 0) + 1
+            continue
         end = time.time()
+        num_calls += 1
         time_spent_inside_shards_in_seconds += end - start
         time_spent_outside_shards_in_seconds -= end - start
+        scheduler.called(i, end - start)
+
+        # Action 1: the internal nodes visited, per query
+        seen = visited.setdefault(i, dict())
+        for mask, nodes in ins:
+            for n in nodes:
+                seen[n] = seen.get(n, 0) | mask
+
+        # Action 2: queue the remote nodes reached, for the queries that have not 
+        # visited them yet. A query new to the shard's queue entry is a cross-cut.
+        for ss, groups in exs:
+            seen_ss = visited.get(ss, dict())
+            entry = shard_queue.get(ss)
+            added = 0
+            for mask, nodes in groups:
+                for n in nodes:
+                    new = mask & ~seen_ss.get(n, 0)
+                    if new:
+                        if entry is None:
+                            entry = shard_queue[ss] = dict()
+                        entry[n] = entry.get(n, 0) | new
+                        added |= new
+            if added:
+                if ss in pending:
+                    scheduler.merged(ss)
+                else:
+                    scheduler.enqueued(ss)
+                for q in mask_queries(added & ~pending.get(ss, 0)):
+                    cross_cuts[q] += 1
+                pending[ss] = pending.get(ss, 0) | added
 
-        # debugging
         if verbose:
-            print("   BFS: internal nodes traversed: " + str(ins))
-            print("   BFS: Need to additionally traverse following shards and their nodes: " + str(exs))
-            print("        On these shards, only the following new nodes need to be visited:")
-            for ex in exs:
-                shard, nodes = ex
+            log.debug("multi dbfs queue=%s", {k: len(v) for k, v in shard_queue.items()})
+
+    # nodes visited per query, off the distinct masks
+    masks = collections.Counter()
+    for seen in visited.values():
+        masks.update(seen.values())
+    num_nodes_visited = [0] * num_queries
+    for mask, count in masks.items():
+        for q in mask_queries(mask):
+            num_nodes_visited[q] += count
 
-                if shard in traversed_nodes:
-                    print("        On shard " + str(shard) +": Nodes " + str(set(nodes) - traversed_nodes[shard]))
+    end_o = time.time()
+    time_spent_outside_shards_in_seconds += end_o - start_o
+    return cross_cuts, num_nodes_visited, num_calls, time_spent_inside_shards_in_seconds, time_spent_outside_shards_in_seconds
+
+
+#####################################################
+### Shard queue policies
+###
+### Which shard dbfs() takes off its queue next, and
+### combined_dbfs() off the shards of a level. FIFO
+### is the order the shards were queued in. Largest
+### frontier first gets the most nodes per call done.
+### Most contributions first takes the shard the most
+### frontiers have been merged into since it was 
+### queued. Latency-aware puts the shards with slow 
+### calls last, so that more frontiers merge into 
+### their entries in the meantime and they are called
+### less often. Call times are kept per fleet as a 
+### moving average, across DBFS runs, whatever the
+### policy. Ties always go first in, first out.
+#####################################################
+class QueuePolicy:
+    name = 'fifo'
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+
+    def pick(self, shard_queue):
+        return firstkey(shard_queue)
+
+    def enqueued(self, shard):
+        pass
+
+    def merged(self, shard):
+        pass
+
+    def called(self, shard, seconds):
+        latency = self.fleet.latency
+        latency[shard] = seconds if shard not in latency else 0.8 * latency[shard] + 0.2 * seconds
+
+class LargestFrontierPolicy(QueuePolicy):
+    name = 'largest'
+
+    def pick(self, shard_queue):
+        return max(shard_queue, key=lambda q: len(shard_queue[q]))
+
+class MostContributionsPolicy(QueuePolicy):
+    name = 'contributions'
+
+    def __init__(self, fleet):
+        QueuePolicy.__init__(self, fleet)
+        self.contributions = dict()
+
+    def enqueued(self, shard):
+        self.contributions[shard] = 1
+
+    def merged(self, shard):
+        self.contributions[shard] += 1
+
+    def pick(self, shard_queue):
+        return max(shard_queue, key=lambda q: self.contributions[q])
+
+class LatencyAwarePolicy(QueuePolicy):
+    name = 'latency'
+
+    # shards not called yet go first, to learn their latency
+    def pick(self, shard_queue):
+        latency = self.fleet.latency
+        return min(shard_queue, key=lambda q: latency.get(q, 0.))
+
+queue_policies = {'fifo': QueuePolicy, 'largest': LargestFrontierPolicy, 'contributions': MostContributionsPolicy, 'latency': LatencyAwarePolicy}
+
+# Runs the DBFS once per policy, runs times each. Returns, per policy, the cross-cuts
+# and nodes visited, and the average wall time and time spent in the shards.
+def dbfs_policies(begin_shard, policies, runs=1, verbose=False, fleet=None):
+    if fleet is None:
+        fleet = registry.current()
+    results = collections.OrderedDict()
+    for policy in policies:
+        wall = inside = 0.
+        for run in range(runs):
+            start = time.time()
+            cross_cuts, num_nodes_visited, time_in, time_out = dbfs(begin_shard, verbose, fleet, policy=policy)
+            wall += time.time() - start
+            inside += time_in
+        results[policy] = {'cross_cuts': cross_cuts, 'visited': num_nodes_visited,
+                           'wall_seconds': round(wall / runs, 6), 'bfs_seconds': round(inside / runs, 6)}
+    return results
+
+
+# Level-synchronous DBFS with a combiner: the frontiers the shards of a level emit
+# are buffered per target shard until the level completes, and each target shard
+# then gets one merged request in the next level. Within a level, the shards go in
+# the order policy picks them (see queue_policies), and a frontier for a shard still
+# waiting in the level joins its request, for no extra cross-cut. A heuristic: it
+# usually takes fewer cross-cuts than dbfs(), but not always, as a shard reached
+# early in a level waits for the level to end instead of taking in the frontiers 
+# of the shards after it. Returns the same as dbfs(). unavailable: as in dbfs().
+def combined_dbfs(begin_shard, verbose=False, fleet=None, counts_only=False, unavailable=None, policy='fifo'):
+
+    if fleet is None:
+        fleet = registry.current()
+    s = fleet.shards
+    if not s:
+        log.warning("Whoah! Graph has not been initialized yet!")
+        return 0,0,0,0
+
+    time_spent_inside_shards_in_seconds = 0.
+    traversed_nodes = dict()
+    sid = session_id()
+    asked = set()   # the shards with a counts-only session
+    num_nodes_counted = 0
+    num_levels = 0
+
+    # the first shard call is not a cross-cut
+    total_cross_cuts_required = -1
+    level = {begin_shard: NodeSet([s[begin_shard].node_center()[0]])}
+    scheduler = queue_policies[policy](fleet)
+    scheduler.enqueued(begin_shard)
+
+    start_o = time.time()
+    try:
+        while level:
+            next_level = dict()
+            while level:
+                i = scheduler.pick(level)
+                ns = level.pop(i)
+                total_cross_cuts_required += 1
+                hop_log.info("combined dbfs hop level=%d shard=%s again=%s", num_levels, i, i in traversed_nodes)
+
+                start = time.time()
+                try:
+                    with registry.lock.read():
+                        if counts_only:
+                            asked.add(i)
+                            count, exs, ins = s[i].bfs_count_with_remote_nodes(sid, ns)   #n, [(p, {}), (q, {}), ..], {anchors}
+                            num_nodes_counted += count
+                        else:
+                            ins, exs = s[i].bfs_trees_with_remote_nodes(ns)   #{}, [(p, {}), (q, {}), ..]
+                except requests.RequestException:
+                    if unavailable is None:
+                        raise
+                    # the nodes behind shard i are left out, the DBFS goes on without them
+                    unavailable[i] = unavailable.get(i, 0) + len(ns)
+                    continue
+                time_spent_inside_shards_in_seconds += time.time() - start
+                scheduler.called(i, time.time() - start)
+
+                if i in traversed_nodes:
+                    traversed_nodes[i].update(ins)
                 else:
-                    print("        On shard " + str(shard) +": Nodes " + str(nodes))
-            print("        ---------")
+                    traversed_nodes[i] = NodeSet(ins)
+
+                # combine the frontiers per target shard
+                for ss, nns in exs:
+                    real_nns = NodeSet(nns) - traversed_nodes[ss] if ss in traversed_nodes else NodeSet(nns)
+                    if not real_nns:
+                        continue
+                    if ss in level:
+                        level[ss].update(real_nns)
+                        scheduler.merged(ss)
+                    elif ss in next_level:
+                        next_level[ss].update(real_nns)
+                        scheduler.merged(ss)
+                    else:
+                        next_level[ss] = real_nns
+                        scheduler.enqueued(ss)
 
+            if verbose:
+                log.debug("combined dbfs level=%d next=%s", num_levels, sorted(next_level))
+            level = next_level
+            num_levels += 1
+    finally:
+        # the shards' counts-only sessions are ended also when the DBFS fails
+        if counts_only:
+            for i in asked:
+                end_session(s, i, sid)
+
+    if counts_only:
+        num_nodes_visited = num_nodes_counted
+    else:
+        num_nodes_visited = sum(len(traversed_nodes[i]) for i in traversed_nodes)
+    if verbose:
+        log.debug("combined dbfs levels=%d", num_levels)
 
-        # Action 1: Add internal nodes to the visited nodes per shard
-        if i in traversed_nodes:
-            traversed_nodes[i].update(set(ins)) # automatically discards duplicates
-        else:
-            traversed_nodes[i] = set(ins)
+    time_spent_outside_shards_in_seconds = time.time() - start_o - time_spent_inside_shards_in_seconds
+    return total_cross_cuts_required, num_nodes_visited, time_spent_inside_shards_in_seconds, time_spent_outside_shards_in_seconds
+	
 
+#####################################################
+### Speculative DBFS
+###
+### While dbfs() waits on shard i, the next shards on
+### its queue are known, and so are the nodes to ask
+### them for. So their BFS is started right away, up
+### to width of them in flight besides shard i. By the
+### time a shard comes off the queue its pending nodes
+### may have grown: the BFS of the nodes added in the
+### meantime is then run as well, and merged in (a 
+### BFS from several sources is the union of their
+### BFSes). Shards next to i (see Fleet.neigh) that 
+### are likely to be asked next get a warm-up call, 
+### if they take one (see dShard.warm_up()). Cross-
+### cuts are counted as in dbfs(). Wasted work: the 
+### extra calls for grown frontiers, and the warm-ups
+### of shards the DBFS never asked anything.
+#####################################################
+class Speculation:
+    def __init__(self, shard, nodes):
+        self.nodes = NodeSet(nodes)
+        self.result = None
+        self.error = None
+        self.seconds = 0.
+        self.thread = threading.Thread(target=self.run, args=(shard,), name="nxg-speculation", daemon=True)
+        self.thread.start()
+
+    def run(self, shard):
+        start = time.time()
+        try:
+            with registry.lock.read():
+                self.result = shard.bfs_trees_with_remote_nodes(self.nodes)
+        except Exception as e:
+            self.error = e
+        self.seconds = time.time() - start
+
+    # returns the seconds waited for the result
+    def wait(self):
+        start = time.time()
+        self.thread.join()
+        return time.time() - start
 
-        # Action 2: if an external node that needs to be traversed hasn't 
-        # already been traversed, schedule it for traversal and
-        # increment the number of cross-cuts if that node hadn't
-        # already been previously scheduled for traversal
-        for ex in exs:      #[(p, {}), (q, {}), ..]
-            (ss, nns) = ex  #(p, {})
-			
-			# nodes that have not already been traversed:
-            real_nns = set(nns) - traversed_nodes[ss] if ss in traversed_nodes else set(nns)
+def warm_up(shard):
+    try:
+        shard.warm_up()
+    except Exception:
+        log.debug("warm-up failed", exc_info=True)
+
+# the next width shards policy would pick off the queue, as it stands
+def upcoming(scheduler, shard_queue, width):
+    rest = dict(shard_queue)
+    picks = []
+    while rest and len(picks) < width:
+        q = scheduler.pick(rest)
+        del rest[q]
+        picks.append(q)
+    return picks
+
+# Same as dbfs(), plus the speculation stats. unavailable, policy: as in dbfs(). 
+# The shards speculated on are the next ones policy would pick.
+def speculative_dbfs(begin_shard, verbose=False, fleet=None, width=2, unavailable=None, policy='fifo'):
+
+    if fleet is None:
+        fleet = registry.current()
+    s = fleet.shards
+    if not s:
+        log.warning("Whoah! Graph has not been initialized yet!")
+        return 0,0,0,0,dict()
 
-            # if non-empty
-            if real_nns:
-                if ss in shard_queue:
+    time_spent_inside_shards_in_seconds = 0.
+    traversed_nodes = dict()
+    shard_queue = dict()
+    speculations = dict()   # shard -> Speculation for its queue entry
+    warmed = set()
+    called = set()
+    stats = {'speculative_calls': 0, 'hits': 0, 'extra_calls': 0, 'warm_ups': 0, 'saved_seconds': 0.}
 
-                    # Shard ss is already spooled in the queue.
-                    # Find queue entry and add the additional nodes to be visited only if they have not already been visited
-                    # Note no new cross-cuts required at all, piggy-backing on already scheduled ones!
-                    shard_queue[ss].update(real_nns)
+    total_cross_cuts_required = 0
+    shard_queue[begin_shard] = NodeSet([s[begin_shard].node_center()[0]])
+    scheduler = queue_policies[policy](fleet)
+    scheduler.enqueued(begin_shard)
 
+    start_o = time.time()
+    while shard_queue:
+        i = scheduler.pick(shard_queue)
+        ns = shard_queue.pop(i)
+        hop_log.info("speculative dbfs hop shard=%s queue=%d again=%s speculated=%s", i, len(shard_queue), i in traversed_nodes, i in speculations)
+
+        # the next shards on the queue get going now, while shard i runs
+        for q in upcoming(scheduler, shard_queue, width):
+            if q not in speculations:
+                speculations[q] = Speculation(s[q], shard_queue[q])
+                stats['speculative_calls'] += 1
+        for q in fleet.neigh.get(i, ()):
+            if q not in traversed_nodes and q not in shard_queue and q not in warmed and hasattr(s[q], 'warm_up'):
+                warmed.add(q)
+                stats['warm_ups'] += 1
+                threading.Thread(target=warm_up, args=(s[q],), daemon=True).start()
+        called.add(i)
+
+        start = time.time()
+        speculation = speculations.pop(i, None)
+        try:
+            if speculation is None:
+                with registry.lock.read():
+                    ins, exs = s[i].bfs_trees_with_remote_nodes(ns)
+            else:
+                # not under the lock: the speculation takes it itself
+                waited = speculation.wait()
+                if speculation.error is not None:
+                    raise speculation.error
+                stats['saved_seconds'] += max(0., speculation.seconds - waited)
+                ins, exs = speculation.result
+                grown = ns - speculation.nodes
+                if grown:
+                    stats['extra_calls'] += 1
+                    with registry.lock.read():
+                        more_ins, more_exs = s[i].bfs_trees_with_remote_nodes(grown)
+                    ins = list(ins) + list(more_ins)
+                    exs = list(exs) + list(more_exs)
                 else:
+                    stats['hits'] += 1
+        except requests.RequestException:
+            if unavailable is None:
+                raise
+            # the nodes behind shard i are left out, the DBFS goes on without them
+            unavailable[i] = unavailable.get(i, 0) + len(ns)
+            continue
+        time_spent_inside_shards_in_seconds += time.time() - start
+        scheduler.called(i, time.time() - start)
+
+        if i in traversed_nodes:
+            traversed_nodes[i].update(ins)
+        else:
+            traversed_nodes[i] = NodeSet(ins)
 
-                    # need new entry in shard queue, need to increment cross-cuts
+        for ss, nns in exs:
+            real_nns = NodeSet(nns) - traversed_nodes[ss] if ss in traversed_nodes else NodeSet(nns)
+            if real_nns:
+                if ss in shard_queue:
+                    shard_queue[ss].update(real_nns)
+                    scheduler.merged(ss)
+                else:
                     shard_queue[ss] = real_nns
+                    scheduler.enqueued(ss)
                     total_cross_cuts_required += 1
-                    cross_cuts_per_shard[ss] = cross_cuts_per_shard[ss] + 1 if ss in cross_cuts_per_shard else 1
 
-        # debugging
         if verbose:
-            print("        shard queue = " + str(shard_queue))
-            print()
-            
-            # If i don't do this I may exceed the allowed data rate and crash the hotebook!
-            time.sleep(0.1)
-            
-        #debugging_p = False
-	
+            log.debug("speculative dbfs queue=%s in flight=%s", sorted(shard_queue), sorted(speculations))
+
+    num_nodes_visited = sum(len(traversed_nodes[i]) for i in traversed_nodes)
+    stats['wasted_warm_ups'] = len(warmed - called)
+    stats['saved_seconds'] = round(stats['saved_seconds'], 6)
+    log.info("speculative dbfs: %s", stats)
+
+    time_spent_outside_shards_in_seconds = time.time() - start_o - time_spent_inside_shards_in_seconds
+    return total_cross_cuts_required, num_nodes_visited, time_spent_inside_shards_in_seconds, time_spent_outside_shards_in_seconds, stats
+
+
+#####################################################
+### summary graph, for coordinator-side DBFS planning
+###
+### One vertex per (shard, component), weighted by the
+### component's number of internal nodes, and an edge
+### wherever a component borders on a remote node of
+### another shard's component. Built once per fleet,
+### with one summary() call per shard, and built again
+### after the fleet has been changed through the
+### helpers above. Reachability, node counts and the 
+### shards a DBFS has to visit are then computed here,
+### without calling any shard.
+#####################################################
+class SummaryGraph:
+    def __init__(self, fleet):
+        self.version = dict()     # p -> version of shard p summarized
+        self.count = dict()       # (p, cid) -> number of internal nodes
+        self.sample = dict()      # (p, cid) -> a node of the component
+        self.adj = dict()         # (p, cid) -> {(q, cid), ..}
+        self.center = dict()      # p -> (p, cid) of p's center node, or None
+        self.anchor = dict()      # p -> {node: cid}
+        borders = []
+
+        start = time.time()
+        for p, shard in enumerate(fleet.shards):
+            summary = shard.summary()
+            self.version[p] = summary.get('version')
+            for cid, count, node in summary['components']:
+                self.count[(p, cid)] = count
+                self.sample[(p, cid)] = node
+                self.adj[(p, cid)] = set()
+            self.anchor[p] = dict((ni, cid) for ni, cid in summary['anchors'])
+            center, cid = summary['center']
+            self.center[p] = None if cid is None else (p, cid)
+            for cid, q, ne in summary['boundary']:
+                borders.append(((p, cid), q, ne))
+
+        # the mirror of every cross-cut is there as well, so one direction will do
+        for u, q, ne in borders:
+            cid = self.anchor.get(q, dict()).get(ne)
+            if cid is not None:
+                self.adj[u].add((q, cid))
+        self.build_seconds = time.time() - start
+        log.info("summary graph: %d shards, %d vertices, %d borders, built in %s s", fleet.num_shards(), len(self.count), len(borders), self.build_seconds)
+
+    # the (shard, component) vertices reachable from shard begin_shard's center node
+    def reach(self, begin_shard):
+        begin = self.center.get(begin_shard)
+        if begin is None:
+            return []
+        visited = {begin}
+        frontier = collections.deque([begin])
+        order = []
+        while frontier:
+            u = frontier.popleft()
+            order.append(u)
+            for v in self.adj[u]:
+                if v not in visited:
+                    visited.add(v)
+                    frontier.append(v)
+        return order
+
+    # A DBFS from begin_shard, planned: the nodes it visits, the shards it has 
+    # to visit, and a lower bound on the cross-cuts (every shard but the first
+    # one has to be entered at least once).
+    def plan(self, begin_shard):
+        reached = self.reach(begin_shard)
+        shards = []
+        for p, cid in reached:
+            if p not in shards:
+                shards.append(p)
+        return reached, shards, max(0, len(shards) - 1), sum(self.count[v] for v in reached)
+
+def fleet_summary(fleet, rebuild=False):
+    if rebuild or fleet.summary is None:
+        with registry.lock.read():
+            fleet.summary = SummaryGraph(fleet)
+    return fleet.summary
+
+# DBFS off the summary graph. With counts_only, no shard is called at all.
+# Otherwise each shard on the plan is called once, with one node per reached
+# component as sources, instead of once per cross-cut the plain dbfs() takes. 
+# Returns the same as dbfs().
+def summary_dbfs(begin_shard, verbose=False, fleet=None, counts_only=False):
+    if fleet is None:
+        fleet = registry.current()
+    s = fleet.shards
+    if not s:
+        log.warning("Whoah! Graph has not been initialized yet!")
+        return 0,0,0,0
+
+    time_spent_inside_shards_in_seconds = 0.
+    start_o = time.time()
+    summary = fleet_summary(fleet)
+    reached, shards, cross_cuts, num_nodes_visited = summary.plan(begin_shard)
     if verbose:
-        num_shards = nshards_as_list[0]
-        for i in range(0, num_shards):
-            if i not in traversed_nodes:
-                print("        fyi, shard " + str(i) + " was never visited!")
-				
-    # num nodes visited
-    num_nodes_visited = sum(
-        [len(traversed_nodes[i]) for i in traversed_nodes]
-    )
-    
-    end_o = time.time()
-    time_spent_outside_shards_in_seconds += end_o - start_o	
-    return total_cross_cuts_required, num_nodes_visited, time_spent_inside_shards_in_seconds, time_spent_outside_shards_in_seconds
-	
+        log.debug("summary dbfs plan shards=%s cross_cuts=%d visited=%d", shards, cross_cuts, num_nodes_visited)
+
+    if not counts_only:
+        sources = dict()
+        for p, cid in reached:
+            sources.setdefault(p, []).append(summary.sample[(p, cid)])
+        num_nodes_visited = 0
+        for p in shards:
+            start = time.time()
+            with registry.lock.read():
+                ins, exs = s[p].bfs_trees_with_remote_nodes(sources[p])
+            time_spent_inside_shards_in_seconds += time.time() - start
+            num_nodes_visited += len(ins)
+            if verbose:
+                log.debug("summary dbfs shard=%s internal=%s", p, ins)
+
+    time_spent_outside_shards_in_seconds = time.time() - start_o - time_spent_inside_shards_in_seconds
+    return cross_cuts, num_nodes_visited, time_spent_inside_shards_in_seconds, time_spent_outside_shards_in_seconds
+
+
+#####################################################
+### global connected components
+###
+### Each shard's component index already is the local
+### union-find: the coordinator merges its components
+### over the boundary proxies (the summary graph's 
+### edges) with a union-find of (shard, component)
+### vertices, then labels every shard's components 
+### with their global component id, the smallest
+### shard * 2**32 + cid of the global component. A 
+### DBFS then is the global component of the begin
+### node: its size, and the shards it spans.
+#####################################################
+class UnionFind:
+    def __init__(self):
+        self.parent = dict()
+        self.size = dict()
+
+    def find(self, x):
+        parent = self.parent
+        if x not in parent:
+            parent[x] = x
+            self.size[x] = 1
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]   # path halving
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return a
+
+class GlobalComponents:
+    def __init__(self, fleet, summary):
+        self.of = dict()       # (p, cid) -> gid
+        self.size = dict()     # gid -> number of internal nodes
+        self.shards = dict()   # gid -> shards spanned
+        self.stale = []        # shards that changed since summarized, not labelled
+
+        start = time.time()
+        uf = UnionFind()
+        for u in summary.count:
+            uf.find(u)
+            for v in summary.adj[u]:
+                uf.union(u, v)
+        gids = dict()
+        for u in summary.count:
+            root = uf.find(u)
+            gid = (u[0] << 32) + u[1]
+            if root not in gids or gid < gids[root]:
+                gids[root] = gid
+        labels = dict()
+        for u in summary.count:
+            p, cid = u
+            gid = gids[uf.find(u)]
+            self.of[u] = gid
+            self.size[gid] = self.size.get(gid, 0) + summary.count[u]
+            self.shards.setdefault(gid, set()).add(p)
+            labels.setdefault(p, []).append((cid, gid))
+
+        # store the labels on the shards
+        for p, shard in enumerate(fleet.shards):
+            if not shard.label_components(summary.version[p], labels.get(p, [])):
+                self.stale.append(p)
+        self.build_seconds = time.time() - start
+        if self.stale:
+            log.warning("global components: shards %s changed since summarized, not labelled", self.stale)
+        log.info("global components: %d components over %d shards, labelled in %s s", len(self.size), fleet.num_shards(), self.build_seconds)
+
+    # the global component of p's node, or of p's center node, None if unknown
+    def component(self, summary, p, node=None):
+        if node is None:
+            u = summary.center.get(p)
+        else:
+            cid = summary.anchor.get(p, dict()).get(node)
+            u = None if cid is None else (p, cid)
+        return None if u is None else self.of.get(u)
+
+def fleet_components(fleet, rebuild=False):
+    if rebuild or fleet.components is None:
+        summary = fleet_summary(fleet, rebuild)
+        with registry.lock.read():
+            fleet.components = GlobalComponents(fleet, summary)
+    return fleet.components
+
+# DBFS from begin_shard's center node, answered from the global components: the
+# number of nodes visited and the shards visited, never visited, without any
+# traversal. With check, a plain dbfs() is run as well and must agree.
+# Returns the global component id, the number of nodes visited, the shards 
+# visited, the shards never visited, and whether the check passed (None if not checked).
+def components_dbfs(begin_shard, verbose=False, fleet=None, check=False):
+    if fleet is None:
+        fleet = registry.current()
+    components = fleet_components(fleet)
+    gid = components.component(fleet.summary, begin_shard)
+    num_nodes_visited = components.size.get(gid, 0)
+    shards = sorted(components.shards.get(gid, set()))
+    never_visited = [p for p in range(fleet.num_shards()) if p not in shards]
+    if verbose:
+        log.debug("components dbfs gid=%s visited=%d shards=%s never visited=%s", gid, num_nodes_visited, shards, never_visited)
+
+    agrees = None
+    if check:
+        cross_cuts, num_nodes_traversed, time_in, time_out = dbfs(begin_shard, verbose, fleet)
+        agrees = num_nodes_traversed == num_nodes_visited
+        if not agrees:
+            log.warning("components dbfs: %d nodes from the labels, %d traversed", num_nodes_visited, num_nodes_traversed)
+    return gid, num_nodes_visited, shards, never_visited, agrees
+
+
+#####################################################
+### k-hop halos ("ghost" replicas)
+###
+### Each shard of a local fleet can keep a read-only
+### copy of the remote nodes within k hops of its 
+### boundary, with their edges, including their own
+### cross-cuts to further shards. The BFS on the shard
+### (see Shard.bfs_trees_with_halo()) then goes on 
+### through the halo instead of stopping at the 
+### proxies, and only the remote nodes on the halo's
+### border and beyond it need a cross-cut. A node of
+### the halo is only expanded if all its neighbors
+### are in the halo or in the shard, the others are 
+### on the border. Replication against network: the 
+### halos cost memory and a sync every time the graph
+### changes, and save the cross-cuts they absorb.
+#####################################################
+class Halos:
+    def __init__(self, fleet, k):
+        self.k = k
+        self.nodes = dict()     # p -> number of remote nodes replicated
+        self.edges = dict()     # p -> number of their edges replicated
+        self.bytes = dict()     # p -> size of the halo shipped to shard p
+
+        start = time.time()
+        neighbors = dict()
+        def neighbors_of(key):
+            if key not in neighbors:
+                q, n = key
+                shard = fleet.shards[q]
+                neighbors[key] = [shard.boundary[t][:2] if t in shard.boundary else (q, t) for t in shard.g.adj[n]]
+            return neighbors[key]
+
+        for p, shard in enumerate(fleet.shards):
+            # the remote nodes the proxies point to are 1 hop away
+            depth = dict()
+            frontier = collections.deque()
+            for q, ne, d in shard.boundary.values():
+                if q != p and (q, ne) not in depth:
+                    depth[(q, ne)] = 1
+                    frontier.append((q, ne))
+            while frontier:
+                key = frontier.popleft()
+                if depth[key] < k:
+                    for nb in neighbors_of(key):
+                        if nb[0] != p and nb not in depth:
+                            depth[nb] = depth[key] + 1
+                            frontier.append(nb)
+
+            halo = dict()
+            border = set()
+            for key in depth:
+                nbs = neighbors_of(key)
+                if all(nb[0] == p or nb in depth for nb in nbs):
+                    halo[key] = [tuple(nb) for nb in nbs]
+                else:
+                    border.add(key)
+            shard.set_halo(k, halo, border)
+            self.nodes[p] = len(depth)
+            self.edges[p] = sum(len(nbs) for nbs in halo.values())
+            self.bytes[p] = wire_size([list(halo.items()), list(border)])
+        self.build_seconds = time.time() - start
+        log.info("halos: k=%d, %d remote nodes and %d edges replicated, %d bytes, built in %s s",
+                 k, sum(self.nodes.values()), sum(self.edges.values()), sum(self.bytes.values()), self.build_seconds)
+
+    def stats(self):
+        return {'k': self.k, 'nodes': sum(self.nodes.values()), 'edges': sum(self.edges.values()),
+                'bytes': sum(self.bytes.values()), 'sync_seconds': round(self.build_seconds, 6),
+                'max_nodes_per_shard': max(self.nodes.values()) if self.nodes else 0}
+
+# the fleet's halos, k hops deep, built if the graph has changed since. They are
+# set on the shards, hence the write lock: no BFS is going on meanwhile.
+def fleet_halos(fleet, k, rebuild=False):
+    halos = fleet.halos.get(k)
+    if rebuild or halos is None:
+        with registry.lock.write():
+            if rebuild or fleet.halos.get(k) is halos:
+                fleet.halos[k] = Halos(fleet, k)
+            halos = fleet.halos[k]
+    return halos
+
+
+#####################################################
+### distributed shortest path and k-hop queries
+###
+### Same boundary labels and cross-cut accounting as
+### dbfs(), but targeted: every shard call expands a
+### session on the shard from the entries pending for
+### it (see Shard.expand()), always the shard with the
+### smallest pending distance first, Dijkstra-like, so
+### that labels below that distance are final. The
+### shortest path search goes both ways, from the 
+### source and from the target, and stops as soon as
+### the smallest pending distances of both directions
+### add up to the best path found. k-hop stops at 
+### distance k, and a level-aware DBFS does not stop 
+### at all, but only returns the number of nodes per
+### distance. Every shard call but the first one in
+### each direction is a cross-cut.
+#####################################################
+infinity = float('inf')
+
+class Search:
+    def __init__(self, fleet, limit):
+        self.fleet = fleet
+        self.limit = limit
+        self.sid = session_id()
+        self.pending = {'F': dict(), 'B': dict()}   # direction -> shard -> node -> entry
+        self.best = {'F': dict(), 'B': dict()}      # direction -> (shard, node) -> (distance, origin shard, origin node)
+        self.touched = set()
+        self.steps = {'F': 0, 'B': 0}
+        self.calls = 0
+        self.time_in = 0.
+        self.meet = None
+        self.length = infinity
+
+    def push(self, direction, shard, node, dist, oshard, onode):
+        if dist > self.limit:
+            return
+        known = self.best[direction].get((shard, node))
+        if known is None or dist < known[0]:
+            self.best[direction][(shard, node)] = (dist, oshard, onode)
+            self.pending[direction].setdefault(shard, dict())[node] = (node, dist, oshard, onode)
+
+    def min_pending(self, direction):
+        best = (infinity, None)
+        for shard, entries in self.pending[direction].items():
+            for entry in entries.values():
+                if entry[1] < best[0]:
+                    best = (entry[1], shard)
+        return best
+
+    # expands the shard with the smallest pending distance in direction
+    def step(self, direction, shard):
+        entries = list(self.pending[direction].pop(shard).values())
+        other = 'B' if 'F' == direction else 'F'
+        self.touched.add(shard)
+        start = time.time()
+        with registry.lock.read():
+            meet, reached = self.fleet.shards[shard].expand(self.sid, direction, entries, min(self.limit, self.length - 1))
+        self.time_in += time.time() - start
+        self.steps[direction] += 1
+        self.calls += 1
+
+        if meet is not None and meet[0] < self.length:
+            self.length, self.meet = meet[0], (shard, meet[1], None)
+        for q, ne, dist, ni, w in reached:
+            self.push(direction, q, ne, dist, shard, ni)
+            # the other direction may already have crossed the same external edge
+            known = self.best[other].get((shard, ni))
+            if known is not None and dist - w + known[0] < self.length:
+                self.length, self.meet = dist - w + known[0], (shard, ni, other)
+
+    # the nodes from the direction's source to node on shard, as [(shard, node), ..]
+    def path_to(self, direction, shard, node):
+        path = []
+        while shard is not None:
+            nodes, origin = self.fleet.shards[shard].session_path(self.sid, direction, node)
+            path.extend((shard, n) for n in nodes)
+            shard, node = origin if origin is not None else (None, None)
+        path.reverse()
+        return path
+
+    # ends the session on every shard it touched, returns the number of 
+    # nodes reached per shard, per distance: {shard: [(distance, count), ..]}.
+    # A shard that cannot be reached is left out (see end_session()).
+    def end(self):
+        levels = dict()
+        for shard in self.touched:
+            shard_levels = end_session(self.fleet.shards, shard, self.sid)
+            if shard_levels is not None:
+                levels[shard] = shard_levels
+        return levels
+
+def distributed_shortest_path(from_shard, from_node, to_shard, to_node, verbose=False, fleet=None):
+    if fleet is None:
+        fleet = registry.current()
+    search = Search(fleet, infinity)
+    start_o = time.time()
+    try:
+        search.push('F', from_shard, from_node, 0, -1, -1)
+        search.push('B', to_shard, to_node, 0, -1, -1)
+        while True:
+            min_f, shard_f = search.min_pending('F')
+            min_b, shard_b = search.min_pending('B')
+            if min_f + min_b >= search.length and search.length < infinity:
+                break
+            # A direction that has run out has final labels on everything it
+            # can reach, so the other direction would have met it on its first
+            # expansion (at its own source), if the path existed.
+            if shard_f is None and (shard_b is None or search.steps['B']):
+                break
+            if shard_b is None and search.steps['F']:
+                break
+            if shard_b is None or (shard_f is not None and min_f <= min_b):
+                search.step('F', shard_f)
+            else:
+                search.step('B', shard_b)
+            hop_log.info("shortest path hop calls=%d length=%s", search.calls, search.length)
+
+        path = []
+        if search.meet is not None:
+            shard, node, crossed = search.meet
+            if crossed is None:
+                path = search.path_to('F', shard, node) + list(reversed(search.path_to('B', shard, node)))[1:]
+            else:
+                # shard, node is where the crossing direction's label came in through an external edge
+                dist, oshard, onode = search.best[crossed][(shard, node)]
+                near = search.path_to('B' if 'F' == crossed else 'F', shard, node)
+                far = search.path_to(crossed, oshard, onode)
+                path = near + list(reversed(far)) if 'B' == crossed else far + list(reversed(near))
+    finally:
+        search.end()
+
+    time_out = time.time() - start_o - search.time_in
+    if verbose:
+        log.debug("shortest path length=%s path=%s", search.length, path)
+    cross_cuts = max(0, search.calls - 2)
+    return search.length, path, cross_cuts, search.time_in, time_out
+
+# Level-aware DBFS: the BFS depth is carried across shards in the entries, and a
+# shard is only entered again for nodes it can now reach by a shorter distance.
+# Returns the number of nodes per distance from the source, [(distance, count), ..],
+# the number of nodes per shard, the cross-cuts, how many of those were re-entries
+# into an already expanded shard, and the usual times.
+def dbfs_levels(from_shard, from_node, max_depth=infinity, verbose=False, fleet=None):
+    if fleet is None:
+        fleet = registry.current()
+    search = Search(fleet, max_depth)
+    start_o = time.time()
+    try:
+        search.push('F', from_shard, from_node, 0, -1, -1)
+        while True:
+            min_f, shard_f = search.min_pending('F')
+            if shard_f is None:
+                break
+            search.step('F', shard_f)
+            hop_log.info("dbfs levels hop shard=%s distance=%s calls=%d", shard_f, min_f, search.calls)
+    finally:
+        levels_per_shard = search.end()
+
+    levels = collections.Counter()
+    counts = dict()
+    for shard, shard_levels in levels_per_shard.items():
+        counts[shard] = 0
+        for dist, count in shard_levels:
+            levels[dist] += count
+            counts[shard] += count
+
+    time_out = time.time() - start_o - search.time_in
+    if verbose:
+        log.debug("dbfs levels nodes per shard=%s levels=%s", counts, sorted(levels.items()))
+    cross_cuts = max(0, search.calls - 1)
+    reentries = search.calls - len(search.touched)
+    return sorted(levels.items()), counts, cross_cuts, reentries, search.time_in, time_out
+
+def distributed_k_hop(from_shard, from_node, k, verbose=False, fleet=None):
+    levels, counts, cross_cuts, reentries, time_in, time_out = dbfs_levels(from_shard, from_node, k, verbose, fleet)
+    return sum(counts.values()), counts, cross_cuts, time_in, time_out
+
+
+#####################################################
+### Pregel-style supersteps, for iterative analytics
+###
+### Every superstep, each shard is called once: it 
+### takes in the messages for its nodes, runs the 
+### vertex program on all of its internal nodes (see
+### Shard.superstep()), keeps the messages between its
+### own nodes, and returns the messages for remote 
+### nodes, combined per remote node and grouped per 
+### shard. The coordinator hands each shard's batch to
+### the shard's next superstep call, so each batch from
+### shard p to shard q is a cross-cut.
+###
+### A vertex program combines messages to the same 
+### node, updates node values, and aggregates over all
+### nodes (aggregates add up across shards).
+#####################################################
+class PageRank:
+    def __init__(self, params):
+        self.alpha = params.get('alpha', 0.85)
+        self.n = params.get('n', 1)
+        self.dangling = params.get('dangling', 0.)
+
+    def combine(self, a, b):
+        return a + b
+
+    def initial(self, shard, node):
+        return 1. / self.n
+
+    # the rank of nodes without edges goes to all nodes alike
+    def update(self, value, message):
+        return (1. - self.alpha) / self.n + self.alpha * ((message or 0.) + self.dangling / self.n)
+
+    def message(self, old, new, degree):
+        return new / degree if degree else None
+
+    # [sum of rank changes, rank of the nodes without edges]
+    def zero(self):
+        return [0., 0.]
+
+    def aggregate(self, aggregate, old, new, degree):
+        return [aggregate[0] + abs(new - (old or 0.)), aggregate[1] + (0. if degree else new)]
+
+    def converged(self, step, aggregate, num_messages, tolerance):
+        return 0 < step and aggregate[0] < tolerance
+
+    def next_params(self, params, aggregate):
+        params['dangling'] = aggregate[1]
+
+    # [sum of ranks, [(node, rank), ..] top ranks]
+    def result(self, values, top):
+        return list((sum(values.values()), sorted(values.items(), key = lambda e: -e[1])[:top]))
+
+    def merge(self, results, top):
+        total = sum(r[0] for p, r in results)
+        ranks = sorted(((p, n, v) for p, r in results for n, v in r[1]), key = lambda e: -e[2])[:top]
+        return "Sum of ranks: " + str(round(total, 6)) + ". Top ranks (shard, node, rank): " + str([(p, n, round(v, 6)) for p, n, v in ranks]).replace(' ', '')
+
+# Connected components by label propagation: the smallest global node id 
+# (shard * 2**32 + node) wins, and nodes only message when their label changes.
+class ConnectedComponents:
+    def __init__(self, params):
+        pass
+
+    def combine(self, a, b):
+        return min(a, b)
+
+    def initial(self, shard, node):
+        return (shard << 32) + node
+
+    def update(self, value, message):
+        return value if message is None else min(value, message)
+
+    def message(self, old, new, degree):
+        return new if old != new else None
+
+    # [number of labels changed]
+    def zero(self):
+        return [0]
+
+    def aggregate(self, aggregate, old, new, degree):
+        return [aggregate[0] + (old != new)]
+
+    def converged(self, step, aggregate, num_messages, tolerance):
+        return 0 == num_messages
+
+    def next_params(self, params, aggregate):
+        pass
+
+    # [(label, number of nodes), ..]
+    def result(self, values, top):
+        return list(collections.Counter(values.values()).items())
+
+    def merge(self, results, top):
+        sizes = collections.Counter()
+        for p, r in results:
+            for label, count in r:
+                sizes[label] += count
+        largest = sorted(sizes.values(), reverse=True)
+        return "Connected components: " + str(len(largest)) + ". Largest: " + str(largest[:top]).replace(' ', '')
+
+vertex_programs = {'pagerank': PageRank, 'cc': ConnectedComponents}
+
+# Runs vertex program algorithm until it converges, or for max_supersteps. Returns
+# the merged result, whether it converged, and per superstep the cross-cuts
+# (shard to shard message batches), the messages across shards and the bytes of
+# the JSON payloads exchanged with the shards, and the usual times.
+def pregel(algorithm, max_supersteps=30, tolerance=1e-6, top=5, verbose=False, fleet=None):
+    if fleet is None:
+        fleet = registry.current()
+    s = fleet.shards
+    params = {'n': sum(fleet_summary(fleet).count.values())}
+    program = vertex_programs[algorithm](params)
+    sid = session_id()
+    inboxes = dict((p, []) for p in range(len(s)))
+    supersteps = []
+    converged = False
+    time_in = 0.
+    start_o = time.time()
+    try:
+        for step in range(max_supersteps):
+            next_inboxes = dict((p, []) for p in range(len(s)))
+            aggregate = program.zero()
+            cross_cuts = 0
+            num_messages = 0
+            num_bytes = 0
+            num_kept = 0
+            for p in range(len(s)):
+                params['shard'] = p
+                start = time.time()
+                with registry.lock.read():
+                    outbox, shard_aggregate, num_local = s[p].superstep(sid, algorithm, step, inboxes[p], params)
+                time_in += time.time() - start
+                num_bytes += len(j.dumps(inboxes[p])) + len(j.dumps(outbox))
+                for q, messages in outbox:
+                    next_inboxes[q].extend(messages)
+                    cross_cuts += 1
+                    num_messages += len(messages)
+                aggregate = [a + b for a, b in zip(aggregate, shard_aggregate)]
+                num_kept += num_local
+            supersteps.append((step, cross_cuts, num_messages, num_bytes))
+            hop_log.info("pregel %s superstep=%d cross_cuts=%d messages=%d bytes=%d aggregate=%s", algorithm, step, cross_cuts, num_messages, num_bytes, aggregate)
+            inboxes = next_inboxes
+            program.next_params(params, aggregate)
+            if program.converged(step, aggregate, num_messages + num_kept, tolerance):
+                converged = True
+                break
+
+        start = time.time()
+        results = [(p, s[p].superstep_result(sid, algorithm, top)) for p in range(len(s))]
+        time_in += time.time() - start
+    finally:
+        for p in range(len(s)):
+            end_session(s, p, sid)
+
+    time_out = time.time() - start_o - time_in
+    if verbose:
+        log.debug("pregel %s supersteps=%s", algorithm, supersteps)
+    return program.merge(results, top), converged, supersteps, time_in, time_out
+
 
 ###########################################
 ### grow distributed graph on REMOTE shards
 ###
 ### The remote containers need to exist, at
-### the specified IP and ports.
+### the specified IP and ports. The fleet is
+### built privately and only published to the
+### registry once it is complete.
 ###########################################
-def grow_remote_shards(numshards, nodespershard, pedge, farnodes, verbose):	
+def grow_remote_shards(numshards, nodespershard, pedge, farnodes, verbose, ip, ports_start_at):	
     num_shards = numshards
     num_nodes_per_shard = nodespershard
     p_edge_creation = pedge
     num_far_nodes_per_shard = farnodes  #number of nodes in each shard that will be connected to another shard's nodes
 
     # where?	
-    if not IP:
+    if not ip:
         return "Remote IP has not been set!"
-    ip = IP[0]
+    ports = [ports_start_at + i for i in range(0, num_shards)]
+    s = []
+    sfar = []
+    sneigh = dict()
 
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write("Growing remote shards, each one in its own container..")
-        else:
-            print("Growing remote shards, each one in its own container..")
+    log.info("Growing remote shards, each one in its own container..")
 
     # the loop that creates the remote shards			
     for i in range(0, num_shards):
@@ -1044,21 +4056,13 @@ def grow_remote_shards(numshards, nodespershard, pedge, farnodes, verbose):
         sfar.append(curr_shard.most_distant_internal_nodes(num_far_nodes_per_shard)) #..and of their far nodes!
         time.sleep(0.1)
 
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write("Connecting shard neighborhoods..")
-        else:
-            print("Connecting shard neighborhoods..")
+    log.info("Connecting shard neighborhoods..")
 			
     # shard neighborhoods (toroidally wrapped)
     for i in range(0, num_shards):
         sneigh[i] = tw_neigh(i, int(m.sqrt(num_shards)))
 		
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write("Pairing shards' distant nodes..")
-        else:
-            print("Pairing shards' distant nodes..")
+    log.info("Pairing shards' distant nodes..")
 
     # geometric graph is undirected, so external nodes need to be mirrored: a connection from a node on shard p to 
     # a node on shard q needs to be accompanied by a connection from the node on shard q to the node on shard p
@@ -1074,12 +4078,15 @@ def grow_remote_shards(numshards, nodespershard, pedge, farnodes, verbose):
                     s[q].add_edge_external([(n[1], n[0], 1., 1., p, 1)])
                 paired_already.append((p,q))
 
+    # so that the shards can forward frontiers to each other (see PeerNode)
+    peers = [ip + ":" + str(port) for port in ports]
+    for i in range(0, num_shards):
+        s[i].set_peers(i, peers)
+
+    registry.publish('remote', Fleet(s, sfar, sneigh, num_nodes_per_shard, ip, ports_start_at, ports), role="MASTER-SERVER")
+
     comment = "Created " + str(num_shards) + " remote toroidal shards, with " + str(int(num_far_nodes_per_shard * 2)) + " nodes per shard connected to other shards' nodes."
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write(comment)
-        else:
-            print(comment)
+    log.info(comment)
     return comment
 
 
@@ -1091,12 +4098,11 @@ def grow_shards(numshards, nodespershard, pedge, farnodes):
     num_nodes_per_shard = nodespershard
     p_edge_creation = pedge
     num_far_nodes_per_shard = farnodes  #number of nodes in each shard that will be connected to another shard's nodes
+    s = []
+    sfar = []
+    sneigh = dict()
 
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write("Growing local shards`..")
-        else:
-            print("Growing local shards..")
+    log.info("Growing local shards..")
 
     for i in range(0, num_shards):
         # Need to change this since my constructor has changed
@@ -1106,20 +4112,12 @@ def grow_shards(numshards, nodespershard, pedge, farnodes):
         s.append(curr_shard) #we keep track of local shards created..
         sfar.append(curr_shard.most_distant_internal_nodes(num=num_far_nodes_per_shard)) ##..and of their far nodes!
 
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write("Connecting shard neighborhoods..")
-        else:
-            print("Connecting shard neighborhoods..")		
+    log.info("Connecting shard neighborhoods..")
     # shard neighborhoods (toroidally wrapped)
     for i in range(0, num_shards):
         sneigh[i] = tw_neigh(i, int(m.sqrt(num_shards)))
 	
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write("Pairing shards' distant nodes..")
-        else:
-            print("Pairing shards' distant nodes..")
+    log.info("Pairing shards' distant nodes..")
 
     # geometric graph is undirected, so external nodes need to be mirrored: a connection from a node on shard p to 
     # a node on shard q needs to be accompanied by a connection from the node on shard q to the node on shard p
@@ -1135,81 +4133,547 @@ def grow_shards(numshards, nodespershard, pedge, farnodes):
                     s[q].add_edge_external([(n[1], n[0], 1., 1., p, 1)])
                 paired_already.append((p,q))
 
+    registry.publish('local', Fleet(s, sfar, sneigh, num_nodes_per_shard), role="SERVER")
+
     comment = "Created " + str(num_shards) + " local toroidal shards, with " + str(int(num_far_nodes_per_shard * 2)) + " nodes per shard connected to other shards' nodes."
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write(comment)
-        else:
-            print(comment)
+    log.info(comment)
     return comment
 
 
+#############################################
+### incremental changes to a sharded graph
+###
+### For local (Shard) and remote (dShard)
+### fleets alike. Cross-cuts are mirrored: a
+### cross-cut (p, ni, q, ne) is an external
+### edge from node ni on shard p to a copy of
+### node ne, and one from node ne on shard q
+### to a copy of node ni. Local shards are 
+### changed in place, under the registry write
+### lock, in between DBFS hops. Remote shards 
+### change under their own lock: the calls to 
+### them are made outside the registry write 
+### lock, so as not to stall the master, which
+### only takes it to drop the fleet's caches. A
+### change that fails on a shard is undone on 
+### the shards it went through, so that no 
+### cross-cut is left on one side only.
+#############################################
+def change_lock(fleet):
+    if any(isinstance(shard, dShard) for shard in fleet.shards):
+        return contextlib.nullcontext()
+    return registry.lock.write()
+
+# changes shard p with apply(shard, changes) per p -> changes in per_shard, and 
+# if that fails on a remote shard, undoes them with undo(shard, changes)
+def change_shards(fleet, per_shard, apply, undo):
+    s = fleet.shards
+    done = []
+    try:
+        with change_lock(fleet):
+            for p, changes in per_shard.items():
+                apply(s[p], changes)
+                done.append(p)
+    except requests.RequestException:
+        for p in done:
+            try:
+                undo(s[p], per_shard[p])
+            except requests.RequestException as e:
+                log.warning("could not undo the change on shard %s: %s", p, e)
+        raise
+    finally:
+        with registry.lock.write():
+            fleet.changed()
+
+#input: [(p,ni,q,ne), (), ..]
+def add_cross_cuts(fleet, cuts):
+    per_shard = dict()
+    for p, ni, q, ne in cuts:
+        per_shard.setdefault(p, []).append((ni, ne, 1., 1., q, 1))  #(ni, ne, x, y, shard, d)
+        per_shard.setdefault(q, []).append((ne, ni, 1., 1., p, 1))
+    change_shards(fleet, per_shard, lambda shard, nodes_and_pos: shard.add_edge_external(nodes_and_pos),
+                  lambda shard, nodes_and_pos: shard.remove_edge_external([(ni, q, ne) for ni, ne, x, y, q, d in nodes_and_pos]))
+    return "added " + str(len(cuts)) + " cross-cuts."
+
+#input: [(p,ni,q,ne), (), ..]
+def remove_cross_cuts(fleet, cuts):
+    per_shard = dict()
+    for p, ni, q, ne in cuts:
+        per_shard.setdefault(p, []).append((ni, q, ne))  #(ni, shard, ne)
+        per_shard.setdefault(q, []).append((ne, p, ni))
+    change_shards(fleet, per_shard, lambda shard, shard_cuts: shard.remove_edge_external(shard_cuts),
+                  lambda shard, shard_cuts: shard.add_edge_external([(ni, ne, 1., 1., q, 1) for ni, q, ne in shard_cuts]))
+    return "removed " + str(len(cuts)) + " cross-cuts."
+
+# Removes nodes from shard p, and the mirrors of their cross-cuts from the other 
+# shards. Removed nodes cannot be put back: the mirrors on a shard that fails are
+# left there, pointing to nothing, and the shard is reported. 
+def remove_shard_nodes(fleet, p, node_ids):
+    s = fleet.shards
+    per_shard = dict()
+    failed = []
+    try:
+        with change_lock(fleet):
+            for ni, q, ne in s[p].remove_nodes(node_ids):
+                per_shard.setdefault(q, []).append((ne, p, ni))
+            for q, shard_cuts in per_shard.items():
+                try:
+                    s[q].remove_edge_external(shard_cuts)
+                except requests.RequestException as e:
+                    log.warning("could not remove the cross-cuts to removed nodes of shard %s from shard %s: %s", p, q, e)
+                    failed.append(q)
+    finally:
+        with registry.lock.write():
+            fleet.changed()
+    return "removed " + str(len(node_ids)) + " nodes from shard " + str(p) + ", and their cross-cuts from shards " + str(sorted(q for q in per_shard if q not in failed)) + "." + \
+        (" Could not remove them from shards " + str(sorted(failed)) + "." if failed else "")
+
+# Rewires the fleet: removes 'changes' random cross-cuts, and adds as many new ones
+# between the (current) far nodes of neighboring shards, same as the fleet was grown.
+def churn_cross_cuts(fleet, changes, num_far_nodes_per_shard=16):
+    s = fleet.shards
+    cuts = []
+    for p in range(0, len(s)):
+        for ni, q, ne in s[p].external_edges():
+            if p < q:
+                cuts.append((p, ni, q, ne))
+    removed = sample(cuts, min(changes, len(cuts)))
+    remove_cross_cuts(fleet, removed)
+
+    added = []
+    for _ in range(0, changes):
+        p = choice(range(0, len(s)))
+        q = choice(fleet.neigh[p])
+        ni = choice(s[p].most_distant_internal_nodes(num=num_far_nodes_per_shard))[0]
+        ne = choice(s[q].most_distant_internal_nodes(num=num_far_nodes_per_shard))[0]
+        added.append((p, ni, q, ne))
+    add_cross_cuts(fleet, added)
+    return "removed " + str(len(removed)) + " cross-cuts out of " + str(len(cuts)) + " and added " + str(len(added)) + " new ones."
+
+
 ##################################
 ### dbfs on remotely sharded graph
 ##################################
-def run_ddbfs(begin_shard, verbose=False):
+def run_ddbfs(begin_shard, verbose=False, fleet=None, counts_only=False, combine=False, speculate=0, policy='fifo', partial=False, checkpoint=None):
     #if 0 == len(ports):
     #    oopsie = "remote graph shards have not been created yet!"
     #    print(oopsie)
     #    return oopsie
 
-    num_shards = nshards_as_list[0]
-    num_nodes_per_shard = num_nodes_per_shard_as_list[0]
-    total_cross_cuts_required, num_nodes_visited, time_in, time_out = ddbfs(begin_shard, verbose)
+    if fleet is None:
+        fleet = registry.current()
+    s = fleet.shards
+    num_shards = fleet.num_shards()
+    num_nodes_per_shard = fleet.num_nodes_per_shard
+    unavailable = dict() if partial else None
+    meter = MeteredTransport()
+    wire_bytes = fleet_wire_bytes(fleet)
+    total_cross_cuts_required, num_nodes_visited, time_in, time_out = ddbfs(begin_shard, verbose, linked_fleet(fleet, meter), counts_only, combine, speculate, policy, unavailable, checkpoint)
+    # a run that skipped shards would skew the cost model
+    if not unavailable:
+        cost_model.observe(fleet, meter, meter.calls, fleet_wire_bytes(fleet) - wire_bytes, total_cross_cuts_required, num_nodes_visited, time_in, time_out, remote=True)
 
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write("---> Distributed BFS on remote shard fleet complete!")
-            sys.stderr.write('    ' + str(total_cross_cuts_required) + 
-              ' cross-cuts required for DBFS on ' + str(num_shards) + ' shards starting from shard ' 
-              + str(begin_shard) + ', node ' + str(s[begin_shard].node_center()[0]))
-            sys.stderr.write('    Total number of nodes visited over total number of nodes in the entire graph: ' + 
-              str(num_nodes_visited) + '/' +  str(num_shards * num_nodes_per_shard))
-            sys.stderr.write('    Seconds doing BFS inside shards: ' + str(time_in))
-            sys.stderr.write('    Seconds doing overhead outside shards: ' + str(time_out))
-        else:
-            print("---> Distributed BFS on remote shard fleet complete!")
-            print('    ' + str(total_cross_cuts_required) + 
-              ' cross-cuts required for DBFS on ' + str(num_shards) + ' shards starting from shard ' 
-              + str(begin_shard) + ', node ' + str(s[begin_shard].node_center()[0]))
-            print('    Total number of nodes visited over total number of nodes in the entire graph: ' + 
-              str(num_nodes_visited) + '/' +  str(num_shards * num_nodes_per_shard))
-            print('    Seconds doing BFS inside shards: ' + str(time_in))
-            print('    Seconds doing overhead outside shards: ' + str(time_out))
+    log.info("---> Distributed BFS on remote shard fleet complete! cross_cuts=%d shards=%d begin_shard=%s begin_node=%s visited=%d/%d bfs_seconds=%s overhead_seconds=%s",
+             total_cross_cuts_required, num_shards, begin_shard, s[begin_shard].node_center()[0],
+             num_nodes_visited, num_shards * num_nodes_per_shard, time_in, time_out)
 
-    return "Total cross cuts: " + str(total_cross_cuts_required) + ". Total nodes visited: " + str(num_nodes_visited) + "/" +  str(num_shards * num_nodes_per_shard) + ". Total bfs time: " + str(round(time_in,2)) + " s. Overhead: " + str(round(time_out,2)) + " s."
+    return ("Checkpointed as traversal " + checkpoint.traversal + ". " if checkpoint is not None else "") + \
+        ("Partial result! Unavailable shards (shard: nodes not asked for): " + str(unavailable).replace(' ', '') + ". " if unavailable else "") + \
+        "Total cross cuts: " + str(total_cross_cuts_required) + ". Total nodes visited: " + str(num_nodes_visited) + "/" +  str(num_shards * num_nodes_per_shard) + ". Total bfs time: " + str(round(time_in,2)) + " s. Overhead: " + str(round(time_out,2)) + " s."
 
 
 #################################
 ### dbfs on locally sharded graph
 #################################
-def run_dbfs(begin_shard, verbose=False):
-    total_cross_cuts_required, num_nodes_visited, time_in, time_out = dbfs(begin_shard, verbose)
+def run_dbfs(begin_shard, verbose=False, fleet=None, counts_only=False, combine=False, speculate=0, policy='fifo', checkpoint=None):
+    if fleet is None:
+        fleet = registry.current()
+    meter = MeteredTransport()
+    total_cross_cuts_required, num_nodes_visited, time_in, time_out = dbfs(begin_shard, verbose, linked_fleet(fleet, meter), counts_only, combine, speculate=speculate, policy=policy, checkpoint=checkpoint)
+    cost_model.observe(fleet, meter, meter.calls, 0, total_cross_cuts_required, num_nodes_visited, time_in, time_out)
 
-    num_shards = nshards_as_list[0]
-    num_nodes_per_shard = num_nodes_per_shard_as_list[0]
+    s = fleet.shards
+    num_shards = fleet.num_shards()
+    num_nodes_per_shard = fleet.num_nodes_per_shard
+
+    log.info("---> Distributed BFS on co-located shards complete! cross_cuts=%d shards=%d begin_shard=%s begin_node=%s visited=%d/%d bfs_seconds=%s overhead_seconds=%s",
+             total_cross_cuts_required, num_shards, begin_shard, s[begin_shard].node_center()[0],
+             num_nodes_visited, num_shards * num_nodes_per_shard, time_in, time_out)
+
+    return ("Checkpointed as traversal " + checkpoint.traversal + ". " if checkpoint is not None else "") + \
+        "Total cross cuts: " + str(total_cross_cuts_required) + ". Total nodes visited: " + str(num_nodes_visited) + "/" +  str(num_shards * num_nodes_per_shard) + ". Total bfs time: " + str(round(time_in,2)) + " s. Overhead: " + str(round(time_out,2)) + " s."
+
+
+#####################################################
+### Network emulation
+###
+### A Transport carries every call from the coordinator
+### to a shard, through a Link that stands in for the
+### shard in a fleet (see linked_fleet()). The direct
+### transport only counts calls and bytes. The emulated
+### one also charges each call a round trip, jitter, 
+### the time to push the request and the response 
+### through a bandwidth cap, and a timeout per lost 
+### attempt before the retry. That time is simulated:
+### it is added up, not slept, so that LAN and WAN
+### scenarios can be swept on one machine, and kept
+### apart from the time actually spent in the shards.
+#####################################################
+class Transport:
+    name = 'direct'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.retries = 0
+        self.network_seconds = 0.
+
+    def call(self, method, args):
+        result = method(*args)
+        self.account(wire_size(args), wire_size(result), 0., 0)
+        return result
+
+    def account(self, bytes_out, bytes_in, seconds, retries):
+        with self.lock:
+            self.calls += 1
+            self.bytes_out += bytes_out
+            self.bytes_in += bytes_in
+            self.network_seconds += seconds
+            self.retries += retries
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'bytes_out': self.bytes_out, 'bytes_in': self.bytes_in,
+                    'retries': self.retries, 'network_seconds': round(self.network_seconds, 6)}
+
+    # the round trips of calls calls, and the time to move num_bytes through the
+    # bandwidth cap, as the transport is set up (features of the CostModel)
+    def round_trip_seconds(self, calls):
+        return 0.
+
+    def transfer_seconds(self, num_bytes):
+        return 0.
+
+# Counts the shard calls of a real DBFS run, without emulating anything, and
+# without serializing in-process calls: their bytes are not counted (see fleet_wire_bytes())
+class MeteredTransport(Transport):
+    name = 'measured'
+
+    def call(self, method, args):
+        result = method(*args)
+        self.account(0, 0, 0., 0)
+        return result
+
+class EmulatedTransport(Transport):
+    # rtt, jitter, timeout: seconds. bandwidth: bytes per second, 0 for no cap.
+    # loss: probability an attempt is lost, retried up to retries times. The jitter and
+    # the losses are drawn from a Random seeded with seed, so a sweep can be reproduced.
+    def __init__(self, name, rtt, jitter=0., bandwidth=0, loss=0., retries=8, timeout=None, seed=0):
+        Transport.__init__(self)
+        self.name = name
+        self.rtt = rtt
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.max_retries = retries
+        self.timeout = timeout if timeout is not None else max(4 * rtt, 0.2)
+        self.random = Random(seed)
+
+    def call(self, method, args):
+        bytes_out = wire_size(args)
+        seconds = 0.
+        retries = 0
+        with self.lock:
+            # the request, or its response, got lost: wait it out and resend
+            while 0 < self.loss and self.random.random() < self.loss:
+                if retries == self.max_retries:
+                    self.network_seconds += seconds + self.timeout
+                    self.retries += retries
+                    raise requests.ConnectionError("emulated network (" + self.name + "): call lost " + str(retries + 1) + " times")
+                retries += 1
+                seconds += self.timeout
+            seconds += self.rtt + self.random.uniform(0, self.jitter)
+        result = method(*args)
+        bytes_in = wire_size(result)
+        if 0 < self.bandwidth:
+            seconds += (bytes_out + bytes_in) / self.bandwidth
+        self.account(bytes_out, bytes_in, seconds, retries)
+        return result
+
+    def round_trip_seconds(self, calls):
+        # a lost attempt costs a timeout, and there are loss / (1 - loss) of those per call
+        lost = self.loss / (1. - self.loss) if self.loss < 1 else float(self.max_retries)
+        return calls * (self.rtt + self.jitter / 2. + lost * self.timeout)
+
+    def transfer_seconds(self, num_bytes):
+        return num_bytes / self.bandwidth if 0 < self.bandwidth else 0.
+
+# name -> rtt, jitter (seconds), bandwidth (bytes per second), loss
+network_scenarios = collections.OrderedDict([
+    ('direct', None),
+    ('lan', (0.0002, 0.00005, 1.25e9, 0.)),              # 10 Gb/s, same rack
+    ('datacenter', (0.001, 0.0002, 1.25e8, 0.)),         # 1 Gb/s, across the building
+    ('wan', (0.04, 0.005, 1.25e7, 0.001)),               # 100 Mb/s, across the country
+    ('intercontinental', (0.15, 0.02, 1.25e6, 0.01)),    # 10 Mb/s
+])
+
+def network_transport(name, seed=0):
+    scenario = network_scenarios[name]
+    if scenario is None:
+        return Transport()
+    rtt, jitter, bandwidth, loss = scenario
+    return EmulatedTransport(name, rtt, jitter, bandwidth, loss, seed=seed)
+
+# Bytes on the wire for a call's arguments or result, as JSON (NodeSets as sent, see to_wire())
+def wire_default(o):
+    if isinstance(o, NodeSet):
+        return o.to_wire()
+    return list(o)
+
+def wire_size(o):
+    return len(j.dumps(o, default=wire_default, separators=(',', ':')))
+
+# Stands in for a Shard or a dShard: its method calls go through the transport
+class Link:
+    def __init__(self, shard, transport):
+        self.shard = shard
+        self.transport = transport
+
+    def __getattr__(self, name):
+        attr = getattr(self.shard, name)
+        if not callable(attr):
+            return attr
+        transport = self.transport
+        def call(*args):
+            return transport.call(attr, args)
+        return call
+
+# same fleet, every shard call over transport. The fleet's caches are shared: the
+# shards behind the links are the same.
+def linked_fleet(fleet, transport):
+    linked = fleet.with_shards([Link(shard, transport) for shard in fleet.shards])
+    linked.summary, linked.components, linked.halos, linked.latency = fleet.summary, fleet.components, fleet.halos, fleet.latency
+    return linked
+
+# Bytes the remote shards of fleet have sent and received over HTTP so far, 0 for
+# a local fleet. Other queries running on the fleet meanwhile are counted as well.
+def fleet_wire_bytes(fleet):
+    return sum(shard.wire_bytes() for shard in fleet.shards if isinstance(shard, dShard))
+
+# Runs the DBFS once per transport. Returns, per transport name, what the DBFS
+# returns and the transport's stats, with the total (bfs + network) time.
+def dbfs_network_sweep(begin_shard, transports, verbose=False, fleet=None, counts_only=False, combine=False):
+    if fleet is None:
+        fleet = registry.current()
+    results = collections.OrderedDict()
+    for transport in transports:
+        try:
+            cross_cuts, num_nodes_visited, time_in, time_out = dbfs(begin_shard, verbose, linked_fleet(fleet, transport), counts_only, combine)
+        except requests.ConnectionError as e:
+            log.warning("network sweep %s: %s", transport.name, e)
+            results[transport.name] = dict(transport.stats(), error=str(e))
+            continue
+        stats = transport.stats()
+        results[transport.name] = dict(stats, cross_cuts=cross_cuts, visited=num_nodes_visited,
+                                       bfs_seconds=round(time_in, 6), overhead_seconds=round(time_out, 6),
+                                       total_seconds=round(time_in + time_out + stats['network_seconds'], 6))
+        # every run is a measurement the cost model is checked against, then fit to
+        results[transport.name]['predicted_seconds'] = cost_model.observe(fleet, transport, stats['calls'], stats['bytes_out'] + stats['bytes_in'],
+                                                                          cross_cuts, num_nodes_visited, time_in, time_out + stats['network_seconds'])
+    return results
 
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write("---> Distributed BFS on co-located shards complete!")
-            sys.stderr.write('    ' + str(total_cross_cuts_required) + 
-              ' cross-cuts required for BFS on ' + str(num_shards) + ' shards starting from shard ' 
-              + str(begin_shard) + ', node ' + str(s[begin_shard].node_center()[0]))
-            sys.stderr.write('    Total number of nodes visited over total number of nodes in the entire graph: ' + 
-              str(num_nodes_visited) + '/' +  str(num_shards * num_nodes_per_shard))
-            sys.stderr.write('    Seconds doing BFS inside shards: ' + str(time_in))
-            sys.stderr.write('    Seconds doing overhead outside shards: ' + str(time_out))
-        else:
-            print("---> Distributed BFS on co-located shards complete!")
-            print('    ' + str(total_cross_cuts_required) + 
-              ' cross-cuts required for BFS on ' + str(num_shards) + ' shards starting from shard ' 
-              + str(begin_shard) + ', node ' + str(s[begin_shard].node_center()[0]))
-            print('    Total number of nodes visited over total number of nodes in the entire graph: ' + 
-              str(num_nodes_visited) + '/' +  str(num_shards * num_nodes_per_shard))
-            print('    Seconds doing BFS inside shards: ' + str(time_in))
-            print('    Seconds doing overhead outside shards: ' + str(time_out))
 
-    return "Total cross cuts: " + str(total_cross_cuts_required) + ". Total nodes visited: " + str(num_nodes_visited) + "/" +  str(num_shards * num_nodes_per_shard) + ". Total bfs time: " + str(round(time_in,2)) + " s. Overhead: " + str(round(time_out,2)) + " s."
+#####################################################
+### DBFS cost model
+###
+### Fit from the DBFS runs of the network sweeps, and
+### from the real /do-dbfs and /do-ddbfs runs. The 
+### time inside the shards is per_hop * calls + 
+### per_node * nodes visited. The time outside them, 
+### on the coordinator and the network, is per_call *
+### calls + per_byte * bytes + per_http_call * calls
+### to remote shards + per_round_trip * the round
+### trips + per_transfer * the transfer time, the last
+### two as the transport is set up (see 
+### round_trip_seconds()). All coefficients come from
+### the measured times, by least squares. The workload
+### of an unseen fleet comes from the ratios observed:
+### cross-cuts per shard, calls per cross-cut, share 
+### of the nodes visited, bytes per node visited.
+### Only the last cost_model_runs runs are kept, so
+### that a long-lived server follows the fleet as it
+### changes, in bounded memory. The normal equations
+### are kept as running sums over those runs, so a
+### refit does not go through the runs again.
+#####################################################
+cost_model_runs = int(os.environ.get('NXG_COST_MODEL_RUNS', 256))
+
+class CostModel:
+    inside_features = ('per_hop', 'per_node')
+    outside_features = ('per_call', 'per_byte', 'per_http_call', 'per_round_trip', 'per_transfer')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = collections.deque(maxlen=cost_model_runs)      # dicts, see observe()
+        self.checks = collections.deque(maxlen=cost_model_runs)    # (transport, predicted seconds, measured seconds), out of sample
+        self.coefficients = None
+        self.sums()
+
+    # the normal equations of the runs kept, from scratch
+    def sums(self):
+        self.inside = NormalEquations(len(self.inside_features))
+        self.outside = NormalEquations(len(self.outside_features))
+        self.evicted = 0
+        for run in self.runs:
+            self.inside.add(self.inside_row(run), run['inside'])
+            self.outside.add(self.outside_row(run), run['outside'])
+
+    def clear(self):
+        with self.lock:
+            self.runs.clear()
+            self.checks.clear()
+            self.coefficients = None
+            self.sums()
+
+    # Records a DBFS run over transport (a MeteredTransport for a real run), and
+    # refits. remote: the calls went to remote shards over HTTP. Returns what the
+    # model predicted for the run before it was fit to it, None before the first run.
+    def observe(self, fleet, transport, calls, num_bytes, cross_cuts, visited, inside_seconds, outside_seconds, remote=False):
+        run = {'shards': fleet.num_shards(), 'nodes_per_shard': fleet.num_nodes_per_shard, 'cross_cuts': cross_cuts,
+               'calls': calls, 'bytes': num_bytes, 'visited': visited, 'http_calls': calls if remote else 0,
+               'round_trips': transport.round_trip_seconds(calls), 'transfer': transport.transfer_seconds(num_bytes),
+               'inside': inside_seconds, 'outside': outside_seconds}
+        with self.lock:
+            predicted = None
+            if self.coefficients is not None:
+                predicted = self.seconds(self.inside_row(run), self.inside_features) + self.seconds(self.outside_row(run), self.outside_features)
+                self.checks.append((transport.name, predicted, inside_seconds + outside_seconds))
+            if len(self.runs) == self.runs.maxlen:
+                oldest = self.runs[0]
+                self.inside.add(self.inside_row(oldest), oldest['inside'], -1)
+                self.outside.add(self.outside_row(oldest), oldest['outside'], -1)
+                self.evicted += 1
+            self.runs.append(run)
+            self.inside.add(self.inside_row(run), run['inside'])
+            self.outside.add(self.outside_row(run), run['outside'])
+            # the rounding errors of the subtractions are let go for so long only
+            if self.evicted == self.runs.maxlen:
+                self.sums()
+            self.coefficients = dict(self.fit(self.inside, self.inside_features), **self.fit(self.outside, self.outside_features))
+        return None if predicted is None else round(predicted, 6)
+
+    @staticmethod
+    def inside_row(run):
+        return (run['calls'], run['visited'])
+
+    @staticmethod
+    def outside_row(run):
+        return (run['calls'], run['bytes'], run['http_calls'], run['round_trips'], run['transfer'])
+
+    def seconds(self, row, features):
+        return sum(self.coefficients[f] * x for f, x in zip(features, row))
+
+    # Non-negative least squares, the simple way: a feature that gets a negative
+    # coefficient explains nothing the others don't, so it is dropped and the rest refit.
+    # A feature that is 0 in every run is left out, at 0.
+    @staticmethod
+    def fit(equations, features):
+        coefficients = dict((f, 0.) for f in features)
+        active = [k for k in range(len(features)) if equations.nonzero[k]]
+        while active:
+            x = equations.solve(active)
+            negative = [k for k, v in zip(active, x) if v < 0]
+            if not negative:
+                for k, v in zip(active, x):
+                    coefficients[features[k]] = v
+                return coefficients
+            active.remove(min(negative, key=lambda k: x[active.index(k)]))
+        return coefficients
+
+    def workload(self):
+        runs = self.runs
+        shards = sum(r['shards'] for r in runs)
+        cuts = sum(r['cross_cuts'] for r in runs)
+        nodes = sum(r['shards'] * r['nodes_per_shard'] for r in runs)
+        visited = sum(r['visited'] for r in runs)
+        # the real runs on local shards move no bytes
+        moved = [r for r in runs if r['bytes']]
+        moved_visited = sum(r['visited'] for r in moved)
+        return {'cross_cuts_per_shard': cuts / shards if shards else 0.,
+                'calls_per_cross_cut': sum(r['calls'] for r in runs) / cuts if cuts else 1.,
+                'visited_share': visited / nodes if nodes else 0.,
+                'bytes_per_node': sum(r['bytes'] for r in moved) / moved_visited if moved_visited else 0.}
+
+    # DBFS time on shards shards of nodes_per_shard nodes, over transport, or over
+    # HTTP to remote shards if remote. cross_cuts overrides the estimate, i.e. for
+    # another topology.
+    def predict(self, shards, nodes_per_shard, transport, cross_cuts=None, remote=False):
+        with self.lock:
+            if self.coefficients is None:
+                return None
+            w = self.workload()
+            if cross_cuts is None:
+                cross_cuts = w['cross_cuts_per_shard'] * shards
+            calls = w['calls_per_cross_cut'] * cross_cuts
+            visited = w['visited_share'] * shards * nodes_per_shard
+            num_bytes = w['bytes_per_node'] * visited
+            inside = self.seconds((calls, visited), self.inside_features)
+            outside = self.seconds((calls, num_bytes, calls if remote else 0, transport.round_trip_seconds(calls),
+                                    transport.transfer_seconds(num_bytes)), self.outside_features)
+        return {'cross_cuts': round(cross_cuts, 1), 'calls': round(calls, 1), 'visited': round(visited, 1), 'bytes': round(num_bytes),
+                'bfs_seconds': round(inside, 6), 'outside_seconds': round(outside, 6), 'total_seconds': round(inside + outside, 6)}
+
+    def status(self):
+        with self.lock:
+            errors = [abs(p - m) / m for _, p, m in self.checks if 0 < m]
+            return {'runs': len(self.runs), 'coefficients': self.coefficients,
+                    'workload': self.workload() if self.runs else None,
+                    'checks': len(self.checks),
+                    'mean_relative_error': round(sum(errors) / len(errors), 4) if errors else None}
+
+# The normal equations of a least squares problem as running sums, X'X and X'y,
+# and the number of rows each feature is not 0 in. sign=-1 takes a row out.
+class NormalEquations:
+    def __init__(self, n):
+        self.xtx = [[0.] * n for _ in range(n)]
+        self.xty = [0.] * n
+        self.nonzero = [0] * n
+
+    def add(self, row, y, sign=1):
+        for i, a in enumerate(row):
+            if a:
+                self.nonzero[i] += sign
+                self.xty[i] += sign * a * y
+                xtx = self.xtx[i]
+                for k, b in enumerate(row):
+                    xtx[k] += sign * a * b
+
+    # x minimizing |a x - y| over the features in active
+    def solve(self, active):
+        return solve_normal_equations([[self.xtx[i][k] for k in active] for i in active], [self.xty[i] for i in active])
+
+cost_model = CostModel()
+
+# x solving a'a x = a'y, given a'a and a'y, by Gaussian elimination. A touch of
+# ridge keeps them solvable when runs repeat the same fleet.
+def solve_normal_equations(xtx, xty):
+    n = len(xty)
+    m = [list(row) + [v] for row, v in zip(xtx, xty)]
+    for i in range(n):
+        m[i][i] += 1e-9 * m[i][i] + 1e-300
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda r: abs(m[r][i]))
+        m[i], m[pivot] = m[pivot], m[i]
+        for r in range(i + 1, n):
+            f = m[r][i] / m[i][i]
+            for k in range(i, n + 1):
+                m[r][k] -= f * m[i][k]
+    x = [0.] * n
+    for i in reversed(range(n)):
+        x[i] = (m[i][n] - sum(m[i][k] * x[k] for k in range(i + 1, n))) / m[i][i]
+    return x
 
 
 def is_perfect_square(n):
@@ -1222,20 +4686,321 @@ def is_perfect_square(n):
     return True
 
 
-def clear_all_lists():
-    IP.clear()
-    ports_start.clear()
-    ports.clear()
-    s.clear()
-    sfar.clear()
-    nshards_as_list.clear()
-    num_nodes_per_shard_as_list.clear()
-    for i in range(0, nshards_max):
+#####################################################
+### peer-to-peer DBFS on remote shards
+###
+### No master hop: each CLIENT shard knows its peers'
+### addresses, and forwards the remote nodes it 
+### reaches straight to the shards that own them, so
+### a cross-cut is one network leg instead of two.
+### The shards only report counts to the master.
+###
+### Termination by weight throwing: the master hands
+### a credit of 1 to the begin shard. A shard that 
+### forwards to k peers splits its credit in k + 1
+### equal shares, one per message and one it returns 
+### to the master with its report. Credit is only
+### ever split, never created, so the DBFS is over as
+### soon as the master has all of it back.
+###
+### A master that times out ends the sessions while
+### frontiers may still be on their way. The shards
+### keep a tombstone of the ended queries, and drop
+### their frontiers instead of starting them over.
+#####################################################
+peer_tombstones = 4096
+
+class PeerNode:
+    def __init__(self):
+        self.me = None
+        self.peers = []     # shard -> ip:port
+        self.inbox = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+        self.ended = collections.OrderedDict()   # sid -> True, the last peer_tombstones ended queries
+
+    def configure(self, me, peers):
+        self.me = me
+        self.peers = list(peers)
+
+    def end(self, sid):
+        with self.lock:
+            self.ended[sid] = True
+            while len(self.ended) > peer_tombstones:
+                self.ended.popitem(last=False)
+
+    def is_ended(self, sid):
+        with self.lock:
+            return sid in self.ended
+
+    # Frontiers are handled by a worker thread, so that a peer's request returns
+    # right away, and shards forwarding to each other never wait on each other.
+    # Returns False if the query has ended already, and the frontier is dropped.
+    def receive(self, sid, nodes, credit, master):
+        with self.lock:
+            if sid in self.ended:
+                log.debug("peer %s: dropped a frontier of ended query %s", self.me, sid)
+                return False
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name="nxg-peer", daemon=True)
+                self.worker.start()
+        self.inbox.put((sid, nodes, credit, master))
+        return True
+
+    def run(self):
+        while True:
+            batch = [self.inbox.get()]
+            while True:
+                try:
+                    batch.append(self.inbox.get_nowait())
+                except queue.Empty:
+                    break
+            # the frontiers of a query that queued up meanwhile go as one BFS
+            combined = dict()
+            for sid, nodes, credit, master in batch:
+                if sid in combined:
+                    combined[sid][0].update(nodes)
+                    combined[sid][1] += credit
+                else:
+                    combined[sid] = [NodeSet(nodes), credit, master]
+            for sid, (nodes, credit, master) in combined.items():
+                self.forward(sid, nodes, credit, master)
+
+    def forward(self, sid, nodes, credit, master):
+        if self.is_ended(sid):
+            return
+        count = 0
+        targets = []
         try:
-            sneigh[i].clear()
-        except:
-            j=0
-    sneigh = [None]*nshards_max
+            shard = registry.current().shards[0]
+            with registry.lock.read():
+                count, exs, anchors = shard.bfs_count_with_remote_nodes(sid, nodes)
+            # the master may have ended the query meanwhile: drop the session again
+            if self.is_ended(sid):
+                shard.end_session(sid)
+                return
+            with registry.lock.read():
+                # remote nodes already forwarded for this query are not sent again
+                sent = shard.sessions[sid].setdefault('sent', dict())
+            for q, ns in exs:
+                new_nodes = NodeSet(ns) - sent[q] if q in sent else NodeSet(ns)
+                if new_nodes:
+                    sent.setdefault(q, NodeSet()).update(new_nodes)
+                    targets.append((q, new_nodes))
+        except Exception:
+            log.exception("peer %s: bfs failed for query %s", self.me, sid)
+
+        share = credit / (len(targets) + 1)
+        failed = 0
+        for q, new_nodes in targets:
+            try:
+                requests.post(
+                  "http://" + self.peers[q] + "/p2p-frontier?sid=" + sid + "&credit=" + str(share) + "&master=" + master,
+                  data={'sources': new_nodes.to_wire()},
+                  timeout=rpc.timeout
+                ).raise_for_status()
+            except (requests.RequestException, IndexError):
+                # the share comes back to the master, the DBFS still terminates
+                log.warning("peer %s: could not forward to shard %s for query %s", self.me, q, sid)
+                failed += 1
+
+        returned = credit - share * (len(targets) - failed)
+        try:
+            requests.get(
+              "http://" + master + "/p2p-report?sid=" + sid + "&shard=" + str(self.me) + "&count=" + str(count) + 
+              "&credit=" + str(returned) + "&sent=" + str(len(targets) - failed) + "&failed=" + str(failed),
+              timeout=rpc.timeout
+            )
+        except requests.RequestException:
+            log.warning("peer %s: could not report to master %s for query %s", self.me, master, sid)
+
+# The master's side of a peer-to-peer DBFS
+class PeerQuery:
+    def __init__(self, sid):
+        self.sid = sid
+        self.credit = Fraction(0)
+        self.count = 0
+        self.messages = 0
+        self.failed = 0
+        self.shards = set()
+        self.done = threading.Condition()
+
+    def report(self, shard, count, credit, sent, failed):
+        with self.done:
+            self.shards.add(shard)
+            self.count += count
+            self.credit += credit
+            self.messages += sent
+            self.failed += failed
+            if 1 == self.credit:
+                self.done.notify_all()
+
+    def wait(self, timeout):
+        with self.done:
+            return self.done.wait_for(lambda: 1 == self.credit, timeout)
+
+# master: ip:port the shards report to. Returns the peer messages (cross-cuts, one
+# network leg each), the number of nodes visited, whether the DBFS terminated within
+# timeout seconds, the frontiers that could not be forwarded, and the wall time.
+def p2p_dbfs(begin_shard, master, verbose=False, fleet=None, timeout=30.):
+    if fleet is None:
+        fleet = registry.current()
+    s = fleet.shards
+    sid = session_id()
+    query = PeerQuery(sid)
+    with registry.queries_lock:
+        registry.queries[sid] = query
+
+    start = time.time()
+    try:
+        s[begin_shard].p2p_frontier(sid, [s[begin_shard].node_center()[0]], Fraction(1), master)
+        terminated = query.wait(timeout)
+    finally:
+        with registry.queries_lock:
+            registry.queries.pop(sid, None)
+    elapsed = time.time() - start
+
+    if not terminated:
+        log.warning("p2p dbfs %s: only %s of the credit came back within %s s", sid, query.credit, timeout)
+    for i in (query.shards if terminated else range(len(s))):
+        s[i].end_session(sid)
+    if verbose:
+        log.debug("p2p dbfs %s: shards=%s messages=%d visited=%d", sid, sorted(query.shards), query.messages, query.count)
+    return query.messages, query.count, terminated, query.failed, elapsed
+
+
+#####################################################
+### Shard registry
+###
+### Holds the named fleets of shards this instance
+### knows about: 'local' (Shard objects, as a SERVER,
+### or the sole shard, as a CLIENT), 'remote' (dShard
+### objects, as a MASTER-SERVER), 'neo' (dNeoShard
+### objects) and 'janus' (dJanusShard objects).
+###
+### A published Fleet is never changed: changing a 
+### fleet means building a new one and publishing it
+### under the write lock. A traversal takes a snapshot
+### (the current Fleet object) and keeps on using it,
+### even if the fleet gets replaced underneath it, so
+### DBFS runs on different fleets can go in parallel.
+### Changes to the graph inside a CLIENT shard take
+### the write lock too, single shard BFSes the read one.
+#####################################################
+class RWLock:
+    # many readers or a single writer. A waiting writer blocks new readers,
+    # so that a steady stream of BFS calls cannot starve a fleet change.
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if 0 == self.readers:
+                    self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+
+class Fleet:
+    # shards: list of Shard, dShard, dNeoShard or dJanusShard
+    # far: most distant nodes per shard
+    # neigh: shard neighborhoods, shard -> neighbor shards
+    # ip, ports_start, ports: where the remote shards live (MASTER-SERVER)
+    def __init__(self, shards, far=None, neigh=None, num_nodes_per_shard=0, ip=None, ports_start=None, ports=None):
+        self.shards = shards
+        self.far = far if far is not None else []
+        self.neigh = neigh if neigh is not None else dict()
+        self.num_nodes_per_shard = num_nodes_per_shard
+        self.ip = ip
+        self.ports_start = ports_start
+        self.ports = ports if ports is not None else []
+        # the coordinator's summary graph of the fleet, and the global
+        # components off it, built on demand
+        self.summary = None
+        self.components = None
+        # k -> the k-hop halos of the shards (see Halos)
+        self.halos = dict()
+        # p -> moving average of shard p's call seconds (see QueuePolicy)
+        self.latency = dict()
+
+    def num_shards(self):
+        return len(self.shards)
+
+    # the graph inside the shards has changed
+    def changed(self):
+        self.summary = None
+        self.components = None
+        self.halos = dict()
+
+    # same fleet layout, other shard objects (i.e. neo clones of the local shards)
+    def with_shards(self, shards):
+        return Fleet(shards, self.far, self.neigh, self.num_nodes_per_shard, self.ip, self.ports_start, self.ports)
+
+empty_fleet = Fleet([])
+
+
+class ShardRegistry:
+    def __init__(self):
+        self.lock = RWLock()
+        self.fleets = dict()
+        # role: CLIENT, SERVER, or MASTER-SERVER
+        self.role = None
+        # CLIENT: this shard's place among its peers, for peer-to-peer DBFS
+        self.peer = PeerNode()
+        # MASTER-SERVER: the peer-to-peer DBFS queries running, sid -> PeerQuery
+        self.queries = dict()
+        self.queries_lock = threading.Lock()
+
+    def snapshot(self, name):
+        with self.lock.read():
+            return self.fleets.get(name, empty_fleet)
+
+    # the fleet the shard endpoints and the DBFS work on by default
+    def current(self):
+        with self.lock.read():
+            return self.fleets.get('remote' if "MASTER-SERVER" == self.role else 'local', empty_fleet)
+
+    # A role change drops the local and remote fleets, the neo and
+    # janus clones stay around until they are cloned again.
+    def publish(self, name, fleet, role=None):
+        with self.lock.write():
+            if role is not None and role != self.role:
+                log.info("This instance is now a %s instance!", role)
+                self.fleets.pop('local', None)
+                self.fleets.pop('remote', None)
+                self.role = role
+            self.fleets[name] = fleet
+
+    def reset(self):
+        with self.lock.write():
+            self.fleets.clear()
+            self.role = None
+
 	
 #####################################################
 ### globals
@@ -1245,53 +5010,59 @@ app = Flask(__name__)
 # global verbosity
 global_verbose = True
 
-# role: CLIENT, SERVER, or MASTER-SERVER
-# once set cannot be changed. Too confusing!
-# This i really just one constant, I use a list to make it persist across calls
-role = []
-
-# IP for distributed shards
-# This i really just one number, I use a list to make it persist across calls
-IP = []
-
-# ports for distributed shards
-ports_start = []
-ports = []
-
 # number of shards, upper limit
 nshards_max = 10000
 
-# number of shards
-# This i really just one number, I use a list to make it persist across calls
-nshards_as_list = []
-
-# number of nodes per shard
-# This i really just one number, I use a list to make it persist across calls
-num_nodes_per_shard_as_list = []
-
-# single shard
-s = Shard(1776)
-
-# list of shards, either local Shard, remote dShard, dNeoShard, or dJanusShard
-s = []
-s_neo = []
-s_janus = []
-s_backup = []
-
-# list of most distant nodes per shard
-sfar = []
-
-# shard neighborhoods
-sneigh = [None]*nshards_max
+# all fleets of shards, and this instance's role
+registry = ShardRegistry()
 
 # are we containerized?
 total_recall = False
 
+# logging. Records are handed over to a listener thread through a queue, so
+# the DBFS hot path never blocks writing to stdout/stderr. Messages use lazy
+# %-style arguments: large node sets are only stringified if the record's
+# level is enabled. Per-hop records go to the 'nxg.hop' logger and only 1
+# out of every hop_log_sample_every of them gets through.
+log = logging.getLogger("nxg")
+hop_log = logging.getLogger("nxg.hop")
+hop_log_sample_every = 100
+
+class HopSampler(logging.Filter):
+    def __init__(self, every):
+        logging.Filter.__init__(self)
+        self.every = every
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        return 0 == next(self.counter) % self.every
+
+def setup_logging(level):
+    handler = logging.StreamHandler(sys.stderr if total_recall else sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(level)
+    log.propagate = False
+    hop_log.addFilter(HopSampler(hop_log_sample_every))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging(logging.DEBUG if global_verbose else logging.WARNING)
+
 
 #####################################################
 ###  PUBLIC ENDPOINTS
 #####################################################
 
+# multi-worker serving: adopt the CLIENT shard another worker published, if any
+@app.before_request
+def before_request():
+    sync_shared_shard()
+
+
 ######################
 ### Usage: test health
 ######################
@@ -1300,6 +5071,28 @@ def hello():
     return "Hello from hyper-capable graph shard flask app!"
 
 
+#########################################################
+### Usage: logging level and per-hop sampling rate
+### (level is one of debug, info, warning, error)
+#########################################################
+# i.e. http://localhost:5000/log-level?level=debug&hop-sample=10
+@app.route("/log-level", methods=['GET'])
+def log_level():
+    level = str(request.args.get('level', 'info')).upper()
+    if level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR'):
+        return "The level should be one of debug, info, warning, error!"
+    log.setLevel(level)
+
+    try:
+        every = int(request.args.get('hop-sample'))
+        for hop_filter in hop_log.filters:
+            hop_filter.every = max(1, every)
+    except:
+        every = hop_log.filters[0].every
+
+    return "log level set to " + level + ", logging 1 out of every " + str(every) + " per-hop records."
+
+
 #####################################################
 ### Usage: MASTER SERVER (sharded distributed graph)
 ###
@@ -1322,10 +5115,11 @@ def hello():
 # i.e. http://localhost:5000/when?port=1234
 @app.route("/when", methods=['GET'])
 def when():
-    port = int(request.args.get('port`'))
+    port = int(request.args.get('port'))
+    fleet = registry.snapshot('remote')
     try:
-        index = port - ports_start[0]
-        return s[index].when 
+        index = port - fleet.ports_start
+        return fleet.shards[index].when 
     except:
         return "Could not find remote shard at that port!"
 		
@@ -1341,61 +5135,45 @@ def create_remote_shards():
     ports_start_at = int(request.args.get('shard-ports-start-at'))
     verbose = int(request.args.get('verbose'))
 	
-    # This instance is now a master-server instance!
-    try:
-        if (role[0] != "MASTER-SERVER"):
-            print("This instance is now a MASTER-SERVER instance!")
-        role.clear()
-        role.append("MASTER-SERVER")
-        s.clear()
-        sfar.clear()
-    except:
-        role.append("MASTER-SERVER")	
-
     if (num_shards > nshards_max):
         comment = "The upper limit on the number of shards is set as a constant in the program and is equal to " + str(nshards_max) + "." 
-        if global_verbose:
-            print(comment)
+        log.warning(comment)
         return comment
 		
     if not is_perfect_square(num_shards):
         comment = str(num_shards) + " is not a perfect square! Toroidal wrap will not work. Please specify perfect square number of shards."
-        if global_verbose:
-            print(comment)
+        log.warning(comment)
         return comment
 
     #if 10000 < num_shards and global_verbose:
     #    print("That dbfs will take a loooooooooooooooooong time..")
 
-    # clear lists, set number of shards global
-    clear_all_lists()
-    nshards_as_list.append(num_shards)
-    num_nodes_per_shard_as_list.append(nodes)
-	
-	# set IP and ports
-    IP.append(shards_ip)
-    ports_start.append(ports_start_at)
-    for i in range(0, num_shards):
-        ports.append(ports_start_at + i)
-		
+    # This instance becomes a master-server instance once the remote fleet is published
+    unpublish_shard()
 
-    if global_verbose:	
-        print("*** This master server will create " + str(num_shards) + " shards of " + str(nodes) + " nodes and " + str(farnodes) + " external edges each, at IP " + shards_ip + ", at ports [" + str(ports_start_at) + "," + str(ports_start_at + num_shards) + "]")	
+    log.info("This master server will create %d shards of %d nodes and %d external edges each, at IP %s, at ports [%d,%d]",
+             num_shards, nodes, farnodes, shards_ip, ports_start_at, ports_start_at + num_shards)
 
     # do it
-    return grow_remote_shards(num_shards, nodes, edges_p, farnodes, verbose)
+    return grow_remote_shards(num_shards, nodes, edges_p, farnodes, verbose, shards_ip, ports_start_at)
 
 
-# i.e. http://localhost:5000/do-ddbfs?shard=5&verbose=0
+# counts-only=1 has the shards return counts and boundaries only, not the nodes visited
+# combine=1 runs the DBFS level by level, one merged request per shard per level,
+# not checkpointed nor speculative
+# speculate=2 starts the BFS of the next 2 shards on the queue while a shard runs
+# policy picks the next shard off the queue (see queue_policies). partial=1 
+# answers without the shards that stay unavailable, instead of failing. checkpoint=1
+# keeps the DBFS state on disk (see DbfsCheckpoint), as traversal <name> if given.
+# i.e. http://localhost:5000/do-ddbfs?shard=5&verbose=0&counts-only=0&combine=0&speculate=0&policy=fifo&partial=0&checkpoint=0&traversal=t1
 @app.route("/do-ddbfs", methods=['GET'])
 def do_ddbfs():
 
     # This instance should be a master-server instance!
-    try:
-        if (role[0] != "MASTER-SERVER"):
-            return "This instance is not a MASTER-SERVER instance!"
-    except:
+    if registry.role is None:
         return "The remote shards have not been created yet!"	
+    if (registry.role != "MASTER-SERVER"):
+        return "This instance is not a MASTER-SERVER instance!"
 
     begin_shard = int(request.args.get('shard'))
     verbose = int(request.args.get('verbose'))
@@ -1405,16 +5183,23 @@ def do_ddbfs():
         verbose = True
 
     start = time.ctime()
-    if global_verbose:
-        print('Starting DBFS on remote shard fleet. The current time is :', start)
-    result = run_ddbfs(begin_shard, verbose)
+    log.info('Starting DBFS on remote shard fleet. The current time is : %s', start)
+    counts_only = 0 != int(request.args.get('counts-only', 0))
+    combine = 0 != int(request.args.get('combine', 0))
+    speculate = int(request.args.get('speculate', 0))
+    policy = request.args.get('policy', 'fifo')
+    if policy not in queue_policies:
+        return "Unknown policy, pick one of " + ",".join(queue_policies) + "!"
+    partial = 0 != int(request.args.get('partial', 0))
+    try:
+        checkpoint = request_checkpoint()
+        check_dbfs_options(counts_only, combine, 0, speculate, checkpoint)
+    except ValueError as e:
+        return str(e)
+    result = run_ddbfs(begin_shard, verbose, None, counts_only, combine, speculate, policy, partial, checkpoint)
     end = time.ctime()
 
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write('Finished DBFS. The current time is :', end)
-        else:
-            print('Finished DBFS. The current time is :', end)
+    log.info('Finished DBFS. The current time is : %s', end)
 
     return 'DBFS started ' + str(start) + ', finished ' + str(end) + '. ' + result 	
 
@@ -1439,33 +5224,18 @@ def create_shards():
     edges_p = float(request.args.get('edges'))
     farnodes = int(request.args.get('farnodes'))
 	
-    # clear lists, set number of shards global
-    clear_all_lists()
-    nshards_as_list.append(shards)
-    num_nodes_per_shard_as_list.append(nodes)
+    # This instance becomes a server instance once the local fleet is published
+    unpublish_shard()
     num_shards = shards
-	
-    # This instance is now a server instance!
-    try:
-        if (role[0] != "SERVER"):
-            print("This instance is now a SERVER instance!")
-        role.clear()
-        role.append("SERVER")
-        s.clear()
-        sfar.clear()
-    except:
-        role.append("SERVER")
 
     if (num_shards > nshards_max):
         comment = "The upper limit on the number of shards is set as a constant in the program and is equal to " + str(nshards_max) + "." 
-        if global_verbose:
-            print(comment)
+        log.warning(comment)
         return comment
 		
     if not is_perfect_square(num_shards):
         comment = str(num_shards) + " is not a perfect square! Toroidal wrap will not work. Please specify perfect square number of shards."
-        if global_verbose:
-            print(comment)
+        log.warning(comment)
         return comment
 
     #if 10000 < num_shards and global_verbose:
@@ -1475,16 +5245,16 @@ def create_shards():
     return grow_shards(num_shards, nodes, edges_p, farnodes)
 
 
-# i.e. http://localhost:5000/do-dbfs?shard=5&verbose=0
+# checkpoint=1 keeps the DBFS state on disk, as traversal <name> if given (see /do-ddbfs)
+# i.e. http://localhost:5000/do-dbfs?shard=5&verbose=0&counts-only=0&combine=0&speculate=0&policy=fifo&checkpoint=0&traversal=t1
 @app.route("/do-dbfs", methods=['GET'])
 def do_dbfs():
 
     # This instance is a server instance!
-    try:
-        if (role[0] != "SERVER"):
-            return "This instance is not a SERVER instance!"
-    except:
+    if registry.role is None:
         return "The local sharded graph has not been created yet!"
+    if (registry.role != "SERVER"):
+        return "This instance is not a SERVER instance!"
 
     begin_shard = int(request.args.get('shard'))
     verbose = int(request.args.get('verbose'))
@@ -1493,26 +5263,34 @@ def do_dbfs():
     else:
         verbose = True
     start = time.ctime()
-    if global_verbose:
-        print('Starting DBFS on local shard fleet. The current time is :', start)
-    result = run_dbfs(begin_shard, verbose)
+    log.info('Starting DBFS on local shard fleet. The current time is : %s', start)
+    counts_only = 0 != int(request.args.get('counts-only', 0))
+    combine = 0 != int(request.args.get('combine', 0))
+    speculate = int(request.args.get('speculate', 0))
+    policy = request.args.get('policy', 'fifo')
+    if policy not in queue_policies:
+        return "Unknown policy, pick one of " + ",".join(queue_policies) + "!"
+    try:
+        checkpoint = request_checkpoint()
+        check_dbfs_options(counts_only, combine, 0, speculate, checkpoint)
+    except ValueError as e:
+        return str(e)
+    result = run_dbfs(begin_shard, verbose, None, counts_only, combine, speculate, policy, checkpoint)
     end = time.ctime()
-    if global_verbose:
-        print('Finished DBFS. The current time is :', end)
+    log.info('Finished DBFS. The current time is : %s', end)
     return 'DBFS started ' + str(start) + ', finished ' + str(end) + '. ' + result 
 
 
 # i.e. http://localhost:5000/clone-shards-to-neo?neo-ip=192.168.99.100&neo-start-port=7474&how-many-shards=16&verbose=1
 @app.route("/clone-shards-to-neo", methods=['GET'])
 def clone_shards_to_neo():
-    global s_neo
-	
     neo_ip = str(request.args.get('neo-ip'))
     neo_start_port = int(request.args.get('neo-start-port'))
     shard_num = int(request.args.get('how-many-shards'))
     verbose = int(request.args.get('verbose'))
 
-    s_neo.clear()
+    local = registry.snapshot('local')
+    s_neo = []
     for i in range(0, shard_num):
         if global_verbose:
             if verbose: print("")
@@ -1520,7 +5298,8 @@ def clone_shards_to_neo():
         r = clone_shard_to_neo_internal(neo_ip, neo_start_port + i, i, verbose)
         if verbose:
             print(r)
-        s_neo.append(dNeoShard(i, s[i].node_center()[0], neo_ip, neo_start_port + i, verbose))
+        s_neo.append(dNeoShard(i, local.shards[i].node_center()[0], neo_ip, neo_start_port + i, verbose))
+    registry.publish('neo', local.with_shards(s_neo))
     done = "finished cloning " + str(shard_num) + " local shards to neo containers at ip " + neo_ip + " and ports [" + str(neo_start_port) + ", " + str(neo_start_port + shard_num - 1) + "]"
     if verbose:
         print("")
@@ -1531,14 +5310,14 @@ def clone_shards_to_neo():
 # i.e. http://localhost:5000/clone-shards-to-janus?janus-ip=192.168.99.100&janus-start-port=7474&how-many-shards=16&verbose=1
 @app.route("/clone-shards-to-janus", methods=['GET'])
 def clone_shards_to_janus():
-    global s_janus
 
     janus_ip = str(request.args.get('janus-ip'))
     janus_start_port = int(request.args.get('janus-start-port'))
     shard_num = int(request.args.get('how-many-shards'))
     verbose = int(request.args.get('verbose'))
 
-    s_janus.clear()
+    local = registry.snapshot('local')
+    s_janus = []
     for i in range(0, shard_num):
         if global_verbose:
             if verbose: print("")
@@ -1546,7 +5325,8 @@ def clone_shards_to_janus():
         r = clone_shard_to_janus_internal(janus_ip, janus_start_port + i, i, verbose)
         if verbose:
             print(r)
-        s_janus.append(dJanusShard(i, s[i].node_center()[0], janus_ip, janus_start_port + i, verbose))
+        s_janus.append(dJanusShard(i, local.shards[i].node_center()[0], janus_ip, janus_start_port + i, verbose))
+    registry.publish('janus', local.with_shards(s_janus))
     done = "finished cloning " + str(shard_num) + " local shards to janus containers at ip " + janus_ip + " and ports [" + str(janus_start_port) + ", " + str(janus_start_port + shard_num - 1) + "]"
     if verbose:
         print("")
@@ -1557,17 +5337,11 @@ def clone_shards_to_janus():
 # i.e. http://localhost:5000/do-ddbfs-on-neo-shards?shard=5&verbose=0
 @app.route("/do-ddbfs-on-neo-shards", methods=['GET'])
 def do_ddbfs_on_neo_shards():
-    global s, s_neo, s_backup
-	
-    # This should do the dbfs on a dNeoShard cluster
-
-    # move s_neo[] over to s[]
-    s_backup.clear()
-    for local_shard in s:
-        s_backup.append(local_shard)
-    s.clear()
-    for neo_shard in s_neo:
-        s.append(neo_shard)
+    # This should do the dbfs on a dNeoShard cluster. No more swapping
+    # the fleets in and out of s[]: the DBFS runs on a snapshot of the neo fleet.
+    fleet = registry.snapshot('neo')
+    if 0 == fleet.num_shards():
+        return "The neo shards have not been cloned yet!"
 
     # do a stock DBFS
     begin_shard = int(request.args.get('shard'))
@@ -1578,22 +5352,11 @@ def do_ddbfs_on_neo_shards():
         verbose = True
 
     start = time.ctime()
-    if global_verbose:
-        print('Starting DBFS on remote neo fleet. The current time is :', start)
-    result = run_ddbfs(begin_shard, verbose)
+    log.info('Starting DBFS on remote neo fleet. The current time is : %s', start)
+    result = run_ddbfs(begin_shard, verbose, fleet)
     end = time.ctime()
 
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write('Finished DBFS. The current time is :', end)
-        else:
-            print('Finished DBFS. The current time is :', end)
-			
-    # restore s to local shards:
-    s.clear()
-    for local_shard in s_backup:
-        s.append(local_shard)
-    s_backup.clear()
+    log.info('Finished DBFS. The current time is : %s', end)
 
     return 'DBFS on neo fleet started ' + str(start) + ', finished ' + str(end) + '. ' + result 	
 
@@ -1601,17 +5364,11 @@ def do_ddbfs_on_neo_shards():
 # i.e. http://localhost:5000/do-ddbfs-on-janus-shards?shard=5&verbose=0
 @app.route("/do-ddbfs-on-janus-shards", methods=['GET'])
 def do_ddbfs_on_janus_shards():
-    global s, s_janus, s_backup
-	
-    # This should do the dbfs on a dJanusShard cluster
-
-    # move s_janus[] over to s[]
-    s_backup.clear()
-    for local_shard in s:
-        s_backup.append(local_shard)
-    s.clear()
-    for janus_shard in s_janus:
-        s.append(janus_shard)
+    # This should do the dbfs on a dJanusShard cluster. No more swapping
+    # the fleets in and out of s[]: the DBFS runs on a snapshot of the janus fleet.
+    fleet = registry.snapshot('janus')
+    if 0 == fleet.num_shards():
+        return "The janus shards have not been cloned yet!"
 
     # do a stock DBFS
     begin_shard = int(request.args.get('shard'))
@@ -1622,26 +5379,655 @@ def do_ddbfs_on_janus_shards():
         verbose = True
 
     start = time.ctime()
-    if global_verbose:
-        print('Starting DBFS on remote janus fleet. The current time is :', start)
-    result = run_ddbfs(begin_shard, verbose)
+    log.info('Starting DBFS on remote janus fleet. The current time is : %s', start)
+    result = run_ddbfs(begin_shard, verbose, fleet)
     end = time.ctime()
 
-    if global_verbose:
-        if total_recall:
-            sys.stderr.write('Finished DBFS. The current time is :', end)
-        else:
-            print('Finished DBFS. The current time is :', end)
-			
-    # restore s to local shards:
-    s.clear()
-    for local_shard in s_backup:
-        s.append(local_shard)
-    s_backup.clear()
+    log.info('Finished DBFS. The current time is : %s', end)
 
     return 'DBFS on janus fleet started ' + str(start) + ', finished ' + str(end) + '. ' + result 
 
 
+# Runs the same DBFS on several fleets at the same time, one thread per fleet,
+# each on its own snapshot, i.e. to benchmark neo vs. janus side by side.
+# i.e. http://localhost:5000/do-ddbfs-side-by-side?fleets=neo,janus&shard=5&verbose=0
+@app.route("/do-ddbfs-side-by-side", methods=['GET'])
+def do_ddbfs_side_by_side():
+    names = str(request.args.get('fleets', 'neo,janus')).split(',')
+    begin_shard = int(request.args.get('shard'))
+    verbose = 0 != int(request.args.get('verbose', 0))
+
+    fleets = dict((name, registry.snapshot(name)) for name in names)
+    missing = [name for name in names if 0 == fleets[name].num_shards()]
+    if missing:
+        return "These fleets have not been created yet: " + ", ".join(missing) + "!"
+
+    results = dict()
+    def run(name):
+        started = time.time()
+        results[name] = run_ddbfs(begin_shard, verbose, fleets[name]) + " Wall time: " + str(round(time.time() - started, 2)) + " s."
+
+    start = time.ctime()
+    log.info('Starting DBFS side by side on fleets %s. The current time is : %s', names, start)
+    threads = [threading.Thread(target=run, args=(name,)) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    end = time.ctime()
+    log.info('Finished DBFS. The current time is : %s', end)
+
+    return 'DBFS side by side started ' + str(start) + ', finished ' + str(end) + '. ' + ' '.join(name + ' fleet: ' + results[name] for name in names)
+
+
+#####################################################
+### Usage: SERVER and MASTER-SERVER, incremental
+### changes to the sharded graph
+###
+### Caller uses this surface API to change the graph
+### without growing the fleet again, i.e. to run
+### DBFSes while the graph keeps on changing. Works on
+### the local fleet (SERVER) or the remote fleet 
+### (MASTER-SERVER), whichever this instance has.
+#####################################################
+def fleet_to_change():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return None
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return None
+    return fleet
+
+# i.e. http://localhost:5000/add-cross-cuts?info=p0,ni0,q0,ne0,p1,ni1,q1,ne1,...
+# i.e. http://localhost:5000/add-cross-cuts?info=0,197,1,30,0,198,3,31
+@app.route("/add-cross-cuts", methods=['GET'])
+def add_cross_cuts_endpoint():
+    fleet = fleet_to_change()
+    if fleet is None:
+        return "This instance has no sharded graph to change!"
+    cuts = mytuples(request.args.get('info'), 4)
+    if cuts is None:
+        return "The argument should be a list of 4-tuple (p,ni,q,ne) cross-cut information!"
+    return add_cross_cuts(fleet, cuts)
+
+
+# i.e. http://localhost:5000/remove-cross-cuts?info=0,197,1,30,0,198,3,31
+@app.route("/remove-cross-cuts", methods=['GET'])
+def remove_cross_cuts_endpoint():
+    fleet = fleet_to_change()
+    if fleet is None:
+        return "This instance has no sharded graph to change!"
+    cuts = mytuples(request.args.get('info'), 4)
+    if cuts is None:
+        return "The argument should be a list of 4-tuple (p,ni,q,ne) cross-cut information!"
+    return remove_cross_cuts(fleet, cuts)
+
+
+# Returns the ids of the new nodes
+# i.e. http://localhost:5000/add-shard-nodes?shard=0&info=0.5,0.5,0.6,0.6
+@app.route("/add-shard-nodes", methods=['GET'])
+def add_shard_nodes():
+    fleet = fleet_to_change()
+    if fleet is None:
+        return "This instance has no sharded graph to change!"
+    shard_id = int(request.args.get('shard'))
+    positions = mytuples(request.args.get('info'), 2)
+    if positions is None:
+        return "The argument should be a list of (x,y) node positions!"
+    with change_lock(fleet):
+        result = j.dumps(fleet.shards[shard_id].add_nodes(positions)).replace(' ', '')
+    with registry.lock.write():
+        fleet.changed()
+    return result
+
+
+# i.e. http://localhost:5000/remove-shard-nodes?shard=0&nodes=6,9,131
+@app.route("/remove-shard-nodes", methods=['GET'])
+def remove_shard_nodes_endpoint():
+    fleet = fleet_to_change()
+    if fleet is None:
+        return "This instance has no sharded graph to change!"
+    shard_id = int(request.args.get('shard'))
+    node_ids = myints(j.loads(myjson(request.args.get('nodes'))))
+    return remove_shard_nodes(fleet, shard_id, node_ids)
+
+
+# i.e. http://localhost:5000/add-shard-edges?shard=0&info=6,9,9,131
+@app.route("/add-shard-edges", methods=['GET'])
+def add_shard_edges():
+    fleet = fleet_to_change()
+    if fleet is None:
+        return "This instance has no sharded graph to change!"
+    shard_id = int(request.args.get('shard'))
+    edges = mytuples(request.args.get('info'), 2)
+    if edges is None:
+        return "The argument should be a list of (u,v) edges!"
+    with change_lock(fleet):
+        result = fleet.shards[shard_id].add_edges(edges)
+    with registry.lock.write():
+        fleet.changed()
+    return result
+
+
+# i.e. http://localhost:5000/remove-shard-edges?shard=0&info=6,9,9,131
+@app.route("/remove-shard-edges", methods=['GET'])
+def remove_shard_edges():
+    fleet = fleet_to_change()
+    if fleet is None:
+        return "This instance has no sharded graph to change!"
+    shard_id = int(request.args.get('shard'))
+    edges = mytuples(request.args.get('info'), 2)
+    if edges is None:
+        return "The argument should be a list of (u,v) edges!"
+    with change_lock(fleet):
+        result = fleet.shards[shard_id].remove_edges(edges)
+    with registry.lock.write():
+        fleet.changed()
+    return result
+
+
+# i.e. http://localhost:5000/churn-cross-cuts?changes=16
+@app.route("/churn-cross-cuts", methods=['GET'])
+def churn_cross_cuts_endpoint():
+    fleet = fleet_to_change()
+    if fleet is None:
+        return "This instance has no sharded graph to change!"
+    changes = int(request.args.get('changes', 16))
+    return churn_cross_cuts(fleet, changes)
+
+
+#####################################################
+### Usage: SERVER and MASTER-SERVER, DBFS planned on
+### the coordinator's summary graph
+###
+### The summary graph is built on first use, or on
+### demand with rebuild=1 (i.e. after the shards were
+### changed directly, not through this instance).
+#####################################################
+# i.e. http://localhost:5000/summary-graph?rebuild=1
+@app.route("/summary-graph", methods=['GET'])
+def summary_graph():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+    summary = fleet_summary(fleet, 0 != int(request.args.get('rebuild', 0)))
+    num_edges = sum(len(v) for v in summary.adj.values()) // 2
+    return "Summary graph of " + str(fleet.num_shards()) + " shards: " + str(len(summary.count)) + " components, " + str(num_edges) + " edges between them. Built in " + str(round(summary.build_seconds,2)) + " s."
+
+
+# i.e. http://localhost:5000/do-dbfs-summary?shard=5&counts-only=1&verbose=0
+@app.route("/do-dbfs-summary", methods=['GET'])
+def do_dbfs_summary():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+
+    begin_shard = int(request.args.get('shard'))
+    counts_only = 0 != int(request.args.get('counts-only', 1))
+    verbose = 0 != int(request.args.get('verbose', 0))
+
+    start = time.ctime()
+    log.info('Starting DBFS on the summary graph. The current time is : %s', start)
+    total_cross_cuts_required, num_nodes_visited, time_in, time_out = summary_dbfs(begin_shard, verbose, fleet, counts_only)
+    end = time.ctime()
+    log.info('Finished DBFS. The current time is : %s', end)
+
+    num_shards = fleet.num_shards()
+    return 'DBFS started ' + str(start) + ', finished ' + str(end) + '. ' + "Total cross cuts (lower bound): " + str(total_cross_cuts_required) + ". Total nodes visited: " + str(num_nodes_visited) + "/" +  str(num_shards * fleet.num_nodes_per_shard) + ". Total bfs time: " + str(round(time_in,2)) + " s. Overhead: " + str(round(time_out,2)) + " s."
+
+
+# Labels every node with its global component, on the shards
+# i.e. http://localhost:5000/label-components-fleet?rebuild=0
+@app.route("/label-components-fleet", methods=['GET'])
+def label_components_fleet():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+
+    rebuild = 0 != int(request.args.get('rebuild', 0))
+    components = fleet_components(fleet, rebuild)
+    largest = sorted(components.size.values(), reverse=True)[:5]
+    return "Global components: " + str(len(components.size)) + ", over " + str(fleet.num_shards()) + " shards. Largest: " + str(largest).replace(' ', '') + ". Shards not labelled (changed since summarized): " + str(components.stale).replace(' ', '') + ". Labelled in " + str(round(components.build_seconds,2)) + " s."
+
+
+# DBFS answered from the global components, check=1 runs a plain DBFS to compare
+# i.e. http://localhost:5000/do-dbfs-components?shard=5&check=0&verbose=0
+@app.route("/do-dbfs-components", methods=['GET'])
+def do_dbfs_components():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+
+    begin_shard = int(request.args.get('shard'))
+    check = 0 != int(request.args.get('check', 0))
+    verbose = 0 != int(request.args.get('verbose', 0))
+
+    gid, num_nodes_visited, shards, never_visited, agrees = components_dbfs(begin_shard, verbose, fleet, check)
+    return "Global component: " + str(gid) + ". Total nodes visited: " + str(num_nodes_visited) + "/" +  str(fleet.num_shards() * fleet.num_nodes_per_shard) + ". Shards visited: " + str(len(shards)) + ". Never visited shards: " + str(never_visited).replace(' ', '') + "." + ("" if agrees is None else " Plain DBFS agrees: " + str(agrees) + ".")
+
+
+# DBFS through k-hop halos on a local fleet (see Halos), side by side with the 
+# plain DBFS: the cross-cuts saved, and the halos' memory and sync cost.
+# i.e. http://localhost:5000/do-dbfs-halo?shard=0&k=2&rebuild=0&verbose=0
+@app.route("/do-dbfs-halo", methods=['GET'])
+def do_dbfs_halo():
+    if registry.role != "SERVER":
+        return "This instance is not a SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The local sharded graph has not been created yet!"
+
+    begin_shard = int(request.args.get('shard'))
+    k = int(request.args.get('k', 1))
+    if k < 1:
+        return "k must be at least 1!"
+    verbose = 0 != int(request.args.get('verbose', 0))
+    halos = fleet_halos(fleet, k, 0 != int(request.args.get('rebuild', 0)))
+
+    cross_cuts, num_nodes_visited, time_in, time_out = dbfs(begin_shard, verbose, fleet)
+    halo_cross_cuts, halo_num_nodes_visited, halo_time_in, halo_time_out = dbfs(begin_shard, verbose, fleet, halo=k)
+    if halo_num_nodes_visited != num_nodes_visited:
+        log.warning("halo dbfs: %d nodes visited, %d without the halos", halo_num_nodes_visited, num_nodes_visited)
+    return jsonify({'halos': halos.stats(),
+                    'plain': {'cross_cuts': cross_cuts, 'visited': num_nodes_visited, 'bfs_seconds': round(time_in, 6), 'overhead_seconds': round(time_out, 6)},
+                    'halo': {'cross_cuts': halo_cross_cuts, 'visited': halo_num_nodes_visited, 'bfs_seconds': round(halo_time_in, 6), 'overhead_seconds': round(halo_time_out, 6)},
+                    'cross_cuts_saved': cross_cuts - halo_cross_cuts})
+
+
+# Speculative DBFS (see speculative_dbfs()) side by side with the plain DBFS, both
+# with the same queue policy: the wall time saved, and the speculative work, wasted or not.
+# i.e. http://localhost:5000/do-dbfs-speculative?shard=0&width=2&policy=fifo&verbose=0
+@app.route("/do-dbfs-speculative", methods=['GET'])
+def do_dbfs_speculative():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+
+    begin_shard = int(request.args.get('shard'))
+    width = int(request.args.get('width', 2))
+    policy = request.args.get('policy', 'fifo')
+    if policy not in queue_policies:
+        return "Unknown policy, pick one of " + ",".join(queue_policies) + "!"
+    verbose = 0 != int(request.args.get('verbose', 0))
+
+    start = time.time()
+    cross_cuts, num_nodes_visited, time_in, time_out = dbfs(begin_shard, verbose, fleet, policy=policy)
+    plain_seconds = time.time() - start
+    start = time.time()
+    spec_cross_cuts, spec_num_nodes_visited, spec_time_in, spec_time_out, stats = speculative_dbfs(begin_shard, verbose, fleet, width, policy=policy)
+    spec_seconds = time.time() - start
+    return jsonify({'plain': {'cross_cuts': cross_cuts, 'visited': num_nodes_visited, 'wall_seconds': round(plain_seconds, 6)},
+                    'speculative': dict(stats, cross_cuts=spec_cross_cuts, visited=spec_num_nodes_visited, wall_seconds=round(spec_seconds, 6))})
+
+
+# The DBFS once per shard queue policy (see queue_policies), runs times each
+# i.e. http://localhost:5000/do-dbfs-policies?shard=0&policies=fifo,largest,contributions,latency&runs=3&verbose=0
+@app.route("/do-dbfs-policies", methods=['GET'])
+def do_dbfs_policies():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+
+    begin_shard = int(request.args.get('shard'))
+    policies = request.args.get('policies', ','.join(queue_policies)).split(',')
+    unknown = [p for p in policies if p not in queue_policies]
+    if unknown:
+        return "Unknown policies " + ",".join(unknown) + ", pick from " + ",".join(queue_policies) + "!"
+    runs = max(1, int(request.args.get('runs', 1)))
+    verbose = 0 != int(request.args.get('verbose', 0))
+    return jsonify(dbfs_policies(begin_shard, policies, runs, verbose, fleet))
+
+
+# One DBFS per begin shard in shards (a list, or all), batch-width of them per traversal
+# (see multi_dbfs()): cross-cuts and nodes visited per query, and the shard calls made.
+# compare=1 also runs them one by one, for the calls saved and a check of the results.
+# partial=1 answers without the shards that stay unavailable, instead of failing, with
+# the nodes each query did not ask them for (see /do-ddbfs).
+# i.e. http://localhost:5000/do-dbfs-batch?shards=0,1,2,3&batch-width=64&policy=fifo&compare=1&partial=0
+@app.route("/do-dbfs-batch", methods=['GET'])
+def do_dbfs_batch():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+
+    shards = request.args.get('shards', 'all')
+    begin_shards = list(range(fleet.num_shards())) if 'all' == shards else [int(p) for p in shards.split(',')]
+    width = int(request.args.get('batch-width', batch_width))
+    if not 0 < width <= batch_width:
+        return "The batch width goes from 1 to " + str(batch_width) + "!"
+    policy = request.args.get('policy', 'fifo')
+    if policy not in queue_policies:
+        return "Unknown policy, pick one of " + ",".join(queue_policies) + "!"
+    verbose = 0 != int(request.args.get('verbose', 0))
+    partial = 0 != int(request.args.get('partial', 0))
+
+    queries = []
+    num_calls = 0
+    start = time.time()
+    for b in range(0, len(begin_shards), width):
+        batch = begin_shards[b:b + width]
+        unavailable = dict() if partial else None
+        cross_cuts, num_nodes_visited, calls, time_in, time_out = multi_dbfs(batch, verbose, fleet, policy, unavailable)
+        num_calls += calls
+        for q, p in enumerate(batch):
+            query = {'shard': p, 'cross_cuts': cross_cuts[q], 'visited': num_nodes_visited[q]}
+            if unavailable and q in unavailable:
+                query['unavailable'] = unavailable[q]
+            queries.append(query)
+    result = {'batched': {'queries': queries, 'calls': num_calls, 'wall_seconds': round(time.time() - start, 6)}}
+
+    if 0 != int(request.args.get('compare', 0)):
+        # dbfs() makes one call per cross-cut, and one at the begin shard
+        num_calls = 0
+        mismatches = []
+        start = time.time()
+        for query in queries:
+            cross_cuts, num_nodes_visited, time_in, time_out = dbfs(query['shard'], verbose, fleet, policy=policy, unavailable=dict() if partial else None)
+            num_calls += cross_cuts + 1
+            if num_nodes_visited != query['visited']:
+                mismatches.append(query['shard'])
+        result['one_by_one'] = {'calls': num_calls, 'wall_seconds': round(time.time() - start, 6), 'mismatches': mismatches}
+        result['calls_saved'] = num_calls - result['batched']['calls']
+    return jsonify(result)
+
+
+# Replicas of remote shard shard: other CLIENTs serving the same shard (i.e. sharing
+# its NXG_SHARED_DIR), as ip:port. An empty list drops them.
+# i.e. http://localhost:5000/shard-replicas?shard=0&replicas=192.168.99.100:5070,192.168.99.100:5080
+@app.route("/shard-replicas", methods=['GET'])
+def shard_replicas():
+    if registry.role != "MASTER-SERVER":
+        return "This instance is not a MASTER-SERVER instance!"
+    fleet = registry.current()
+    p = int(request.args.get('shard'))
+    if not 0 <= p < fleet.num_shards():
+        return "No such remote shard!"
+    replicas = [r.rsplit(':', 1) for r in request.args.get('replicas', '').split(',') if r]
+    replicas = [(ip, int(port)) for ip, port in replicas]
+    # a new list, swapped in between DBFS hops
+    with registry.lock.write():
+        fleet.shards[p].replicas = replicas
+    return "Remote shard " + str(p) + " has " + str(len(replicas)) + " replicas."
+
+
+# Resumes a checkpointed DBFS (see DbfsCheckpoint) where it left off, on the current
+# fleet, without going back to the shards it has been through. A finished one just
+# answers its result again.
+# i.e. http://localhost:5000/do-dbfs-resume?traversal=t1&verbose=0
+@app.route("/do-dbfs-resume", methods=['GET'])
+def do_dbfs_resume():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    traversal = request.args.get('traversal', '')
+    if not valid_traversal(traversal):
+        return "A traversal name has letters, digits, - and _ only!"
+    try:
+        checkpoint = DbfsCheckpoint.load(traversal)
+    except (IOError, ValueError):
+        return "No checkpoint for traversal " + traversal + "!"
+    fleet = registry.current()
+    options = checkpoint.options
+    if options['shards'] != fleet.num_shards():
+        return "The fleet has changed since traversal " + traversal + " was checkpointed!"
+    verbose = 0 != int(request.args.get('verbose', 0))
+    checkpoint.every = int(request.args.get('checkpoint-every', checkpoint.every))
+
+    start = time.ctime()
+    unavailable = dict() if options['partial'] else None
+    total_cross_cuts_required, num_nodes_visited, time_in, time_out = dbfs(options['begin_shard'], verbose, fleet, options['counts_only'],
+                                                                           halo=options['halo'], policy=options['policy'],
+                                                                           unavailable=unavailable, checkpoint=checkpoint)
+    end = time.ctime()
+    return 'DBFS resumed ' + str(start) + ', finished ' + str(end) + '. Traversal ' + traversal + '. ' + \
+        ("Partial result! Unavailable shards (shard: nodes not asked for): " + str(unavailable).replace(' ', '') + ". " if unavailable else "") + \
+        "Total cross cuts: " + str(total_cross_cuts_required) + ". Total nodes visited: " + str(num_nodes_visited) + "/" +  str(fleet.num_shards() * fleet.num_nodes_per_shard) + \
+        ". Total bfs time: " + str(round(time_in,2)) + " s. Overhead: " + str(round(time_out,2)) + " s."
+
+
+# The DBFS checkpoints on disk, in NXG_CHECKPOINT_DIR. remove: a traversal to drop.
+# i.e. http://localhost:5000/dbfs-checkpoints?remove=t1
+@app.route("/dbfs-checkpoints", methods=['GET'])
+def dbfs_checkpoints_route():
+    traversal = request.args.get('remove')
+    if traversal:
+        if not valid_traversal(traversal):
+            return "A traversal name has letters, digits, - and _ only!"
+        remove_dbfs_checkpoint(traversal)
+    return jsonify({'directory': checkpoint_dir, 'checkpoints': dbfs_checkpoints()})
+
+
+# Deadlines, retries and hedging of the remote shard calls, and per shard the
+# calls, retries, errors, failures, hedges, hedges won and latency percentiles.
+# i.e. http://localhost:5000/rpc-settings?timeout=5&retries=2&hedge-percentile=95
+@app.route("/rpc-settings", methods=['GET'])
+def rpc_settings():
+    if request.args.get('timeout') is not None:
+        rpc.timeout = float(request.args.get('timeout'))
+    if request.args.get('retries') is not None:
+        rpc.retries = int(request.args.get('retries'))
+    if request.args.get('backoff') is not None:
+        rpc.backoff = float(request.args.get('backoff'))
+    if request.args.get('hedge-percentile') is not None:
+        rpc.hedge_percentile = float(request.args.get('hedge-percentile'))
+    shards = registry.current().shards if registry.role == "MASTER-SERVER" else []
+    return jsonify({'settings': rpc.settings(), 'shards': [shard.rpc_stats() for shard in shards]})
+
+
+# A shard's report on a peer-to-peer DBFS frontier (see PeerNode.forward())
+# i.e. http://localhost:5000/p2p-report?sid=5f3a&shard=1&count=180&credit=1/4&sent=2&failed=0
+@app.route("/p2p-report", methods=['GET'])
+def p2p_report():
+    sid = str(request.args.get('sid'))
+    with registry.queries_lock:
+        query = registry.queries.get(sid)
+    if query is None:
+        return "unknown query"
+    query.report(int(request.args.get('shard')), int(request.args.get('count')), Fraction(request.args.get('credit')),
+                 int(request.args.get('sent')), int(request.args.get('failed', 0)))
+    return "ok"
+
+
+# Peer-to-peer DBFS: the shards forward frontiers to each other, and report to
+# master, the ip:port of this instance as the shards can reach it.
+# i.e. http://localhost:5000/do-dbfs-p2p?shard=0&timeout=30&master=192.168.99.1:5000&verbose=0
+@app.route("/do-dbfs-p2p", methods=['GET'])
+def do_dbfs_p2p():
+    if registry.role != "MASTER-SERVER":
+        return "This instance is not a MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The remote shards have not been created yet!"
+
+    begin_shard = int(request.args.get('shard'))
+    master = request.args.get('master')
+    if not master:
+        return "The argument master should be the ip:port the shards can report to!"
+    timeout = float(request.args.get('timeout', 30))
+    verbose = 0 != int(request.args.get('verbose', 0))
+
+    start = time.ctime()
+    log.info('Starting peer-to-peer DBFS on remote shard fleet. The current time is : %s', start)
+    messages, num_nodes_visited, terminated, failed, elapsed = p2p_dbfs(begin_shard, master, verbose, fleet, timeout)
+    end = time.ctime()
+    log.info('Finished DBFS. The current time is : %s', end)
+    return 'DBFS started ' + str(start) + ', finished ' + str(end) + '. ' + ("" if terminated else "Timed out, partial result! ") + "Total cross cuts (shard to shard, one network leg each): " + str(messages) + (", " + str(failed) + " failed" if failed else "") + ". Total nodes visited: " + str(num_nodes_visited) + "/" +  str(fleet.num_shards() * fleet.num_nodes_per_shard) + ". Wall time: " + str(round(elapsed,2)) + " s."
+
+
+#####################################################
+### Usage: SERVER and MASTER-SERVER, targeted queries
+###
+### Nodes default to the shard's center node.
+#####################################################
+# i.e. http://localhost:5000/shortest-path?from-shard=0&from=12&to-shard=15&to=40&verbose=0
+@app.route("/shortest-path", methods=['GET'])
+def shortest_path():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+
+    from_shard = int(request.args.get('from-shard'))
+    to_shard = int(request.args.get('to-shard'))
+    from_node = int(request.args.get('from', fleet.shards[from_shard].node_center()[0]))
+    to_node = int(request.args.get('to', fleet.shards[to_shard].node_center()[0]))
+    verbose = 0 != int(request.args.get('verbose', 0))
+
+    length, path, cross_cuts, time_in, time_out = distributed_shortest_path(from_shard, from_node, to_shard, to_node, verbose, fleet)
+    if length == infinity:
+        return "No path from node " + str(from_node) + " on shard " + str(from_shard) + " to node " + str(to_node) + " on shard " + str(to_shard) + ". Total cross cuts: " + str(cross_cuts) + ". Total bfs time: " + str(round(time_in,2)) + " s. Overhead: " + str(round(time_out,2)) + " s."
+    return "Path length: " + str(length) + ". Path (shard, node): " + str(path).replace(' ', '') + ". Total cross cuts: " + str(cross_cuts) + ". Total bfs time: " + str(round(time_in,2)) + " s. Overhead: " + str(round(time_out,2)) + " s."
+
+
+# i.e. http://localhost:5000/k-hop?shard=0&node=12&k=3&verbose=0
+@app.route("/k-hop", methods=['GET'])
+def k_hop():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+
+    from_shard = int(request.args.get('shard'))
+    from_node = int(request.args.get('node', fleet.shards[from_shard].node_center()[0]))
+    k = int(request.args.get('k'))
+    verbose = 0 != int(request.args.get('verbose', 0))
+
+    num_nodes, counts, cross_cuts, time_in, time_out = distributed_k_hop(from_shard, from_node, k, verbose, fleet)
+    return "Nodes within " + str(k) + " hops: " + str(num_nodes) + ", on " + str(len([p for p in counts if counts[p]])) + " shards. Total cross cuts: " + str(cross_cuts) + ". Total bfs time: " + str(round(time_in,2)) + " s. Overhead: " + str(round(time_out,2)) + " s."
+
+
+# Number of nodes per BFS level, max-depth is unlimited by default
+# i.e. http://localhost:5000/do-dbfs-levels?shard=0&node=12&max-depth=10&verbose=0
+@app.route("/do-dbfs-levels", methods=['GET'])
+def do_dbfs_levels():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+
+    from_shard = int(request.args.get('shard'))
+    from_node = int(request.args.get('node', fleet.shards[from_shard].node_center()[0]))
+    max_depth = int(request.args.get('max-depth', -1))
+    verbose = 0 != int(request.args.get('verbose', 0))
+
+    levels, counts, cross_cuts, reentries, time_in, time_out = dbfs_levels(from_shard, from_node, infinity if max_depth < 0 else max_depth, verbose, fleet)
+    return "Nodes per level (distance, count): " + str(levels).replace(' ', '') + ". Total nodes visited: " + str(sum(counts.values())) + ", on " + str(len([p for p in counts if counts[p]])) + " shards. Total cross cuts: " + str(cross_cuts) + " (" + str(reentries) + " shard re-entries). Total bfs time: " + str(round(time_in,2)) + " s. Overhead: " + str(round(time_out,2)) + " s."
+
+
+# Iterative analytics, algorithm is pagerank or cc (connected components)
+# i.e. http://localhost:5000/pregel?algorithm=pagerank&supersteps=100&tolerance=0.000001&top=5&verbose=0
+@app.route("/pregel", methods=['GET'])
+def pregel_endpoint():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+
+    algorithm = request.args.get('algorithm', 'pagerank')
+    if algorithm not in vertex_programs:
+        return "Unknown algorithm, pick one of " + ",".join(vertex_programs) + "!"
+    max_supersteps = int(request.args.get('supersteps', 100))
+    tolerance = float(request.args.get('tolerance', 1e-6))
+    top = int(request.args.get('top', 5))
+    verbose = 0 != int(request.args.get('verbose', 0))
+
+    result, converged, supersteps, time_in, time_out = pregel(algorithm, max_supersteps, tolerance, top, verbose, fleet)
+    return result + ". Supersteps: " + str(len(supersteps)) + ("" if converged else " (not converged)") + ". Total cross cuts: " + str(sum(e[1] for e in supersteps)) + ". Per superstep (superstep, cross cuts, messages, bytes): " + str(supersteps).replace(' ', '') + ". Total compute time: " + str(round(time_in,2)) + " s. Overhead: " + str(round(time_out,2)) + " s."
+
+
+# The transports asked for: scenarios (see network_scenarios, all of them by
+# default), and a custom one if rtt-ms is given, all seeded with seed (default 0).
+# An error message otherwise.
+def request_transports():
+    seed = int(request.args.get('seed', 0))
+    names = [n for n in request.args.get('scenarios', '' if 'rtt-ms' in request.args else ','.join(network_scenarios)).split(',') if n]
+    unknown = [n for n in names if n not in network_scenarios]
+    if unknown:
+        return "Unknown scenarios " + ",".join(unknown) + ", pick from " + ",".join(network_scenarios) + "!"
+    transports = [network_transport(n, seed) for n in names]
+    if 'rtt-ms' in request.args:
+        transports.append(EmulatedTransport('custom', float(request.args.get('rtt-ms')) / 1000.,
+                                            float(request.args.get('jitter-ms', 0)) / 1000.,
+                                            float(request.args.get('mbps', 0)) * 1e6 / 8,
+                                            float(request.args.get('loss', 0)),
+                                            int(request.args.get('retries', 8)), seed=seed))
+    return transports
+
+
+# DBFS over emulated networks: the predefined scenarios (see network_scenarios),
+# and/or a custom one from rtt-ms, jitter-ms, mbps, loss. Times are simulated.
+# i.e. http://localhost:5000/do-dbfs-network-sweep?shard=0&scenarios=direct,lan,wan&rtt-ms=20&jitter-ms=2&mbps=100&loss=0.01&seed=1&counts-only=0&combine=0
+@app.route("/do-dbfs-network-sweep", methods=['GET'])
+def do_dbfs_network_sweep():
+    if registry.role not in ("SERVER", "MASTER-SERVER"):
+        return "This instance is not a SERVER or MASTER-SERVER instance!"
+    fleet = registry.current()
+    if 0 == fleet.num_shards():
+        return "The sharded graph has not been created yet!"
+
+    begin_shard = int(request.args.get('shard'))
+    verbose = 0 != int(request.args.get('verbose', 0))
+    counts_only = 0 != int(request.args.get('counts-only', 0))
+    combine = 0 != int(request.args.get('combine', 0))
+    transports = request_transports()
+    if isinstance(transports, str):
+        return transports
+
+    return jsonify(dbfs_network_sweep(begin_shard, transports, verbose, fleet, counts_only, combine))
+
+
+# The DBFS cost model fit from the network sweeps and DBFS runs, clear=1 starts over
+# i.e. http://localhost:5000/cost-model?clear=0
+@app.route("/cost-model", methods=['GET'])
+def cost_model_status():
+    if 0 != int(request.args.get('clear', 0)):
+        cost_model.clear()
+    return jsonify(cost_model.status())
+
+
+# Predicted DBFS time for shards shards of nodes nodes, per network scenario (see 
+# network_scenarios) and/or a custom rtt-ms, jitter-ms, mbps, loss. cross-cuts 
+# overrides the estimated number of cross-cuts. remote=1 adds the HTTP calls to
+# remote shards, as measured on /do-ddbfs runs.
+# i.e. http://localhost:5000/cost-model-predict?shards=64&nodes=200&scenarios=lan,wan&rtt-ms=20&mbps=100&cross-cuts=120&remote=0
+@app.route("/cost-model-predict", methods=['GET'])
+def cost_model_predict():
+    shards = int(request.args.get('shards'))
+    nodes = int(request.args.get('nodes'))
+    cross_cuts = request.args.get('cross-cuts')
+    cross_cuts = float(cross_cuts) if cross_cuts is not None else None
+    remote = 0 != int(request.args.get('remote', 0))
+
+    transports = request_transports()
+    if isinstance(transports, str):
+        return transports
+
+    predictions = collections.OrderedDict()
+    for transport in transports:
+        prediction = cost_model.predict(shards, nodes, transport, cross_cuts, remote)
+        if prediction is None:
+            return "No DBFS runs to fit the cost model to yet, run a DBFS or a network sweep first!"
+        predictions[transport.name] = prediction
+    return jsonify(predictions)
+
+
 ############################################
 ### Usage: CLIENT (one local shard only)
 ###
@@ -1655,10 +6041,10 @@ def do_ddbfs_on_janus_shards():
 # i.e. http://localhost:5000/role
 @app.route("/role", methods=['GET'])
 def instancerole():	
-    if 0 == len(role):
+    if registry.role is None:
         return "Undecided"
     else:
-        return role[0]
+        return registry.role
 
 # i.e. http://localhost:5000/create-graph-shard?id=0&nodes=200&edges=0.08
 @app.route("/create-graph-shard", methods=['GET'])
@@ -1667,20 +6053,6 @@ def create_graph_shard():
     nodes = int(request.args.get('nodes'))
     edges_p = float(request.args.get('edges'))
 	
-    # accessing globals
-    global s, sfar, role, num_nodes_per_shard_as_list
-	
-    # This instance is now a client instance!
-    try:
-        if (role[0] != "CLIENT"):
-            print("This instance is now a CLIENT instance!")
-        role.clear()
-        role.append("CLIENT")
-        s.clear()
-        sfar.clear()
-    except:
-        role.append("CLIENT")		
-	
     if global_verbose:
         print("Instantiating sole shard..")
 
@@ -1688,98 +6060,112 @@ def create_graph_shard():
 	# I could just as easily delete the old shards, but I may want to debug with them.
     #sole_shard = Shard(1779 if 0==len(s) else 1779 + len(s))
 	
-	# Nah, just clear the list
+	# Nah, just replace the local fleet
     sole_shard = Shard(1779)
-    s.clear()
-    s.append(sole_shard)
-    num_nodes_per_shard_as_list.clear()
-    num_nodes_per_shard_as_list.append(nodes)
 		
     if global_verbose:
         print("Creating graph shard with nodes, edge probability ", str(nodes), str(edges_p))
-    return str(sole_shard.grow_graph(id, nodes, edges_p))
+
+    # This instance is now a client instance! Publish it to the other workers too, if any
+    with shared_shard_lock():
+        result = sole_shard.grow_graph(id, nodes, edges_p)
+        registry.publish('local', Fleet([publish_shard(sole_shard)], num_nodes_per_shard=nodes), role="CLIENT")
+    return str(result)
 
 
 # i.e. http://localhost:5000/nodes?id=0
 @app.route("/nodes", methods=['GET'])
 def nodes():
+    s = registry.current().shards
     if(0 == len(s)):
-        print("graph shard not yet created!")
+        log.warning("graph shard not yet created!")
         return "graph shard not yet created!"
 
     id = int(request.args.get('id'))
-    return j.dumps(s[id].nodes()).replace(' ', '')
+    with registry.lock.read():
+        return j.dumps(s[id].nodes()).replace(' ', '')
 
 
 # i.e. http://localhost:5000/edges?id=0
 @app.route("/edges", methods=['GET'])
 def edges():
+    s = registry.current().shards
     if(0 == len(s)):
-        print("graph shard not yet created!")
+        log.warning("graph shard not yet created!")
         return "graph shard not yet created!"
 
     id = int(request.args.get('id'))
-    return j.dumps(s[id].edges()).replace(' ', '')
+    with registry.lock.read():
+        return j.dumps(s[id].edges()).replace(' ', '')
 
 
 # i.e. http://localhost:5000/node-center?id=0
 @app.route("/node-center", methods=['GET'])
 def node_center():
+    s = registry.current().shards
     if(0 == len(s)):
-        print("graph shard not yet created!")
+        log.warning("graph shard not yet created!")
         return "graph shard not yet created!"
 
     id = int(request.args.get('id'))
-    return j.dumps(s[id].node_center()).replace(' ', '')
+    with registry.lock.read():
+        return j.dumps(s[id].node_center()).replace(' ', '')
 
 
 # i.e. http://localhost:5000/node-attribute?id=0&node-id=0&attribute=remote
 @app.route("/node-attribute", methods=['GET'])
 def node_attribute():
+    s = registry.current().shards
     if(0 == len(s)):
-        print("graph shard not yet created!")
+        log.warning("graph shard not yet created!")
         return "graph shard not yet created!"
 
     shard_id = int(request.args.get('id'))
     node_id = int(request.args.get('node-id'))
     node_attribute = str(request.args.get('attribute'))
 	
-    return j.dumps(s[shard_id].node_attribute(node_id, node_attribute)).replace(' ', '')
+    with registry.lock.read():
+        return j.dumps(s[shard_id].node_attribute(node_id, node_attribute)).replace(' ', '')
 
 
 # i.e. http://localhost:5000/edge-attribute?id=0&edge-id=0&attribute=remote
 @app.route("/edge-attribute", methods=['GET'])
 def edge_attribute():
+    s = registry.current().shards
     if(0 == len(s)):
-        print("graph shard not yet created!")
+        log.warning("graph shard not yet created!")
         return "graph shard not yet created!"
 
     shard_id = int(request.args.get('id'))
     edge_id = int(request.args.get('edge-id'))
     edge_attribute = str(request.args.get('attribute'))
 	
-    return j.dumps(s[shard_id].edge_attribute(edge_id, edge_attribute)).replace(' ', '')
+    with registry.lock.read():
+        return j.dumps(s[shard_id].edge_attribute(edge_id, edge_attribute)).replace(' ', '')
 
 
 # i.e. http://localhost:5000/nodes-with-attribute?id=0&attribute=remote
 @app.route("/nodes-with-attribute", methods=['GET'])
 def nodes_with_attribute():
+    s = registry.current().shards
     if(0 == len(s)):
-        print("graph shard not yet created!")
+        log.warning("graph shard not yet created!")
         return "graph shard not yet created!"
 
     shard_id = int(request.args.get('id'))
     node_attribute = str(request.args.get('attribute'))
 	
-    return j.dumps(s[shard_id].nodes_with_attribute(node_attribute)).replace(' ', '')
+    with registry.lock.read():
+        return j.dumps(s[shard_id].nodes_with_attribute(node_attribute)).replace(' ', '')
 
 
 # i.e. http://localhost:5000/most-distant-internal-nodes?id=0&how-many=16
 @app.route("/most-distant-internal-nodes", methods=['GET'])
 def most_distant_internal_nodes_endpoint():
 
+    s = registry.current().shards
     if(0 == len(s)):
-        print("graph shard not yet created!")
+        log.warning("graph shard not yet created!")
         return "graph shard not yet created!"
 
     id = int(request.args.get('id'))
@@ -1790,7 +6176,8 @@ def most_distant_internal_nodes_endpoint():
     #print(s[id].most_distant_internal_nodes(num = how_many))
     #print(j.dumps(s[id].most_distant_internal_nodes(num = how_many)).replace(' ', ''))
 
-    return j.dumps(s[id].most_distant_internal_nodes(num = how_many)).replace(' ', '')
+    with registry.lock.read():
+        return j.dumps(s[id].most_distant_internal_nodes(num = how_many)).replace(' ', '')
 
 
 # Note that info is a list without leading and trailing parenses. Gets converted to a list of lists herein.
@@ -1798,18 +6185,14 @@ def most_distant_internal_nodes_endpoint():
 # i.e. http://localhost:5000/add-edge-external?info=197,30,0.5,0.5,1,10,198,31,0.6,0.6,2,11,199,32,0.7,0.7,3,12
 @app.route("/add-edge-external", methods=['GET'])
 def add_edge_external():
-    global s
-
+    s = registry.current().shards
     if(0 == len(s)):
-        print("graph shard not yet created!")
+        log.warning("graph shard not yet created!")
         return "graph shard not yet created!"
 
     # This instance is a client instance!
-    try:
-        if (role[0] != "CLIENT"):
-            return "This instance is not a CLIENT instance!"
-    except:
-        return "graph has not been created yet!"
+    if (registry.role != "CLIENT"):
+        return "This instance is not a CLIENT instance!"
 
 		
 	# [(n[0], n[1], 1., 1., q, 1)] == (ni, ne, x, y, shard, d)
@@ -1828,7 +6211,7 @@ def add_edge_external():
     list_of_crosscuts = [list_of_numbers[i:i+6] for i in range(0, len(list_of_numbers), 6)]
     #print(list_of_crosscuts)
 
-    return s[0].add_edge_external(list_of_crosscuts)
+    return change_client_shard(lambda shard: shard.add_edge_external(list_of_crosscuts))
 
     # unit-testing
     #info = list(request.args.get('info'))
@@ -1840,29 +6223,123 @@ def add_edge_external():
     #return "testing"
 
 
+# Applies change(shard) to the sole shard, and publishes the changed shard to the other workers, if any
+def change_client_shard(change):
+    with shared_shard_lock():
+        sync_shared_shard()
+        fleet = registry.snapshot('local')
+        with registry.lock.write():
+            result = change(fleet.shards[0])
+        registry.publish('local', fleet.with_shards([publish_shard(fleet.shards[0])]))
+    return result
+
+def client_shard_to_change():
+    if 0 == registry.current().num_shards():
+        return "graph shard not yet created!"
+    if (registry.role != "CLIENT"):
+        return "This instance is not a CLIENT instance!"
+    return None
+
+
+# Note that info is a flattened list of (ni, shard, ne) triples
+# i.e. http://localhost:5000/remove-edge-external?info=197,1,30,198,2,31
+@app.route("/remove-edge-external", methods=['GET'])
+def remove_edge_external():
+    oops = client_shard_to_change()
+    if oops:
+        return oops
+    cuts = mytuples(request.args.get('info'), 3)
+    if cuts is None:
+        return "The argument should be a list of 3-tuple (ni,shard,ne) external edge information!"
+    return change_client_shard(lambda shard: shard.remove_edge_external(cuts))
+
+
+# i.e. http://localhost:5000/external-edges
+@app.route("/external-edges", methods=['GET'])
+def external_edges():
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    with registry.lock.read():
+        return j.dumps(s[0].external_edges()).replace(' ', '')
+
+
+# Returns the ids of the new nodes
+# i.e. http://localhost:5000/add-nodes?info=0.5,0.5,0.6,0.6
+@app.route("/add-nodes", methods=['GET'])
+def add_nodes():
+    oops = client_shard_to_change()
+    if oops:
+        return oops
+    positions = mytuples(request.args.get('info'), 2)
+    if positions is None:
+        return "The argument should be a list of (x,y) node positions!"
+    return j.dumps(change_client_shard(lambda shard: shard.add_nodes(positions))).replace(' ', '')
+
+
+# Returns the external edges (ni, shard, ne) removed along with the nodes,
+# the caller needs to remove their mirrors on the other shards.
+# i.e. http://localhost:5000/remove-nodes?nodes=6,9,131
+@app.route("/remove-nodes", methods=['GET'])
+def remove_nodes():
+    oops = client_shard_to_change()
+    if oops:
+        return oops
+    node_ids = myints(j.loads(myjson(request.args.get('nodes'))))
+    return j.dumps(change_client_shard(lambda shard: shard.remove_nodes(node_ids))).replace(' ', '')
+
+
+# i.e. http://localhost:5000/add-edges?info=6,9,9,131
+@app.route("/add-edges", methods=['GET'])
+def add_edges():
+    oops = client_shard_to_change()
+    if oops:
+        return oops
+    edges = mytuples(request.args.get('info'), 2)
+    if edges is None:
+        return "The argument should be a list of (u,v) edges!"
+    return change_client_shard(lambda shard: shard.add_edges(edges))
+
+
+# i.e. http://localhost:5000/remove-edges?info=6,9,9,131
+@app.route("/remove-edges", methods=['GET'])
+def remove_edges():
+    oops = client_shard_to_change()
+    if oops:
+        return oops
+    edges = mytuples(request.args.get('info'), 2)
+    if edges is None:
+        return "The argument should be a list of (u,v) edges!"
+    return change_client_shard(lambda shard: shard.remove_edges(edges))
+
+
 # 4-19-2020: I had a very crazy bug here: If the block checking on the length of s is after the parsing
 # of query arguments, then somehow s[shard_id] gets lots in space, and only s[0] works...
 
 # Same as below except I start a BFS from multiple internal nodes
+# With bitmap=1, sources and the node lists returned are compressed (see NodeSet.to_wire())
+# sources can also be POSTed as a form field, as dShard does: a large frontier does
+# not fit in a request line.
 # 
 # i.e. http://localhost:5000/bfs-trees-with-remote-nodes?sources=22,171,99,7,44&verbose=1
-@app.route("/bfs-trees-with-remote-nodes", methods=['GET'])
+# i.e. http://localhost:5000/bfs-trees-with-remote-nodes?sources=0.bQAI&bitmap=1
+@app.route("/bfs-trees-with-remote-nodes", methods=['GET', 'POST'])
 def bfs_trees_with_remote_nodes():
-    global s
-	
+    s = registry.current().shards
     if(0 == len(s)):
-        print("graph shard not yet created!")
+        log.warning("graph shard not yet created!")
         return "graph shard not yet created!"
 		
     # This instance is a client instance!
-    try:
-        if (role[0] != "CLIENT"):
-            return "This instance is not a CLIENT instance!"
-    except:
-        return "graph has not been created yet!"
+    if (registry.role != "CLIENT"):
+        return "This instance is not a CLIENT instance!"
 
     #sources = list(request.args.get('sources'))
-    sources = myints(j.loads(myjson(request.args.get('sources')))) 
+    bitmap = 0 != int(request.args.get('bitmap', 0))
+    if bitmap:
+        sources = NodeSet.from_wire(request.values.get('sources', ''))
+    else:
+        sources = myints(j.loads(myjson(request.values.get('sources')))) 
     #sources = list(filter(lambda e: e != ',', sources))
     #sources = list(map(lambda e: int(e), sources))
     try:
@@ -1877,30 +6354,304 @@ def bfs_trees_with_remote_nodes():
     except:
         shard_id = 0
 
-    result = s[shard_id].bfs_trees_with_remote_nodes(sources)
+    with registry.lock.read():
+        result = s[shard_id].bfs_trees_with_remote_nodes(sources)
     if verbose:
-        print(result)
+        log.debug("bfs shard=%s result=%s", shard_id, result)
+    if bitmap:
+        ins, exs = result
+        result = list((NodeSet(ins).to_wire(), [(k, NodeSet(v).to_wire()) for k, v in exs]))
+    return j.dumps(result).replace(' ', '')
+
+
+# The shards' BFS result caches (see BfsCache): hits, subsumed, misses, evictions and
+# invalidations. capacity: entries per shard, 0 turns caching off. clear=1 empties them.
+# A CLIENT sharing NXG_SHARED_DIR answers off its memory-mapped shard, uncached.
+# i.e. http://localhost:5000/bfs-cache?capacity=256&clear=0
+@app.route("/bfs-cache", methods=['GET'])
+def bfs_cache():
+    if registry.role is None:
+        return "The graph has not been created yet!"
+    capacity = request.args.get('capacity')
+    capacity = None if capacity is None else max(0, int(capacity))
+    clear = 0 != int(request.args.get('clear', 0))
+    shards = []
+    for shard in registry.current().shards:
+        if registry.role == "MASTER-SERVER":
+            shards.append(shard.bfs_cache_status(capacity, clear))
+        elif isinstance(shard, MappedShard):
+            shards.append({'mapped': True})
+        else:
+            if capacity is not None:
+                shard.bfs_cache.resize(capacity)
+            if clear:
+                shard.bfs_cache.empty()
+            shards.append(shard.bfs_cache.status())
+
+    total = collections.Counter()
+    for stats in shards:
+        total.update({k: stats.get(k, 0) for k in ('hits', 'subsumed', 'misses', 'evictions', 'invalidations', 'entries')})
+    lookups = total['hits'] + total['subsumed'] + total['misses']
+    total['hit_rate'] = round((total['hits'] + total['subsumed']) / lookups, 4) if lookups else None
+    return jsonify({'total': dict(total), 'shards': shards})
+
+
+# Up to 64 BFSes at once (see multi_dbfs()), sources grouped by the mask of the queries
+# they are for: mask:nodes,.. with mask in hex and nodes compressed (see NodeSet).
+# sources can be POSTed as a form field too.
+# i.e. http://localhost:5000/bfs-trees-with-remote-nodes-multi?sources=3:0.bQAI,4:0.aFAA
+@app.route("/bfs-trees-with-remote-nodes-multi", methods=['GET', 'POST'])
+def bfs_trees_with_remote_nodes_multi():
+    s = registry.current().shards
+    if 0 == len(s):
+        return "graph shard not yet created!"
+    if registry.role != "CLIENT":
+        return "This instance is not a CLIENT instance!"
+    shard_id = int(request.args.get('id', 0))
+    sources = mask_groups_from_wire(request.values.get('sources', ''))
+    with registry.lock.read():
+        ins, exs = s[shard_id].bfs_trees_with_remote_nodes_multi(sources)
+    return j.dumps(list((mask_groups_to_wire(ins), [(k, mask_groups_to_wire(v)) for k, v in exs]))).replace(' ', '')
+	
+
+# Targeted query sessions (see Shard.expand()), driven by a coordinator's shortest
+# path or k-hop query. Sessions live in this process: these refuse to serve with
+# NXG_WORKERS > 1 (see sessions_refused()), as do the other session endpoints below.
+# Note that info is a flattened list of (node, distance, origin shard, origin node) entries.
+# i.e. http://localhost:5000/session-expand?sid=5f3a&rid=9c1e&direction=F&limit=inf&info=6,0,-1,-1
+@app.route("/session-expand", methods=['GET'])
+def session_expand():
+    refused = sessions_refused()
+    if refused:
+        return refused
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    shard_id = int(request.args.get('id', 0))
+    sid = str(request.args.get('sid'))
+    direction = 'B' if 'B' == request.args.get('direction') else 'F'
+    limit = float(request.args.get('limit', 'inf'))
+    entries = mytuples(request.args.get('info'), 4)
+    if entries is None:
+        return "The argument should be a list of 4-tuple (node,distance,oshard,onode) entries!"
+    rid = request.args.get('rid')
+    with registry.lock.read():
+        return j.dumps(reply_once(s[shard_id], sid, rid, lambda: s[shard_id].expand(sid, direction, entries, limit))).replace(' ', '')
+
+
+# i.e. http://localhost:5000/session-path?sid=5f3a&direction=F&node=6
+@app.route("/session-path", methods=['GET'])
+def session_path():
+    refused = sessions_refused()
+    if refused:
+        return refused
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    shard_id = int(request.args.get('id', 0))
+    sid = str(request.args.get('sid'))
+    direction = 'B' if 'B' == request.args.get('direction') else 'F'
+    node = int(request.args.get('node'))
+    return j.dumps(s[shard_id].session_path(sid, direction, node)).replace(' ', '')
+
+
+# Returns the number of nodes the session reached per distance, [[distance,count],..]
+# i.e. http://localhost:5000/session-end?sid=5f3a
+@app.route("/session-end", methods=['GET'])
+def session_end():
+    refused = sessions_refused()
+    if refused:
+        return refused
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    shard_id = int(request.args.get('id', 0))
+    sid = str(request.args.get('sid'))
+    # late peer-to-peer frontiers of the query are dropped from now on (see PeerNode)
+    registry.peer.end(sid)
+    return j.dumps(s[shard_id].end_session(sid)).replace(' ', '')
+
+
+# The shard's index and its peers' addresses, for peer-to-peer DBFS (see PeerNode)
+# i.e. http://localhost:5000/set-peers?me=0&peers=192.168.99.100:5060,192.168.99.100:5061
+@app.route("/set-peers", methods=['GET'])
+def set_peers():
+    refused = sessions_refused()
+    if refused:
+        return refused
+    me = int(request.args.get('me'))
+    peers = request.args.get('peers', '').split(',')
+    registry.peer.configure(me, peers)
+    return "This shard is shard " + str(me) + " of " + str(len(peers)) + " peers."
+
+
+# A frontier of a peer-to-peer DBFS, from the master or a peer, with its credit.
+# It is queued and the call returns right away (see PeerNode). sources can be
+# POSTed as a form field too.
+# i.e. http://localhost:5000/p2p-frontier?sid=5f3a&sources=0.bQAI&credit=1/4&master=192.168.99.1:5000
+@app.route("/p2p-frontier", methods=['GET', 'POST'])
+def p2p_frontier():
+    refused = sessions_refused()
+    if refused:
+        return refused
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    sid = str(request.args.get('sid'))
+    nodes = NodeSet.from_wire(request.values.get('sources', ''))
+    credit = Fraction(request.args.get('credit'))
+    if not registry.peer.receive(sid, nodes, credit, request.args.get('master')):
+        return "dropped, the query has ended"
+    return "queued"
+
+
+# Global component labels of the shard's components, from the coordinator (see
+# Shard.label_components()). info is a flattened list of (cid, gid) pairs.
+# Returns false if the shard has changed since version.
+# i.e. http://localhost:5000/label-components?version=3&info=0,0,1,4294967296
+@app.route("/label-components", methods=['GET'])
+def label_components():
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    shard_id = int(request.args.get('id', 0))
+    version = int(request.args.get('version'))
+    info = request.args.get('info', '')
+    labels = mytuples(info, 2) if info else []
+    if labels is None:
+        return "The argument should be a list of 2-tuple (cid,gid) labels!"
+    with registry.lock.write():
+        return j.dumps(s[shard_id].label_components(version, labels))
+
+
+# The global component id of node, null if unknown or stale
+# i.e. http://localhost:5000/component-label?node=6
+@app.route("/component-label", methods=['GET'])
+def component_label():
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    shard_id = int(request.args.get('id', 0))
+    with registry.lock.read():
+        return j.dumps(s[shard_id].component_label(int(request.args.get('node'))))
+
+
+# A superstep of a vertex program (see Shard.superstep()). Inboxes can get big,
+# so they are POSTed as JSON: {"sid":..,"algorithm":..,"step":..,"inbox":[[node,message],..],"params":{..}}
+# i.e. curl -X POST -H 'Content-Type: application/json' -d '{"sid":"5f3a","algorithm":"cc","step":0,"inbox":[],"params":{"shard":0}}' http://localhost:5000/superstep
+@app.route("/superstep", methods=['POST'])
+def superstep():
+    refused = sessions_refused()
+    if refused:
+        return refused
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    shard_id = int(request.args.get('id', 0))
+    body = request.get_json()
+    if body.get('algorithm') not in vertex_programs:
+        return "Unknown algorithm, pick one of " + ",".join(vertex_programs) + "!"
+    with registry.lock.read():
+        result = s[shard_id].superstep(str(body['sid']), body['algorithm'], int(body['step']), body['inbox'], body['params'])
+    return j.dumps(result).replace(' ', '')
+
+
+# i.e. http://localhost:5000/superstep-result?sid=5f3a&algorithm=pagerank&top=5
+@app.route("/superstep-result", methods=['GET'])
+def superstep_result():
+    refused = sessions_refused()
+    if refused:
+        return refused
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    shard_id = int(request.args.get('id', 0))
+    algorithm = request.args.get('algorithm')
+    if algorithm not in vertex_programs:
+        return "Unknown algorithm, pick one of " + ",".join(vertex_programs) + "!"
+    top = int(request.args.get('top', 5))
+    with registry.lock.read():
+        return j.dumps(s[shard_id].superstep_result(str(request.args.get('sid')), algorithm, top)).replace(' ', '')
+
+
+# The shard's summary, for the coordinator's summary graph
+# i.e. http://localhost:5000/summary?id=0
+@app.route("/summary", methods=['GET'])
+def summary():
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    shard_id = int(request.args.get('id', 0))
+    with registry.lock.read():
+        return j.dumps(s[shard_id].summary()).replace(' ', '')
+
+
+# Same as above, in count-only mode (see Shard.bfs_count_with_remote_nodes()): the
+# nodes visited stay in session sid, to be dropped with /session-end. Returns the
+# number of internal nodes newly visited, the external nodes to visit next, grouped
+# by shard, and the anchors newly visited. bitmap=1 and POSTed sources as for
+# /bfs-trees-with-remote-nodes. A retry of request rid gets the reply the first 
+# attempt got (see reply_once()).
+# i.e. http://localhost:5000/bfs-count-with-remote-nodes?sid=5f3a&rid=9c1e&sources=22,171,99,7,44
+@app.route("/bfs-count-with-remote-nodes", methods=['GET', 'POST'])
+def bfs_count_with_remote_nodes():
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    if (registry.role != "CLIENT"):
+        return "This instance is not a CLIENT instance!"
+
+    bitmap = 0 != int(request.args.get('bitmap', 0))
+    if bitmap:
+        sources = NodeSet.from_wire(request.values.get('sources', ''))
+    else:
+        sources = myints(j.loads(myjson(request.values.get('sources')))) 
+    refused = sessions_refused()
+    if refused:
+        return refused
+    sid = str(request.args.get('sid'))
+    shard_id = int(request.args.get('id', 0))
+    rid = request.args.get('rid')
+    with registry.lock.read():
+        result = s[shard_id].bfs_count_with_remote_nodes(sid, sources, rid)
+    if bitmap:
+        count, exs, anchors = result
+        result = list((count, [(k, NodeSet(v).to_wire()) for k, v in exs], NodeSet(anchors).to_wire()))
     return j.dumps(result).replace(' ', '')
 	
 
+# Same as above, off the shard's reachability index, without traversing. Returns
+# the number of internal nodes reached, the [component, number of internal nodes] 
+# pairs reached, and the external nodes to visit next, grouped by shard.
+# i.e. http://localhost:5000/bfs-reach-with-remote-nodes?sources=22,171,99,7,44
+@app.route("/bfs-reach-with-remote-nodes", methods=['GET'])
+def bfs_reach_with_remote_nodes():
+    s = registry.current().shards
+    if(0 == len(s)):
+        return "graph shard not yet created!"
+    if (registry.role != "CLIENT"):
+        return "This instance is not a CLIENT instance!"
+
+    sources = myints(j.loads(myjson(request.args.get('sources')))) 
+    shard_id = int(request.args.get('id', 0))
+    with registry.lock.read():
+        return j.dumps(s[shard_id].reach_trees_with_remote_nodes(sources)).replace(' ', '')
+	
+
 # I do a BFS starting from the shard's center node. The internal path is returned
 # together with the external node (and its shard #) that needs to be visited next
 #	
 # i.e. http://localhost:5000/bfs-trees-with-remote-nodes-from-center-node?id=0
 @app.route("/bfs-trees-with-remote-nodes-from-center-node", methods=['GET'])
 def bfs_trees_with_remote_nodes_from_center_node():
-    global s
-
+    s = registry.current().shards
     if(0 == len(s)):
-        print("graph shard not yet created!")
+        log.warning("graph shard not yet created!")
         return "graph shard not yet created!"
 
     # This instance is a client instance!
-    try:
-        if (role[0] != "CLIENT"):
-            return "This instance is not a CLIENT instance!"
-    except:
-        return "graph has not been created yet!"
+    if (registry.role != "CLIENT"):
+        return "This instance is not a CLIENT instance!"
 
     shard_id = 0
     try:
@@ -1908,24 +6659,263 @@ def bfs_trees_with_remote_nodes_from_center_node():
     except:
         shard_id = 0
 
-    start_node = s[shard_id].node_center()[0]
-    start_node_list = []
-    start_node_list.append(start_node)
-    return j.dumps(s[shard_id].bfs_trees_with_remote_nodes(start_node_list)).replace(' ', '')
+    with registry.lock.read():
+        start_node = s[shard_id].node_center()[0]
+        start_node_list = []
+        start_node_list.append(start_node)
+        return j.dumps(s[shard_id].bfs_trees_with_remote_nodes(start_node_list)).replace(' ', '')
 	
 
+#####################################################
+### In-process neo and janus stand-ins
+###
+### Engine ip 'fake' (i.e. neo-ip=fake) gets one of
+### these instead of a container, keyed by engine 
+### kind and port. They hold what the local shards 
+### are cloned into them, and understand just the
+### CYPHER and GREMLIN this module sends. Every 
+### round trip to the engine sleeps the injected 
+### latency and is counted, so the driver-side cost
+### of cloning and of DBFS on engine shards can be
+### measured with no outside services.
+#####################################################
+class FakeEngines:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.engines = dict()   # (kind, port) -> FakeNeoGraph or FakeJanusGraph
+        self.latency = 0.0      # seconds per round trip
+
+    def get(self, kind, port):
+        with self.lock:
+            engine = self.engines.get((kind, port))
+            if engine is None:
+                engine = FakeNeoGraph(self) if kind == 'neo' else FakeJanusGraph(self)
+                self.engines[(kind, port)] = engine
+            return engine
+
+    def clear(self):
+        with self.lock:
+            self.engines = dict()
+
+    def stats(self):
+        with self.lock:
+            return dict((kind + ":" + str(port), engine.stats()) for (kind, port), engine in sorted(self.engines.items()))
+
+fake_engines = FakeEngines()
+
+class FakeEngine:
+    def __init__(self, engines):
+        self.engines = engines
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.latency_seconds = 0.0
+
+    def round_trip(self):
+        latency = self.engines.latency
+        with self.lock:
+            self.round_trips += 1
+            self.latency_seconds += latency
+        if 0 < latency:
+            time.sleep(latency)
+
+# A py2neo Graph over http: create() of a Node or Relationship, and run() of the
+# CYPHER below, are one round trip each.
+class FakeNeoGraph(FakeEngine):
+    def __init__(self, engines):
+        FakeEngine.__init__(self, engines)
+        self.nodes = []
+        self.relationships = []
+
+    def create(self, subgraph):
+        self.round_trip()
+        with self.lock:
+            if isinstance(subgraph, Relationship):
+                self.relationships.append(subgraph)
+            else:
+                self.nodes.append(subgraph)
+
+    def run(self, cypher):
+        self.round_trip()
+        query = " ".join(cypher.split()).rstrip(';')
+        with self.lock:
+            if query == "MATCH (n)-[r]-(m) RETURN n,r,m":
+                # undirected match: every relationship, both ways
+                return [(r.start_node, r, r.end_node) for r in self.relationships] + \
+                       [(r.end_node, r, r.start_node) for r in self.relationships]
+            if query == "MATCH (n) DETACH DELETE n":
+                self.nodes = []
+                self.relationships = []
+                return []
+        raise ValueError("fake neo does not understand: " + cypher)
+
+    def stats(self):
+        return {'nodes': len(self.nodes), 'relationships': len(self.relationships),
+                'round_trips': self.round_trips, 'latency_seconds': round(self.latency_seconds, 3)}
+
+# A janus server, through the traversal source janus_g() returns
+class FakeJanusGraph(FakeEngine):
+    def __init__(self, engines):
+        FakeEngine.__init__(self, engines)
+        self.vertices = collections.OrderedDict()   # id -> Vertex
+        self.edges = collections.OrderedDict()      # id -> Edge
+        self.properties = dict()                    # Vertex or Edge -> {key: value}
+        self.next_id = 0
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def stats(self):
+        return {'vertices': len(self.vertices), 'edges': len(self.edges),
+                'round_trips': self.round_trips, 'latency_seconds': round(self.latency_seconds, 3)}
+
+# g.V(), g.E() and g.addV() of a gremlin_python traversal source
+class FakeGremlinSource:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def V(self, *vertices):
+        return FakeTraversal(self.engine, [('V', vertices)])
+
+    def E(self):
+        return FakeTraversal(self.engine, [('E', ())])
+
+    def addV(self, label='vertex'):
+        return FakeTraversal(self.engine, [('addV', (label,))])
+
+# The steps are only recorded. The traversal goes to the engine, one round
+# trip, when it is iterated or next() is called, like a remote traversal.
+class FakeTraversal:
+    def __init__(self, engine, steps):
+        self.engine = engine
+        self.steps = steps
+        self.results = None
+
+    def step(self, name, *args):
+        self.steps.append((name, args))
+        return self
+
+    def property(self, key, value):
+        return self.step('property', key, value)
+
+    def addE(self, label):
+        return self.step('addE', label)
+
+    def to(self, vertex):
+        return self.step('to', vertex)
+
+    def valueMap(self):
+        return self.step('valueMap')
+
+    def drop(self):
+        return self.step('drop')
+
+    def __iter__(self):
+        if self.results is None:
+            self.engine.round_trip()
+            with self.engine.lock:
+                self.results = collections.deque(self.execute())
+        return self
+
+    def __next__(self):
+        iter(self)
+        if not self.results:
+            raise StopIteration
+        return self.results.popleft()
+
+    def next(self):
+        return self.__next__()
+
+    def toList(self):
+        return list(self)
+
+    def iterate(self):
+        iter(self)
+        return self
+
+    def execute(self):
+        engine = self.engine
+        objs = []
+        label = None
+        for name, args in self.steps:
+            if name == 'V':
+                ids = [v.id if isinstance(v, Vertex) else v for v in args]
+                objs = list(engine.vertices.values()) if not ids else [engine.vertices[i] for i in ids if i in engine.vertices]
+            elif name == 'E':
+                objs = list(engine.edges.values())
+            elif name == 'addV':
+                vertex = Vertex(engine.new_id(), args[0])
+                engine.vertices[vertex.id] = vertex
+                engine.properties[vertex] = dict()
+                objs = [vertex]
+            elif name == 'property':
+                for o in objs:
+                    engine.properties[o][args[0]] = args[1]
+            elif name == 'addE':
+                label = args[0]
+            elif name == 'to':
+                to = engine.vertices[args[0].id]
+                edges = []
+                for o in objs:
+                    edge = Edge(engine.new_id(), o, label, to)
+                    engine.edges[edge.id] = edge
+                    engine.properties[edge] = dict()
+                    edges.append(edge)
+                objs = edges
+            elif name == 'valueMap':
+                objs = [dict((k, [v]) for k, v in engine.properties[o].items()) for o in objs]
+            elif name == 'drop':
+                for o in objs:
+                    engine.properties.pop(o, None)
+                    if isinstance(o, Vertex):
+                        engine.vertices.pop(o.id, None)
+                        for edge in [e for e in engine.edges.values() if o in (e.inV, e.outV)]:
+                            engine.edges.pop(edge.id)
+                            engine.properties.pop(edge, None)
+                    else:
+                        engine.edges.pop(o.id, None)
+                objs = []
+        return objs
+
+# login to the neo server, or its stand-in for neo_ip 'fake'
+def neo_graph(neo_ip, neo_port):
+    if neo_ip == 'fake':
+        return fake_engines.get('neo', neo_port)
+    return Graph("http://" + neo_ip + ":" + str(neo_port) + "/db/data/", bolt=False, auth=("neo4j", "test"))
+
+# login to the janus server, or its stand-in for janus_ip 'fake'. Returns the traversal source.
+def janus_g(janus_ip, janus_port):
+    if janus_ip == 'fake':
+        return FakeGremlinSource(fake_engines.get('janus', janus_port))
+    graph = jGraph()
+    connstring = 'ws://' + janus_ip + ':' + str(janus_port) + '/gremlin'
+    return graph.traversal().withRemote(DriverRemoteConnection(connstring, 'g'))
+
+
+# Sets the latency of the in-process neo and janus stand-ins, and reports what
+# they hold and the round trips made to them.
+# i.e. http://localhost:5000/fake-engines?latency-ms=2&clear=1
+@app.route("/fake-engines", methods=['GET'])
+def fake_engines_status():
+    if 0 != int(request.args.get('clear', 0)):
+        fake_engines.clear()
+    if request.args.get('latency-ms') is not None:
+        fake_engines.latency = float(request.args.get('latency-ms')) / 1000.
+    return jsonify({'latency_ms': fake_engines.latency * 1000., 'engines': fake_engines.stats()})
+
+
 # This clones the specified local shard to a neo container
 def clone_shard_to_neo_internal(neo_ip, neo_port, shard_id, verbose):
-    global s
+    s = registry.snapshot('local').shards
 	
     if(0 == len(s)):
-        print("Local graph shards not yet created!")
+        log.warning("Local graph shards not yet created!")
         return "Local graph shards not yet created!"
 	
     # login to neo server
     #graph = Graph()
     #graph = Graph(host=url, auth=("neo4j", "test"))
-    graph = Graph("http://" + neo_ip + ":" + str(neo_port) + "/db/data/", bolt=False, auth=("neo4j", "test"))
+    graph = neo_graph(neo_ip, neo_port)
 
 
     # just don't call these networx APIs, all kinds of problems ensue!
@@ -2014,7 +7004,7 @@ def neo_edges():
     neo_port = int(request.args.get('neo-port'))
 	
     # login to neo server
-    graph = Graph("http://" + neo_ip + ":" + str(neo_port) + "/db/data/", bolt=False, auth=("neo4j", "test"))
+    graph = neo_graph(neo_ip, neo_port)
 	
     print("status:")
     for n,r,m in graph.run("MATCH (n)-[r]-(m) RETURN n,r,m;"):
@@ -2032,7 +7022,7 @@ def neo_clear():
     neo_port = int(request.args.get('neo-port'))
 	
     # login to neo server
-    graph = Graph("http://" + neo_ip + ":" + str(neo_port) + "/db/data/", bolt=False, auth=("neo4j", "test"))
+    graph = neo_graph(neo_ip, neo_port)
 	
     graph.run("MATCH (n) DETACH DELETE n;")
     return "cleared all nodes and edges!"
@@ -2048,12 +7038,12 @@ def bfs_trees_with_remote_nodes_neo_internal(neo_ip, neo_port, sources, verbose)
     finish_time = 0
     if verbose:
         start_time = time.time()
-        print('BFS from: ' + str(sources))
+        log.debug("BFS from sources=%s", sources)
 	
     # login to neo server
     #graph = Graph()
     #graph = Graph(host=url, auth=("neo4j", "test"))
-    graph = Graph("http://" + neo_ip + ":" + str(neo_port) + "/db/data/", bolt=False, auth=("neo4j", "test"))
+    graph = neo_graph(neo_ip, neo_port)
 
 	
 	# step 1: get all graph relationships, and find remote nodes with link info
@@ -2089,17 +7079,8 @@ def bfs_trees_with_remote_nodes_neo_internal(neo_ip, neo_port, sources, verbose)
     max_node = max(nodes)
 		
     if verbose: 
-        print("edges:")
-        print(edges)
-        print("number of edges:")
-        print(numedges)
-        print("remote nodes:")
-        print(remote_nodes)
-        print("number of nodes:")
-        print(len(nodes))
-        print("max of nodes:")
-        print(max_node)
-        print("BFS..")
+        log.debug("neo edges=%s numedges=%d remote_nodes=%s numnodes=%d max_node=%s",
+                  edges, numedges, remote_nodes, len(nodes), max_node)
 
     # step 2: BFS for each source
 	
@@ -2121,7 +7102,7 @@ def bfs_trees_with_remote_nodes_neo_internal(neo_ip, neo_port, sources, verbose)
         visited[s] = True
         if s in remote_nodes:
             if verbose:
-                print(s, remote_nodes[s])
+                log.debug("source=%s remote=%s", s, remote_nodes[s])
             #extnodes.add((s, remote_nodes[s]))
             extnodes[s] = remote_nodes[s]
         else:
@@ -2170,10 +7151,9 @@ def bfs_trees_with_remote_nodes_neo_internal(neo_ip, neo_port, sources, verbose)
     #print(extnodes_as_list)
 
     if verbose:
-        print(list((list(innodes), extnodes_as_list)))
         finish_time = time.time()
         bfs_time_in_seconds = finish_time - start_time
-        print("*** BFS on neo took " + str(bfs_time_in_seconds) + " seconds.")
+        log.debug("neo bfs innodes=%s extnodes=%s seconds=%s", innodes, extnodes_as_list, bfs_time_in_seconds)
 
     return j.dumps(list((list(innodes), extnodes_as_list)))
 	
@@ -2192,18 +7172,14 @@ def bfs_trees_with_remote_nodes_neo():
 	
 # This clones the specified local shard to a janus container
 def clone_shard_to_janus_internal(janus_ip, janus_port, shard_id, verbose):
-    global s
+    s = registry.snapshot('local').shards
 	
     if(0 == len(s)):
-        print("Local graph shards not yet created!")
+        log.warning("Local graph shards not yet created!")
         return "Local graph shards not yet created!"
 	
     # login to janus server
-    graph = jGraph()
-    #connstring = 'ws://' + url + ':8182/gremlin'
-    connstring = 'ws://' + janus_ip + ':' + str(janus_port) + '/gremlin'
-    #print(connstring)
-    g = graph.traversal().withRemote(DriverRemoteConnection(connstring, 'g'))
+    g = janus_g(janus_ip, janus_port)
 
 
     # just don't call these networx APIs, all kinds of problems ensue!
@@ -2305,11 +7281,7 @@ def janus_edges():
     janus_port = int(request.args.get('janus-port'))
 	
     # login to janus server
-    graph = jGraph()
-    #connstring = 'ws://' + url + ':8182/gremlin'
-    connstring = 'ws://' + janus_ip + ':' + str(janus_port) + '/gremlin'
-    #print(connstring)
-    g = graph.traversal().withRemote(DriverRemoteConnection(connstring, 'g'))
+    g = janus_g(janus_ip, janus_port)
 
     id_mapping = dict()
     l1 = [{**node.__dict__}['id'] for node in g.V()]
@@ -2332,11 +7304,7 @@ def janus_clear():
     janus_port = int(request.args.get('janus-port'))
 	
     # login to janus server
-    graph = jGraph()
-    #connstring = 'ws://' + url + ':8182/gremlin'
-    connstring = 'ws://' + janus_ip + ':' + str(janus_port) + '/gremlin'
-    #print(connstring)
-    g = graph.traversal().withRemote(DriverRemoteConnection(connstring, 'g'))
+    g = janus_g(janus_ip, janus_port)
 	
     try:
         g.V().drop().next()
@@ -2355,13 +7323,10 @@ def bfs_trees_with_remote_nodes_janus_internal(janus_ip, janus_port, sources, ve
     finish_time = 0
     if verbose:
         start_time = time.time()
-        print('BFS from: ' + str(sources))
+        log.debug("BFS from sources=%s", sources)
 	
     # login to janus server
-    graph = jGraph()
-    #connstring = 'ws://' + url + ':8182/gremlin'
-    connstring = 'ws://' + janus_ip + ':' + str(janus_port) + '/gremlin'
-    g = graph.traversal().withRemote(DriverRemoteConnection(connstring, 'g'))
+    g = janus_g(janus_ip, janus_port)
 	
 	# step 1: map janus id's to my id's, and find remote nodes with link info
     id_mapping = dict()
@@ -2369,13 +7334,11 @@ def bfs_trees_with_remote_nodes_janus_internal(janus_ip, janus_port, sources, ve
     janus_ids = [{**node.__dict__}['id'] for node in g.V()]
     node_props = [properties for node in g.V() for properties in g.V(node).valueMap()]
 
-    if verbose:
-        print("nodes:")
     for n in node_props:
         #print(n)
         try:
             if verbose:
-                print(n['id'], n['remote'])
+                log.debug("janus node id=%s remote=%s", n['id'], n['remote'])
                 #print('---')
             # Note I mark an empty property differently on janus because of the following exception with '[]':
             # Instead of if n['remote'][0] != '[]': like with neo, which causes the following error:
@@ -2386,17 +7349,13 @@ def bfs_trees_with_remote_nodes_janus_internal(janus_ip, janus_port, sources, ve
             #print('')
             continue
     if verbose:
-        print("number of nodes:")
-        print(str(len(node_props)))
-        print("remote_nodes:")
-        print(remote_nodes)
+        log.debug("janus numnodes=%d remote_nodes=%s", len(node_props), remote_nodes)
 	
     dino_ids = [n['id'][0] for n in node_props]
     for (a, b) in zip(janus_ids, dino_ids): 
         id_mapping[a] = b
     if verbose:
-        print("janus to dino id mapping:")
-        print(id_mapping)
+        log.debug("janus to dino id_mapping=%s", id_mapping)
 		
 			
     # step 2: get edges
@@ -2413,9 +7372,7 @@ def bfs_trees_with_remote_nodes_janus_internal(janus_ip, janus_port, sources, ve
         else:
             edges[d_src] = {d_trg}
     if verbose:
-        print("edges:")
-        print(edges)
-        print("BFS..")
+        log.debug("janus edges=%s", edges)
 
     # step 3: BFS for each source
 	
@@ -2486,10 +7443,9 @@ def bfs_trees_with_remote_nodes_janus_internal(janus_ip, janus_port, sources, ve
     #print(extnodes_as_list)
 
     if verbose:
-        print(list((list(innodes), extnodes_as_list)))
         finish_time = time.time()
         bfs_time_in_seconds = finish_time - start_time
-        print("*** BFS on janus took " + str(bfs_time_in_seconds) + " seconds.")
+        log.debug("janus bfs innodes=%s extnodes=%s seconds=%s", innodes, extnodes_as_list, bfs_time_in_seconds)
 
     return j.dumps(list((list(innodes), extnodes_as_list)))
 	
@@ -2549,4 +7505,4 @@ def exp3():
     return render_template("exp3.html")
 		
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    app.run(host='0.0.0.0', port=5000, threaded=True)